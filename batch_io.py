@@ -0,0 +1,245 @@
+"""
+# Batched UDP send and receive
+sendmmsg(2) and recvmmsg(2) through ctypes, so a fan-out to a whole room or
+a burst of incoming datagrams costs one syscall per MAX_BATCH datagrams
+instead of one per datagram.
+The mmsghdr/iovec arrays are built as array('Q') words with slice
+assignment, so preparing a batch costs a few C-level copies rather than
+Python work per datagram.
+Only 64-bit little-endian Linux and IPv4 addresses are supported,
+BATCH_AVAILABLE is False elsewhere and callers fall back to
+sendto/recvfrom_into loops.
+"""
+import array
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+import sys
+
+# Kernel limit on datagrams per sendmmsg/recvmmsg call (UIO_MAXIOV)
+MAX_BATCH = 1024
+MSG_WAITFORONE = 0x10000
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.c_void_p),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+# An mmsghdr is 8 words: msg_name, msg_namelen, msg_iov, msg_iovlen,
+# msg_control, msg_controllen, msg_flags, msg_len
+_WORDS = 8
+_SOCKADDR_IN_SIZE = 16
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux') or sys.byteorder != 'little':
+        return None
+    # The word layout above must match the C structs
+    if (ctypes.sizeof(_MMsgHdr) != _WORDS * 8
+            or _MsgHdr.msg_namelen.offset != 8
+            or _MsgHdr.msg_iov.offset != 16
+            or _MsgHdr.msg_iovlen.offset != 24
+            or _MMsgHdr.msg_len.offset != 56
+            or ctypes.sizeof(_IOVec) != 16):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_libc = _load_libc()
+BATCH_AVAILABLE = _libc is not None
+
+# sockaddr_in for each destination, fan-out sends to the same addresses over and over
+_sockaddr_cache = {}
+# {id(buffer): (buffer, address)} for long-lived buffers such as the receive pool
+_pinned = {}
+
+
+def _sockaddr_in(address):
+    sockaddr = _sockaddr_cache.get(address)
+    if sockaddr is None:
+        if len(address) != 2:
+            raise ValueError(f'not an IPv4 address: {address}')
+        host, port = address
+        try:
+            packed_host = socket.inet_aton(host)
+        except OSError:
+            raise ValueError(f'not an IPv4 address: {address}')
+        sockaddr = struct.pack('@H', socket.AF_INET) + struct.pack('!H', port) + packed_host + bytes(8)
+        if len(_sockaddr_cache) > 65536:
+            _sockaddr_cache.clear()
+        _sockaddr_cache[address] = sockaddr
+    return sockaddr
+
+
+def pin_buffers(buffers):
+    """Remember the memory address of buffers that are reused for every batch
+    The buffers are kept alive for the life of the process.
+    """
+    for buffer in buffers:
+        _pinned[id(buffer)] = (buffer, ctypes.addressof(ctypes.c_char.from_buffer(buffer)))
+
+
+def _buffer_address(data, keep_alive):
+    """Address and length of a bytes-like object's memory"""
+    pinned = _pinned.get(id(data))
+    if pinned is not None:
+        return pinned[1], len(data)
+    if isinstance(data, bytes):
+        keep_alive.append(data)
+        return ctypes.c_void_p.from_buffer(ctypes.c_char_p(data)).value, len(data)
+    view = memoryview(data)
+    if view.readonly:
+        data = view.tobytes()
+        keep_alive.append(data)
+        return ctypes.c_void_p.from_buffer(ctypes.c_char_p(data)).value, len(data)
+    if view.nbytes == 0:
+        return 0, 0
+    buffer = ctypes.c_char.from_buffer(view)
+    keep_alive.append(buffer)
+    return ctypes.addressof(buffer), view.nbytes
+
+
+def _message_array(count, sockaddr_address, iovec_pointers):
+    """mmsghdr array for count datagrams, one sockaddr_in and one iovec each"""
+    words = array.array('Q', bytes(count * _WORDS * 8))
+    words[0::_WORDS] = array.array('Q', range(sockaddr_address, sockaddr_address + count * _SOCKADDR_IN_SIZE,
+                                              _SOCKADDR_IN_SIZE))
+    words[1::_WORDS] = array.array('Q', [_SOCKADDR_IN_SIZE]) * count
+    words[2::_WORDS] = iovec_pointers
+    words[3::_WORDS] = array.array('Q', [1]) * count
+    return words
+
+
+def send_batch(fileno, packets):
+    """Send every (data, address) in packets with sendmmsg
+    Packets that share the same data object share one iovec.
+    Args:
+        fileno: file descriptor of an AF_INET UDP socket
+        packets: list of (data, (ip, port))
+    Raises:
+        ValueError: if an address is not an IPv4 (ip, port) pair
+    Returns:
+        (sent, failures): packets[sent:] were not attempted because the
+        socket would block, failures is a list of (index, OSError)
+    """
+    count = len(packets)
+    keep_alive = []
+    # One iovec per distinct packet, a fan-out usually has one or two
+    iovec_index = {}
+    iovecs = array.array('Q')
+    for data, _ in packets:
+        if id(data) not in iovec_index:
+            iovec_index[id(data)] = len(iovec_index)
+            iovecs.extend(_buffer_address(data, keep_alive))
+    sockaddrs = array.array('Q', b''.join([_sockaddr_in(address) for _, address in packets]))
+    iovec_address = iovecs.buffer_info()[0]
+    iovec_pointers = array.array('Q', [iovec_address + iovec_index[id(data)] * 16 for data, _ in packets])
+    messages = _message_array(count, sockaddrs.buffer_info()[0], iovec_pointers)
+    messages_address = messages.buffer_info()[0]
+
+    failures = []
+    sent = 0
+    while sent < count:
+        batch = min(count - sent, MAX_BATCH)
+        result = _libc.sendmmsg(fileno, messages_address + sent * _WORDS * 8, batch, 0)
+        if result >= 0:
+            sent += result
+            continue
+        err = ctypes.get_errno()
+        if err == errno.EINTR:
+            continue
+        if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+            break
+        # sendmmsg stops at the first datagram it cannot send, skip it and go on
+        failures.append((sent, OSError(err, os.strerror(err))))
+        sent += 1
+    return sent, failures
+
+
+class BatchReceiver:
+    """recvmmsg into a fixed set of buffer slots
+    The mmsghdr/iovec arrays are built once, and handing a filled buffer
+    off and putting a fresh one in its slot only rewrites one iovec.
+    """
+
+    def __init__(self, buffers):
+        self.buffers = list(buffers[:MAX_BATCH])
+        self.count = len(self.buffers)
+        self.keep_alive = [None] * self.count
+        self.iovecs = array.array('Q', bytes(self.count * 16))
+        for index, buffer in enumerate(self.buffers):
+            self.replace(index, buffer)
+        self.sockaddrs = array.array('Q', bytes(self.count * _SOCKADDR_IN_SIZE))
+        iovec_address = self.iovecs.buffer_info()[0]
+        self.messages = _message_array(self.count, self.sockaddrs.buffer_info()[0],
+                                       array.array('Q', range(iovec_address, iovec_address + self.count * 16, 16)))
+        # (ip, port) for each sockaddr_in seen, senders keep sending from the same address
+        self.addresses = {}
+
+    def replace(self, index, buffer):
+        """Put buffer in slot index, e.g. after the old one was handed off"""
+        keep_alive = []
+        self.buffers[index] = buffer
+        self.iovecs[index * 2], self.iovecs[index * 2 + 1] = _buffer_address(buffer, keep_alive)
+        self.keep_alive[index] = keep_alive
+
+    def receive(self, fileno, flags=MSG_WAITFORONE):
+        """Receive into the slots with one recvmmsg call
+        With MSG_WAITFORONE the call blocks for the first datagram only and
+        then takes whatever else is already queued.
+        Returns:
+            list of (nbytes, (ip, port)) for slots 0..n-1
+        """
+        while True:
+            result = _libc.recvmmsg(fileno, self.messages.buffer_info()[0], self.count, flags, None)
+            if result >= 0:
+                break
+            err = ctypes.get_errno()
+            if err != errno.EINTR:
+                raise OSError(err, os.strerror(err))
+
+        names = self.sockaddrs.tobytes()
+        received = []
+        for index in range(result):
+            nbytes = self.messages[index * _WORDS + 7] & 0xffffffff
+            sockaddr = names[index * _SOCKADDR_IN_SIZE:index * _SOCKADDR_IN_SIZE + 8]
+            address = self.addresses.get(sockaddr)
+            if address is None:
+                if len(self.addresses) > 65536:
+                    self.addresses.clear()
+                address = (socket.inet_ntoa(sockaddr[4:8]), int.from_bytes(sockaddr[2:4], 'big'))
+                self.addresses[sockaddr] = address
+            received.append((nbytes, address))
+        return received
+
+
+def recv_batch(fileno, buffers, flags=MSG_WAITFORONE):
+    """Receive up to len(buffers) datagrams with one recvmmsg call
+    Returns:
+        list of (nbytes, (ip, port)), one per filled buffer in order
+    """
+    return BatchReceiver(buffers).receive(fileno, flags)
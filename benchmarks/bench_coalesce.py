@@ -0,0 +1,102 @@
+"""
+# Coalescing benchmark
+Start server.py with each --coalesce-ms window in --windows, have one room
+of --room-size v3 ChatClients all chatting at --rate messages/sec and report:
+- datagrams the server sent per message (chat_udp_packets_sent_total)
+- server CPU seconds per 1000 messages, read from /proc
+- delivery latency p50 / p99 from send to receipt
+- deliveries received out of (room size - 1) per message sent
+
+Window 0 is the uncoalesced baseline. A longer window packs more messages
+in a datagram for a busier room, and adds up to the window to the latency.
+
+usage:
+    python benchmarks/bench_coalesce.py --windows 0 2 5 10 --room-size 20 --rate 10
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+from bench_udp_engine import HOST, percentile, start_server, stop_server
+from chat_client import ChatClient, EndpointPool
+from loadgen import scrape_metric, server_cpu_seconds
+from wire import PROTOCOL_V3
+
+async def receive(client, latencies):
+    async for _, _, message in client:
+        latencies.append(time.perf_counter_ns() - int(message))
+
+async def send(client, count, interval):
+    await asyncio.sleep(random.uniform(0, interval))
+    for _ in range(count):
+        await client.send(str(time.perf_counter_ns()))
+        await asyncio.sleep(interval)
+
+async def chat(args, server_pid):
+    endpoints = EndpointPool((HOST, 0))
+    clients = [ChatClient(HOST, args.tcp_port, args.udp_port, PROTOCOL_V3, endpoints) for _ in range(args.room_size)]
+    await clients[0].join('coalesce', 'user-0')
+    await asyncio.gather(*(client.join('coalesce', f'user-{index}') for index, client in enumerate(clients) if index))
+    await asyncio.sleep(0.5)
+
+    loop = asyncio.get_running_loop()
+    sent_before = await loop.run_in_executor(None, scrape_metric, args.metrics_port, 1, 'chat_udp_packets_sent_total')
+    cpu_before = server_cpu_seconds(server_pid)
+    latencies = []
+    receivers = [asyncio.create_task(receive(client, latencies)) for client in clients]
+    await asyncio.gather(*(send(client, args.count, 1 / args.rate) for client in clients))
+    await asyncio.sleep(0.5)
+    cpu_after = server_cpu_seconds(server_pid)
+    sent_after = await loop.run_in_executor(None, scrape_metric, args.metrics_port, 1, 'chat_udp_packets_sent_total')
+    for client in clients:
+        await client.close()
+    await asyncio.gather(*receivers)
+    endpoints.close()
+
+    messages = args.room_size * args.count
+    return {
+        'datagrams_per_message': (sent_after - sent_before) / messages,
+        'cpu_per_1000': (cpu_after - cpu_before) / messages * 1000 if cpu_before is not None else 0.0,
+        'p50_ms': percentile(latencies, 50) / 1e6,
+        'p99_ms': percentile(latencies, 99) / 1e6,
+        'delivered': len(latencies) / (messages * (args.room_size - 1)),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--windows', nargs='+', type=float, default=[0, 2, 5, 10], help='coalescing windows in ms')
+    parser.add_argument('--mode', default='asyncio', help='server UDP engine')
+    parser.add_argument('--coalesce-bytes', type=int, default=1400)
+    parser.add_argument('--room-size', type=int, default=20)
+    parser.add_argument('--count', type=int, default=100, help='messages each member sends')
+    parser.add_argument('--rate', type=float, default=10.0, help='messages/sec per member')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--tcp-port', type=int, default=19060)
+    parser.add_argument('--udp-port', type=int, default=19061)
+    parser.add_argument('--metrics-port', type=int, default=19062)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    print(f'{args.room_size} members x {args.count} messages at {args.rate:g}/sec each, '
+          f'{args.room_size * args.rate:g} messages/sec in the room')
+    print(f'{"window ms":>9} {"datagrams/msg":>14} {"cpu ms/1000":>12} {"p50 ms":>8} {"p99 ms":>8} {"delivered":>10}')
+    for window in args.windows:
+        server = start_server(args.mode, args.tcp_port, args.udp_port, extra_args=[
+            '--log-level', 'WARNING', '--metrics-port', str(args.metrics_port),
+            '--coalesce-ms', str(window), '--coalesce-bytes', str(args.coalesce_bytes)])
+        try:
+            result = asyncio.run(chat(args, server.pid))
+        finally:
+            stop_server(server)
+        print(f'{window:>9g} {result["datagrams_per_message"]:>14.2f} {result["cpu_per_1000"] * 1e3:>12.1f} '
+              f'{result["p50_ms"]:>8.2f} {result["p99_ms"]:>8.2f} {result["delivered"]:>10.2%}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""
+# Compression benchmark
+Messages come from --corpus, one per line, or a generated chat corpus;
+half of them train a dictionary with compression.train_dictionary(), the
+other half are measured. For no compression, plain deflate and deflate
+with the trained dictionary the run reports:
+- codec: v3 packet bytes per message and microseconds to compress and to
+  decompress one message, in this process
+- server: start server.py (--compression, --compression-dictionary), join
+  --members members that ask for compression to one room, have --senders
+  of them send the messages compressed and report the v3 datagram bytes
+  each member received per message, the server CPU microseconds per
+  message sent, read from /proc, and the delivered share
+
+usage:
+    python benchmarks/bench_compression.py --members 20 --senders 4 --count 500
+"""
+import argparse
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+from bench_udp_engine import HOST, recv_tcp_packet, start_server, stop_server
+from compression import Codec, train_dictionary
+from loadgen import server_cpu_seconds
+from wire import (CAPABILITY_COMPRESSION, PROTOCOL_V3, build_tcp_packet, build_udp_packet, compress_packet,
+                  split_udp_messages)
+
+ROOM_NAME = 'compression'
+TOKEN = 'f' * 32
+WORDS = ('i you the a to is it and that we what for in of on my have just so no not be do are this lol ok '
+         'yeah know can get was but like me at with all about think go your he she they will out up now '
+         'there if when going how see good one time today tomorrow meeting later thanks sure right back '
+         'really great sorry need want call work home let us still done new where here well maybe could '
+         'would should morning night weekend project deploy review server room message please').split()
+NAMES = ('alice', 'bob', 'carol', 'dave', 'erin', 'frank')
+
+def generate_corpus(count, seed):
+    """Chat-like messages, word frequencies falling off like a natural language's"""
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+    messages = []
+    for _ in range(count):
+        words = rng.choices(WORDS, weights, k=rng.choice((2, 4, 8, 12, 20, 30, 45)))
+        if rng.random() < 0.3:
+            words.insert(0, f'@{rng.choice(NAMES)}')
+        messages.append(' '.join(words).capitalize() + rng.choice(('', '.', '?', '!', ' :)')))
+    return messages
+
+def v3_packet(message):
+    return build_udp_packet(ROOM_NAME, TOKEN, message, PROTOCOL_V3)
+
+def measure_codec(codec, messages):
+    """(packet bytes per message, compress us, decompress us), codec None sends them plain"""
+    packets = [v3_packet(message) for message in messages]
+    if codec is None:
+        return sum(map(len, packets)) / len(packets), 0.0, 0.0
+    started = time.perf_counter()
+    compressed = [compress_packet(packet, codec) for packet in packets]
+    compress_time = time.perf_counter() - started
+    started = time.perf_counter()
+    for packet in compressed:
+        split_udp_messages(packet, PROTOCOL_V3, codec)
+    decompress_time = time.perf_counter() - started
+    return (sum(map(len, compressed)) / len(compressed),
+            compress_time / len(messages) * 1e6, decompress_time / len(messages) * 1e6)
+
+def join(tcp_port, username, compression):
+    """Join the room as a v3 member, with the server's Codec if compression was granted
+    Returns:
+        (token, codec)
+    """
+    state = PROTOCOL_V3 | CAPABILITY_COMPRESSION if compression else PROTOCOL_V3
+    conn = socket.create_connection((HOST, tcp_port))
+    try:
+        conn.sendall(build_tcp_packet(0, state, ROOM_NAME, username, PROTOCOL_V3))
+        recv_tcp_packet(conn, PROTOCOL_V3)  # operation 1: status
+        _, state, _, token = recv_tcp_packet(conn, PROTOCOL_V3)  # operation 2: token
+        if not state & CAPABILITY_COMPRESSION:
+            return token.decode(), None
+        conn.sendall(build_tcp_packet(5, 0, ROOM_NAME, '', PROTOCOL_V3))
+        recv_tcp_packet(conn, PROTOCOL_V3)  # operation 1: status
+        _, _, _, dictionary = recv_tcp_packet(conn, PROTOCOL_V3)  # operation 6: dictionary
+        return token.decode(), Codec(dictionary[4:])
+    finally:
+        conn.close()
+
+def receive(member, codec, totals, done):
+    member.settimeout(0.2)
+    while not done.is_set():
+        try:
+            data = member.recv(65536)
+        except socket.timeout:
+            continue
+        messages = split_udp_messages(data, PROTOCOL_V3, codec)
+        with totals['lock']:
+            totals['bytes'] += len(data)
+            totals['messages'] += len(messages)
+
+def send(member, token, codec, messages, udp_port, interval):
+    for message in messages:
+        packet = build_udp_packet(ROOM_NAME, token, message, PROTOCOL_V3)
+        if codec is not None:
+            packet = compress_packet(packet, codec)
+        member.sendto(packet, (HOST, udp_port))
+        time.sleep(interval)
+
+def measure_server(extra_args, messages, args):
+    """(datagram bytes per delivered message, server CPU us per message, delivered share)"""
+    server = start_server(args.mode, args.tcp_port, args.udp_port, extra_args=['--log-level', 'WARNING', *extra_args])
+    try:
+        members = []
+        for index in range(args.members):
+            token, codec = join(args.tcp_port, f'member-{index}', True)
+            member = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            member.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+            member.bind((HOST, 0))
+            member.sendto(build_udp_packet(ROOM_NAME, token, '', PROTOCOL_V3), (HOST, args.udp_port))
+            members.append((member, token, codec))
+        time.sleep(0.5)
+
+        totals = {'bytes': 0, 'messages': 0, 'lock': threading.Lock()}
+        done = threading.Event()
+        receivers = [threading.Thread(target=receive, args=(member, codec, totals, done), daemon=True)
+                     for member, _, codec in members]
+        for receiver in receivers:
+            receiver.start()
+        # Drop the ACKs of the registrations
+        time.sleep(0.2)
+        with totals['lock']:
+            totals['bytes'] = totals['messages'] = 0
+        cpu_before = server_cpu_seconds(server.pid)
+        senders = [threading.Thread(target=send, args=(member, token, codec, messages[index::args.senders],
+                                                       args.udp_port, 1 / args.rate))
+                   for index, (member, token, codec) in enumerate(members[:args.senders])]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        time.sleep(0.5)
+        cpu_after = server_cpu_seconds(server.pid)
+        done.set()
+        for receiver in receivers:
+            receiver.join()
+        for member, _, _ in members:
+            member.close()
+        # The ACKs each sender gets for its own messages are not deliveries
+        delivered = totals['messages']
+        wire_bytes = totals['bytes'] - len(messages) * len(build_udp_packet(ROOM_NAME, '', '', PROTOCOL_V3))
+        cpu = (cpu_after - cpu_before) / len(messages) * 1e6 if cpu_before is not None else 0.0
+        return wire_bytes / max(delivered, 1), cpu, delivered / (len(messages) * (args.members - 1))
+    finally:
+        stop_server(server)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', help='file of sample messages, one per line, default generates them')
+    parser.add_argument('--count', type=int, default=1000, help='messages measured, as many again train the dictionary')
+    parser.add_argument('--mode', default='threaded', help='server UDP engine')
+    parser.add_argument('--members', type=int, default=20)
+    parser.add_argument('--senders', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=100.0, help='messages/sec per sender')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--tcp-port', type=int, default=19700)
+    parser.add_argument('--udp-port', type=int, default=19701)
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus, encoding='utf-8') as corpus:
+            samples = [line.rstrip('\n') for line in corpus if line.strip()]
+    else:
+        samples = generate_corpus(2 * args.count, args.seed)
+    random.Random(args.seed).shuffle(samples)
+    training, messages = samples[:len(samples) // 2], samples[len(samples) // 2:][:args.count]
+    dictionary = train_dictionary([message.encode() for message in training])
+    setups = [('off', None, []), ('deflate', Codec(), ['--compression'])]
+
+    with tempfile.NamedTemporaryFile(suffix='.dict') as dictionary_file:
+        dictionary_file.write(dictionary)
+        dictionary_file.flush()
+        setups.append(('dictionary', Codec(dictionary), ['--compression-dictionary', dictionary_file.name]))
+
+        print(f'{len(messages)} messages of {sum(map(len, messages)) / len(messages):.0f} bytes on average, '
+              f'{len(dictionary)} byte dictionary from {len(training)} others')
+        print(f'{"codec":<11} {"bytes/msg":>9} {"ratio":>6} {"compress us":>12} {"decompress us":>14}')
+        plain = None
+        for name, codec, _ in setups:
+            size, compress_us, decompress_us = measure_codec(codec, messages)
+            plain = plain or size
+            print(f'{name:<11} {size:>9.1f} {size / plain:>6.2f} {compress_us:>12.1f} {decompress_us:>14.1f}')
+
+        print(f'\n{args.members} members, {args.senders} sending at {args.rate:g} messages/sec each')
+        print(f'{"server":<11} {"bytes/delivery":>14} {"cpu us/msg":>11} {"delivered":>10}')
+        for name, _, extra_args in setups:
+            size, cpu, delivered = measure_server(extra_args, messages, args)
+            print(f'{name:<11} {size:>14.1f} {cpu:>11.0f} {delivered:>10.2%}')
+
+if __name__ == '__main__':
+    main()
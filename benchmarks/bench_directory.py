@@ -0,0 +1,92 @@
+"""
+# Room directory benchmark
+Fill a RoomRegistry with --rooms rooms in process, then time a page of the
+room list two ways:
+- scan: what operation 11 did before the directory, the first names of
+  every room name found with heapq.nsmallest, the member counts looked up
+- directory: RoomRegistry.room_page, a page off the sorted index
+For each the run reports microseconds for the first page, a page from a
+cursor in the middle, and a prefix search, and, for the directory, the cost
+it adds to creating and deleting a room.
+
+usage:
+    python benchmarks/bench_directory.py --rooms 10000 100000 1000000 --page 100
+"""
+import argparse
+import heapq
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+
+from room_directory import RoomDirectory
+from room_registry import RoomRegistry
+
+def scan_page(registry, limit, after=None, prefix=''):
+    """A page of (room_name, member_count) found by scanning every room name"""
+    room_names = (name for name in registry.room_names()
+                  if name.startswith(prefix) and (after is None or name > after))
+    return [(name, len(registry.rooms[name].members)) for name in heapq.nsmallest(limit, room_names)]
+
+def time_us(function, repeat):
+    """Best microseconds of repeat calls of function"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best * 1e6
+
+def fill(rooms):
+    registry = RoomRegistry()
+    for index in range(rooms):
+        # Creation order is not name order
+        registry.create_room(f'room-{index * 7919 % rooms:07d}', f'token-{index}', ('127.0.0.1', index), 2)
+    return registry
+
+def measure(rooms, args):
+    registry = fill(rooms)
+    cursor = f'room-{rooms // 2:07d}'
+    prefix = f'room-{rooms // 3:07d}'[:-2]
+    pages = {}
+    results = []
+    for name, page, repeat in (('scan', lambda *request: scan_page(registry, *request),
+                                # The scan walks every room, fewer repeats keep the run short
+                                max(1, args.repeat // 10)),
+                               ('directory', lambda *request: registry.room_page(*request)[0], args.repeat)):
+        pages[name] = [page(args.page), page(args.page, cursor), page(args.page, None, prefix)]
+        results.append((time_us(lambda: page(args.page), repeat),
+                        time_us(lambda: page(args.page, cursor), repeat),
+                        time_us(lambda: page(args.page, None, prefix), repeat)))
+    if pages['scan'] != pages['directory']:
+        raise RuntimeError(f'{rooms} rooms: the pages differ')
+
+    directory = RoomDirectory(registry.rooms)
+    names = [f'extra-{index}' for index in range(args.repeat * 10)]
+    started = time.perf_counter()
+    for name in names:
+        directory.add(name)
+    for name in names:
+        directory.discard(name)
+    update_us = (time.perf_counter() - started) * 1e6 / (2 * len(names))
+    return results[0], results[1], update_us
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--page', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=100)
+    args = parser.parse_args()
+
+    print(f'page of {args.page}, best of {args.repeat} (scan: of {max(1, args.repeat // 10)})')
+    print(f'{"rooms":>8} {"list":<10} {"first us":>11} {"cursor us":>11} {"prefix us":>11} {"add/del us":>11}')
+    for rooms in args.rooms:
+        scan, directory, update_us = measure(rooms, args)
+        for name, (first_us, cursor_us, prefix_us), update in (('scan', scan, ''),
+                                                                ('directory', directory, f'{update_us:.2f}')):
+            print(f'{rooms:>8} {name:<10} {first_us:>11.1f} {cursor_us:>11.1f} {prefix_us:>11.1f} {update:>11}')
+
+if __name__ == '__main__':
+    main()
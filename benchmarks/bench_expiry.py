@@ -0,0 +1,90 @@
+"""
+# Expiry benchmark
+Fill the registry with idle members (1M by default) whose last activity is
+spread over the inactivity threshold, then compare:
+- sweep: the old cleanup_clients pass over every member of every room
+- wheel: server.expire_clients for one granularity tick, which only visits
+  the members whose expiry came due
+Also reports a tick where nothing is due and how late members expire.
+
+usage:
+    python benchmarks/bench_expiry.py --members 1000000 --room-size 100
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import server
+
+def populate(members, room_size, threshold, now):
+    """Create rooms of room_size idle members, last activity spread over the threshold"""
+    registry = server.registry
+    for index in range(members):
+        room_name = f'room-{index // room_size}'
+        token = str(index)
+        address = ('127.0.0.1', 10000 + index % 50000)
+        if index % room_size == 0:
+            member = registry.create_room(room_name, token, address, server.PROTOCOL_V2)
+        else:
+            member = registry.join(room_name, token, address, server.PROTOCOL_V2)
+        # Owners stay active so their rooms live through the whole run
+        if index % room_size == 0:
+            member.last_active = now + threshold
+        else:
+            member.last_active = now - threshold * (index % 997) / 997
+        server.schedule_expiry(member)
+
+def sweep(threshold, now):
+    """The old cleanup_clients pass, without removing anything"""
+    inactive = 0
+    for room_name in server.registry.room_names():
+        for member in server.registry.members(room_name):
+            if now - member.last_active > threshold:
+                inactive += 1
+    return inactive
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, default=1000000)
+    parser.add_argument('--room-size', type=int, default=100)
+    parser.add_argument('--threshold', type=float, default=180)
+    parser.add_argument('--granularity', type=float, default=1.0)
+    args = parser.parse_args()
+
+    now = time.time()
+    server.configure_expiry(args.threshold, args.granularity)
+    started = time.perf_counter()
+    populate(args.members, args.room_size, args.threshold, now)
+    print(f'populated {args.members} members in {len(server.registry)} rooms '
+          f'in {time.perf_counter() - started:.2f} s')
+
+    started = time.perf_counter()
+    inactive = sweep(args.threshold, now + args.granularity)
+    print(f'sweep over every member: {(time.perf_counter() - started) * 1e3:.1f} ms, {inactive} inactive')
+
+    # Catch the wheel up to now: nothing is due yet
+    started = time.perf_counter()
+    expired = server.expire_clients(now)
+    idle_tick = time.perf_counter() - started
+
+    ticks = 10
+    total_expired = 0
+    tick_times = []
+    for tick in range(1, ticks + 1):
+        started = time.perf_counter()
+        total_expired += server.expire_clients(now + tick * args.granularity)
+        tick_times.append(time.perf_counter() - started)
+
+    print(f'wheel tick with nothing due: {idle_tick * 1e3:.3f} ms ({expired} expired)')
+    print(f'wheel ticks: {sum(tick_times) / ticks * 1e3:.1f} ms per tick, '
+          f'{total_expired / ticks:.0f} expired per tick, '
+          f'{sum(tick_times) / max(total_expired, 1) * 1e6:.2f} us per expired member')
+    print(f'members expire at most {args.granularity:.1f} s late (the sweep: up to 60 s)')
+    print(f'members left: {server.registry.member_count()}')
+
+if __name__ == '__main__':
+    main()
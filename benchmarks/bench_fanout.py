@@ -0,0 +1,118 @@
+"""
+# Fan-out benchmark
+Send one chat packet to every member of a room the way
+send_message_to_clients does, once with a sendto per member and once with
+batch_io.send_batch (sendmmsg), for room sizes from 10 to 10k members.
+Also compares a recvfrom_into loop with batch_io.recv_batch (recvmmsg).
+
+usage:
+    python benchmarks/bench_fanout.py --sizes 10 100 1000 10000
+"""
+import argparse
+import os
+import socket
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import batch_io
+from wire import build_udp_packet
+
+HOST = '127.0.0.1'
+SINKS = 16
+
+def make_sinks():
+    """Receiving sockets that the room members' addresses point at"""
+    sinks = []
+    for _ in range(SINKS):
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        sink.bind((HOST, 0))
+        sink.setblocking(False)
+        sinks.append(sink)
+    return sinks
+
+def drain(sinks):
+    for sink in sinks:
+        try:
+            while True:
+                sink.recv(4096)
+        except BlockingIOError:
+            pass
+
+def fanout_loop(sender, packets):
+    for data, address in packets:
+        sender.sendto(data, address)
+
+def fanout_batch(sender, packets):
+    batch_io.send_batch(sender.fileno(), packets)
+
+def time_fanout(function, sender, packets, sinks, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(sender, packets)
+        best = min(best, time.perf_counter() - started)
+        drain(sinks)
+    return best
+
+def time_receive(use_batch, sender, receiver, packet, count):
+    buffers = [bytearray(4096) for _ in range(32)]
+    # The server pins its pooled receive buffers the same way
+    batch_io.pin_buffers(buffers)
+    batch_receiver = batch_io.BatchReceiver(buffers) if use_batch else None
+    address = receiver.getsockname()
+    for _ in range(count):
+        sender.sendto(packet, address)
+    received = 0
+    started = time.perf_counter()
+    while received < count:
+        if use_batch:
+            received += len(batch_receiver.receive(receiver.fileno()))
+        else:
+            receiver.recvfrom_into(buffers[0])
+            received += 1
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000, 10000], help='room sizes')
+    parser.add_argument('--message-size', type=int, default=64, help='chat message bytes')
+    parser.add_argument('--repeat', type=int, default=5, help='fan-outs per size, the best one is reported')
+    parser.add_argument('--protocol', type=int, default=2, help='packet protocol version')
+    args = parser.parse_args()
+
+    if not batch_io.BATCH_AVAILABLE:
+        print('sendmmsg/recvmmsg are not available on this platform, only the loop is measured')
+
+    packet = bytes(build_udp_packet('bench', 'token', 'x' * args.message_size, args.protocol))
+    sinks = make_sinks()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 22)
+
+    print(f'{"members":>8} {"loop ms":>9} {"batch ms":>9} {"loop pkt/s":>11} {"batch pkt/s":>12} {"speedup":>8}')
+    for size in args.sizes:
+        packets = [(packet, sinks[index % SINKS].getsockname()) for index in range(size)]
+        loop = time_fanout(fanout_loop, sender, packets, sinks, args.repeat)
+        if batch_io.BATCH_AVAILABLE:
+            batch = time_fanout(fanout_batch, sender, packets, sinks, args.repeat)
+        else:
+            batch = float('nan')
+        print(f'{size:>8} {loop * 1e3:>9.3f} {batch * 1e3:>9.3f} {size / loop:>11.0f} '
+              f'{size / batch:>12.0f} {loop / batch:>7.2f}x')
+
+    receiver = sinks[0]
+    receiver.setblocking(True)
+    count = 2000
+    loop = time_receive(False, sender, receiver, packet, count)
+    print(f'\nreceive {count} datagrams: recvfrom_into loop {loop * 1e3:.3f} ms', end='')
+    if batch_io.BATCH_AVAILABLE:
+        batch = time_receive(True, sender, receiver, packet, count)
+        print(f', recvmmsg {batch * 1e3:.3f} ms ({loop / batch:.2f}x)')
+    else:
+        print()
+
+if __name__ == '__main__':
+    main()
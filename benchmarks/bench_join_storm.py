@@ -0,0 +1,96 @@
+"""
+# Join storm benchmark
+Start server.py and open --joins TCP connections, --concurrency at a time,
+each one joining one of --rooms rooms with an operation 0 request and
+reading the status and token responses. Reports:
+- joins/sec completed
+- p50 / p99 time from connect to token
+- failed joins (refused, reset or error responses)
+
+usage:
+    python benchmarks/bench_join_storm.py --joins 20000 --concurrency 1000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_udp_engine import HOST, percentile, start_server, stop_server
+from wire import PACKET_SIZE, build_tcp_packet
+
+async def read_frame(reader, version):
+    """Read one response frame, return (operation, state)"""
+    header = await reader.readexactly(32)
+    size = 32 + header[0] + int.from_bytes(header[3:32], 'big')
+    await reader.readexactly(size - 32)
+    if version == 1 and size < PACKET_SIZE:
+        await reader.readexactly(PACKET_SIZE - size)
+    return header[1], header[2]
+
+async def join(tcp_port, room_name, username, version, latencies):
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection(HOST, tcp_port)
+    except OSError:
+        return False
+    try:
+        writer.write(build_tcp_packet(0, version, room_name, username, version))
+        await read_frame(reader, version)  # operation 1: status
+        operation, state = await read_frame(reader, version)  # operation 2: token
+        if operation != 2 or state != 0:
+            return False
+        latencies.append(time.perf_counter() - started)
+        return True
+    except (OSError, asyncio.IncompleteReadError):
+        return False
+    finally:
+        writer.close()
+
+async def storm(tcp_port, joins, concurrency, rooms, version):
+    latencies = []
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(index):
+        async with slots:
+            return await join(tcp_port, f'storm-{index % rooms}', f'user-{index}', version, latencies)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(one(index) for index in range(joins)))
+    elapsed = time.perf_counter() - started
+    return {
+        'joins': sum(results),
+        'joins_per_sec': sum(results) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1e3,
+        'p99_ms': percentile(latencies, 99) * 1e3,
+        'failed': joins - sum(results),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['threaded', 'asyncio'])
+    parser.add_argument('--protocol', type=int, default=2, help='protocol version to join with')
+    parser.add_argument('--joins', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=1, help='server worker processes')
+    parser.add_argument('--tcp-port', type=int, default=19010)
+    parser.add_argument('--udp-port', type=int, default=19011)
+    args = parser.parse_args()
+
+    print(f'{"mode":<13} {"joins":>7} {"joins/sec":>10} {"p50 ms":>8} {"p99 ms":>8} {"failed":>7}')
+    for mode in args.modes:
+        server = start_server(mode, args.tcp_port, args.udp_port, args.workers)
+        try:
+            result = asyncio.run(storm(args.tcp_port, args.joins, args.concurrency, args.rooms, args.protocol))
+        finally:
+            stop_server(server)
+        print(f'{mode + "/v" + str(args.protocol):<13} {result["joins"]:>7} {result["joins_per_sec"]:>10.0f} '
+              f'{result["p50_ms"]:>8.2f} {result["p99_ms"]:>8.2f} {result["failed"]:>7}')
+
+if __name__ == '__main__':
+    main()
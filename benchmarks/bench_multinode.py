@@ -0,0 +1,151 @@
+"""
+# Multi-node benchmark
+Start one server.py, then a state_server.py and --nodes server.py nodes
+sharing it, and join --members members to one room, spread over the nodes
+in turn, and with --switch sending to the next node instead of the one
+they joined through. --senders members send timestamped messages at --rate
+messages/sec each and every member listens. For each setup the run reports:
+- delivered share and p50 / p99 latency from send to receipt
+- state server lookups per received datagram, which stays near zero since
+  tokens are validated from each node's cache (chat_backend_lookups_total)
+- messages relayed between nodes (chat_relay_packets_sent_total)
+
+usage:
+    python benchmarks/bench_multinode.py --nodes 2 --members 20 --duration 5 --switch
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+from bench_udp_engine import HOST, join_room, percentile, start_server, stop_server
+from loadgen import scrape_metric
+from wire import PROTOCOL_V2, build_udp_packet, split_udp_messages
+
+ROOM_NAME = 'multinode'
+
+def start_state_server(port):
+    """Start state_server.py and wait until it accepts connections"""
+    state = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(ROOT), 'state_server.py'),
+                              '--host', HOST, '--port', str(port), '--log-level', 'WARNING'])
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=0.5).close()
+            return state
+        except OSError:
+            time.sleep(0.1)
+    state.kill()
+    raise RuntimeError('state server did not start')
+
+def receive(member, token, latencies, done):
+    member.settimeout(0.2)
+    while not done.is_set():
+        try:
+            data = member.recv(65536)
+        except socket.timeout:
+            continue
+        for _, sender, message in split_udp_messages(data, PROTOCOL_V2):
+            if sender.decode() != token:
+                latencies.append(time.perf_counter_ns() - int(message))
+
+def send(member, token, udp_port, rate, duration, counts):
+    interval = 1 / rate
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        member.sendto(build_udp_packet(ROOM_NAME, token, str(time.perf_counter_ns()), PROTOCOL_V2), (HOST, udp_port))
+        counts.append(1)
+        time.sleep(interval)
+
+def run(nodes, args):
+    """Chat through nodes server nodes, 1 runs without a state server
+    Returns:
+        (latencies, messages sent, lookups, relayed)
+    """
+    state = start_state_server(args.base_port) if nodes > 1 else None
+    servers = []
+    try:
+        for node in range(nodes):
+            port = args.base_port + 10 * (node + 1)
+            extra_args = ['--log-level', 'WARNING', '--metrics-port', str(port + 3)]
+            if state is not None:
+                extra_args += ['--state-server', f'{HOST}:{args.base_port}', '--node-id', str(node),
+                               '--relay-address', f'{HOST}:{port + 2}']
+            servers.append(start_server(args.mode, port, port + 1, extra_args=extra_args))
+        members = []
+        for index in range(args.members):
+            port = args.base_port + 10 * (index % nodes + 1)
+            token, _ = join_room(port, ROOM_NAME, f'member-{index}', PROTOCOL_V2)
+            if args.switch:
+                port = args.base_port + 10 * ((index + 1) % nodes + 1)
+            member = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            member.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+            member.bind((HOST, 0))
+            member.sendto(build_udp_packet(ROOM_NAME, token, '', PROTOCOL_V2), (HOST, port + 1))
+            members.append((member, token, port + 1))
+        time.sleep(0.5)
+
+        latencies = []
+        done = threading.Event()
+        receivers = [threading.Thread(target=receive, args=(member, token, latencies, done), daemon=True)
+                     for member, token, _ in members]
+        for receiver in receivers:
+            receiver.start()
+        counts = []
+        senders = [threading.Thread(target=send, args=(member, token, udp_port, args.rate, args.duration, counts))
+                   for member, token, udp_port in members[:args.senders]]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        time.sleep(1.0)
+        done.set()
+        for receiver in receivers:
+            receiver.join()
+        for member, _, _ in members:
+            member.close()
+
+        lookups = relayed = received = 0
+        for node in range(nodes):
+            metrics_port = args.base_port + 10 * (node + 1) + 3
+            lookups += scrape_metric(metrics_port, 1, 'chat_backend_lookups_total')
+            relayed += scrape_metric(metrics_port, 1, 'chat_relay_packets_sent_total')
+            received += scrape_metric(metrics_port, 1, 'chat_udp_packets_received_total')
+        return latencies, len(counts), lookups / max(received, 1), relayed
+    finally:
+        for server in servers:
+            stop_server(server)
+        if state is not None:
+            stop_server(state)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', default='threaded', help='server UDP engine')
+    parser.add_argument('--nodes', type=int, default=2)
+    parser.add_argument('--members', type=int, default=20)
+    parser.add_argument('--senders', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=50.0, help='messages/sec per sender')
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--switch', action='store_true',
+                        help='members send to another node than they joined through')
+    parser.add_argument('--base-port', type=int, default=19400,
+                        help='state server port, node N uses the ports from BASE + 10 * (N + 1)')
+    args = parser.parse_args()
+
+    print(f'{args.members} members in one room, {args.senders} sending {args.rate:g} messages/sec each')
+    print(f'{"nodes":<6} {"delivered":>9} {"p50 ms":>8} {"p99 ms":>8} {"lookups/pkt":>11} {"relayed":>8}')
+    for nodes in (1, args.nodes):
+        latencies, sent, lookups, relayed = run(nodes, args)
+        print(f'{nodes:<6} {len(latencies) / (sent * (args.members - 1)):>9.2%} '
+              f'{percentile(latencies, 50) / 1e6:>8.2f} {percentile(latencies, 99) / 1e6:>8.2f} '
+              f'{lookups:>11.4f} {relayed:>8.0f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+# Multiplexed client benchmark
+Start server.py, create --rooms rooms, then join all of them from one
+process, once as one ChatClient per room and once as one ChatSession. For
+each the run reports:
+- milliseconds per room to join them all concurrently, and to leave them
+- sockets the process opened for it, UDP and TCP, from /proc/self/fd
+- TCP connections opened to the server
+- delivered share and p50 / p99 latency of a message sent to every room
+  by its owner
+
+usage:
+    python benchmarks/bench_multiplex.py --rooms 200 --version 3
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+from bench_udp_engine import HOST, percentile, start_server, stop_server
+from chat_client import ChatClient, ChatSession
+
+def open_sockets():
+    """Sockets open in this process"""
+    count = 0
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            count += os.readlink(f'/proc/self/fd/{fd}').startswith('socket:')
+        except OSError:
+            pass
+    return count
+
+class PerRoomClients:
+    """One ChatClient per room, each with its own socket and a connection per request"""
+
+    def __init__(self, args):
+        self.args = args
+        self.clients = {}
+        self.connections = 0
+
+    async def join(self, room_name):
+        client = ChatClient(HOST, self.args.tcp_port, self.args.udp_port, self.args.version)
+        await client.join(room_name, 'bot')
+        self.clients[room_name] = client
+        self.connections += client.control.connects
+
+    async def leave(self, room_name):
+        client = self.clients.pop(room_name)
+        connects = client.control.connects
+        await client.leave()
+        self.connections += client.control.connects - connects
+
+    async def receive(self, count, timeout):
+        """(arrival ns, message) of up to count messages across every room"""
+        async def one(client):
+            _, _, message = await client.messages.get()
+            return time.perf_counter_ns(), message
+        tasks = [asyncio.ensure_future(one(client)) for client in self.clients.values()]
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        return [task.result() for task in done][:count]
+
+    def tcp_connections(self):
+        return self.connections
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.close()
+
+class Session:
+    """One ChatSession in every room"""
+
+    def __init__(self, args):
+        self.session = ChatSession(HOST, args.tcp_port, args.udp_port, args.version)
+
+    async def join(self, room_name):
+        await self.session.join(room_name, 'bot')
+
+    async def leave(self, room_name):
+        await self.session.leave(room_name)
+
+    async def receive(self, count, timeout):
+        received = []
+        deadline = time.monotonic() + timeout
+        while len(received) < count and time.monotonic() < deadline:
+            try:
+                _, _, message = await asyncio.wait_for(self.session.messages.get(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                break
+            received.append((time.perf_counter_ns(), message))
+        return received
+
+    def tcp_connections(self):
+        return self.session.control.connects
+
+    async def close(self):
+        await self.session.close()
+
+async def measure(setup, owners, room_names, args):
+    sockets = open_sockets()
+    started = time.perf_counter()
+    await asyncio.gather(*(setup.join(room_name) for room_name in room_names))
+    join_ms = (time.perf_counter() - started) * 1000 / len(room_names)
+    opened = open_sockets() - sockets
+    await asyncio.sleep(0.5)
+
+    receiving = asyncio.ensure_future(setup.receive(len(room_names), 5.0 + len(room_names) * args.interval))
+    for room_name in room_names:
+        await owners.send(room_name, str(time.perf_counter_ns()))
+        # Paced, the burst of a message to every room at once is not what is measured
+        await asyncio.sleep(args.interval)
+    received = await receiving
+    latencies = sorted(arrival - int(message) for arrival, message in received)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(setup.leave(room_name) for room_name in room_names))
+    leave_ms = (time.perf_counter() - started) * 1000 / len(room_names)
+    connections = setup.tcp_connections()
+    await setup.close()
+    return (join_ms, leave_ms, opened, connections, len(received) / len(room_names),
+            percentile(latencies, 50) / 1e6 if latencies else 0.0,
+            percentile(latencies, 99) / 1e6 if latencies else 0.0)
+
+async def run(args):
+    room_names = [f'multiplex-{index}' for index in range(args.rooms)]
+    # The owners are a session of their own, so they cost few sockets either
+    owners = ChatSession(HOST, args.tcp_port, args.udp_port, args.version)
+    for room_name in room_names:
+        await owners.join(room_name, 'owner')
+
+    print(f'{args.rooms} rooms, v{args.version}')
+    print(f'{"client":<10} {"join ms/room":>12} {"leave ms/room":>13} {"sockets":>8} {"tcp conns":>9} '
+          f'{"delivered":>10} {"p50 ms":>7} {"p99 ms":>7}')
+    for name, setup in (('per-room', PerRoomClients(args)), ('session', Session(args))):
+        join_ms, leave_ms, sockets, connections, delivered, p50, p99 = await measure(setup, owners, room_names, args)
+        print(f'{name:<10} {join_ms:>12.2f} {leave_ms:>13.2f} {sockets:>8} {connections:>9} '
+              f'{delivered:>10.2%} {p50:>7.2f} {p99:>7.2f}')
+    await owners.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, default=200)
+    parser.add_argument('--version', type=int, default=3)
+    parser.add_argument('--interval', type=float, default=0.001, help='seconds between the owners\' messages')
+    parser.add_argument('--mode', default='threaded', help='server UDP engine')
+    parser.add_argument('--tcp-port', type=int, default=19800)
+    parser.add_argument('--udp-port', type=int, default=19801)
+    args = parser.parse_args()
+
+    server = start_server(args.mode, args.tcp_port, args.udp_port, extra_args=['--log-level', 'WARNING'])
+    try:
+        asyncio.run(run(args))
+    finally:
+        stop_server(server)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+# Overload benchmark
+Start server.py in threaded mode with each --drop-policy in --policies and
+overload it: a sender process floods a busy room at --rate messages/sec
+while another member chats in a quiet room at 20 messages/sec. Both rooms
+have --members members. For each room one member measures, and the run
+reports:
+- delivered share and p50 / p99 latency from send to receipt, per room
+- p99 time datagrams waited in the handler queue (chat_udp_queue_wait_seconds)
+- the server's peak thread count and resident memory, read from /proc
+
+With a bounded queue the latency stays near depth / throughput however hard
+the server is pushed; the fair policy keeps the quiet room's messages
+flowing while the busy room's are dropped.
+
+usage:
+    python benchmarks/bench_overload.py --rate 30000 --policies drop-newest drop-oldest fair
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+from bench_udp_engine import HOST, join_room, percentile, start_server, stop_server
+from loadgen import scrape_metric
+from wire import PROTOCOL_V2, build_udp_packet
+
+def send(tcp_port, udp_port, room_name, rate, duration):
+    """Join room_name and send timestamped messages at rate messages/sec"""
+    token, _ = join_room(tcp_port, room_name, 'sender', PROTOCOL_V2)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.sendto(build_udp_packet(room_name, token, '', PROTOCOL_V2), (HOST, udp_port))
+    time.sleep(0.2)
+    started = time.perf_counter()
+    sent = 0
+    while time.perf_counter() - started < duration:
+        # Catch up with the schedule in bursts, time.sleep is too coarse for high rates
+        due = int((time.perf_counter() - started) * rate)
+        while sent < due:
+            sender.sendto(build_udp_packet(room_name, token, str(time.perf_counter_ns()), PROTOCOL_V2),
+                          (HOST, udp_port))
+            sent += 1
+        time.sleep(0.001)
+
+def open_members(tcp_port, udp_port, room_name, count):
+    """Join count members that register a socket each, the first creates the room"""
+    members = []
+    for index in range(count):
+        token, _ = join_room(tcp_port, room_name, f'member-{index}', PROTOCOL_V2)
+        member = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        member.bind((HOST, 0))
+        member.sendto(build_udp_packet(room_name, token, '', PROTOCOL_V2), (HOST, udp_port))
+        members.append(member)
+    return members
+
+def measure(member, latencies, done):
+    member.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    member.settimeout(0.5)
+    while not done.is_set():
+        try:
+            data = member.recv(4096)
+        except socket.timeout:
+            continue
+        latencies.append(time.perf_counter_ns() - int(data[2 + data[0] + data[1]:]))
+
+def process_status(pid):
+    """(threads, resident MB) of pid"""
+    fields = {}
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            key, _, value = line.partition(':')
+            fields[key] = value.split()
+    return int(fields['Threads'][0]), int(fields['VmRSS'][0]) / 1024
+
+def run(policy, args):
+    server = start_server('threaded', args.tcp_port, args.udp_port, extra_args=[
+        '--log-level', 'WARNING', '--metrics-port', str(args.metrics_port), '--drop-policy', policy,
+        '--queue-depth', str(args.queue_depth)])
+    try:
+        busy = open_members(args.tcp_port, args.udp_port, 'busy', args.members)
+        quiet = open_members(args.tcp_port, args.udp_port, 'quiet', args.members)
+        done = threading.Event()
+        results = {'busy': [], 'quiet': []}
+        measurers = [threading.Thread(target=measure, args=(members[0], results[name], done), daemon=True)
+                     for name, members in (('busy', busy), ('quiet', quiet))]
+        for measurer in measurers:
+            measurer.start()
+        senders = [multiprocessing.Process(target=send, args=(args.tcp_port, args.udp_port, room_name, rate,
+                                                              args.duration))
+                   for room_name, rate in (('busy', args.rate), ('quiet', 20))]
+        for sender in senders:
+            sender.start()
+        peak_threads = peak_rss = 0
+        while any(sender.is_alive() for sender in senders):
+            threads, rss = process_status(server.pid)
+            peak_threads = max(peak_threads, threads)
+            peak_rss = max(peak_rss, rss)
+            time.sleep(0.1)
+        time.sleep(1.0)
+        done.set()
+        for measurer in measurers:
+            measurer.join()
+        queue_wait = scrape_metric(args.metrics_port, 1, 'chat_udp_queue_wait_seconds{quantile="0.99"}')
+        for member in busy + quiet:
+            member.close()
+    finally:
+        stop_server(server)
+    return {
+        'policy': policy,
+        'busy': results['busy'],
+        'quiet': results['quiet'],
+        'queue_wait_ms': queue_wait * 1e3,
+        'threads': peak_threads,
+        'rss_mb': peak_rss,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--policies', nargs='+', default=['drop-newest', 'drop-oldest', 'fair'])
+    parser.add_argument('--rate', type=float, default=30000, help='messages/sec offered to the busy room')
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--members', type=int, default=10, help='members of each room')
+    parser.add_argument('--queue-depth', type=int, default=1024)
+    parser.add_argument('--tcp-port', type=int, default=19090)
+    parser.add_argument('--udp-port', type=int, default=19091)
+    parser.add_argument('--metrics-port', type=int, default=19092)
+    args = parser.parse_args()
+
+    offered = {'busy': args.rate * args.duration, 'quiet': 20 * args.duration}
+    print(f'busy room offered {args.rate:g} messages/sec, quiet room 20/sec, {args.members} members each, '
+          f'queue depth {args.queue_depth}')
+    print(f'{"policy":<12} {"busy recv":>9} {"busy p99":>9} {"quiet recv":>10} {"quiet p50":>9} {"quiet p99":>9} '
+          f'{"queue p99":>9} {"threads":>7} {"rss MB":>7}')
+    for policy in args.policies:
+        result = run(policy, args)
+        print(f'{policy:<12} {len(result["busy"]) / offered["busy"]:>9.1%} '
+              f'{percentile(result["busy"], 99) / 1e6:>7.1f}ms '
+              f'{len(result["quiet"]) / offered["quiet"]:>10.1%} '
+              f'{percentile(result["quiet"], 50) / 1e6:>7.1f}ms {percentile(result["quiet"], 99) / 1e6:>7.1f}ms '
+              f'{result["queue_wait_ms"]:>7.1f}ms {result["threads"]:>7} {result["rss_mb"]:>7.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+# Control channel benchmark
+Start server.py and make --requests rooms over TCP, refresh their owners'
+tokens, list the rooms and leave them again, three ways:
+- connect: a new connection for every request, as clients did before
+  RequestIds, answered with operation 1 and then the response
+- sequential: one control channel, each request waits for the answer of the
+  one before
+- pipelined: one control channel, every request sent at once and matched to
+  its answer by RequestId
+For each the run reports milliseconds per request of every phase and the TCP
+connections opened. --delay-ms sends the traffic through a proxy that holds
+every chunk for that long each way, a network round trip on loopback.
+
+usage:
+    python benchmarks/bench_pipeline.py --requests 200 --delay-ms 5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+from bench_udp_engine import HOST, start_server, stop_server
+from chat_client import ControlConnection
+from wire import TCP_HEADER_SIZE, build_tcp_packet, parse_tcp_header
+
+async def delay_proxy(listen_port, server_port, delay):
+    """Forward connections on listen_port to the server, every chunk held delay seconds"""
+    loop = asyncio.get_running_loop()
+
+    async def pump(reader, writer):
+        while data := await reader.read(65536):
+            # Same delay for every chunk, so they stay in order
+            loop.call_later(delay, writer.write, data)
+        loop.call_later(delay, writer.close)
+
+    async def forward(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection(HOST, server_port)
+        try:
+            await asyncio.gather(pump(client_reader, server_writer), pump(server_reader, client_writer),
+                                 return_exceptions=True)
+        except asyncio.CancelledError:
+            # Still forwarding when the run ends
+            pass
+
+    return await asyncio.start_server(forward, HOST, listen_port)
+
+class Connect:
+    """A connection of its own for every request, RequestId 0"""
+
+    def __init__(self, port, version):
+        self.port = port
+        self.version = version
+        self.connects = 0
+
+    async def request(self, operation, state, room_name, operation_payload):
+        reader, writer = await asyncio.open_connection(HOST, self.port)
+        self.connects += 1
+        try:
+            writer.write(build_tcp_packet(operation, state, room_name, operation_payload, self.version))
+            # 1: status, then the response
+            for _ in range(2):
+                room_name_size, operation, state, size, _ = parse_tcp_header(
+                    await reader.readexactly(TCP_HEADER_SIZE))
+                body = await reader.readexactly(room_name_size + size)
+                if operation == 1 and state == 1:
+                    break
+            return operation, state, body[:room_name_size], body[room_name_size:]
+        finally:
+            writer.close()
+
+class Channel:
+    """One ControlConnection, requests sent one after another or all at once"""
+
+    def __init__(self, port, version):
+        self.control = ControlConnection(HOST, port)
+        self.version = version
+
+    @property
+    def connects(self):
+        return self.control.connects
+
+    async def request(self, operation, state, room_name, operation_payload):
+        return await self.control.request(operation, state, room_name, operation_payload, self.version)
+
+async def run_phase(client, requests, pipelined):
+    """Answers of requests, made one after another or all at once, and the ms per request"""
+    started = time.perf_counter()
+    if pipelined:
+        answers = await asyncio.gather(*(client.request(*request) for request in requests))
+    else:
+        answers = [await client.request(*request) for request in requests]
+    return answers, (time.perf_counter() - started) * 1000 / len(requests)
+
+async def measure(client, name, args):
+    version = args.version
+    room_names = [f'{name}-{index}' for index in range(args.requests)]
+    pipelined = name == 'pipelined'
+    answers, create_ms = await run_phase(client, [(9, version, room_name, 'bench') for room_name in room_names],
+                                         pipelined)
+    tokens = [payload.decode() for operation, _, _, payload in answers if operation == 2]
+    if len(tokens) != len(room_names):
+        raise RuntimeError(f'{name}: {len(room_names) - len(tokens)} creates failed')
+    answers, refresh_ms = await run_phase(client, [(13, version, room_name, token)
+                                                   for room_name, token in zip(room_names, tokens)], pipelined)
+    tokens = [payload.decode() for _, _, _, payload in answers]
+    _, list_ms = await run_phase(client, [(11, version, '', '10')] * args.requests, pipelined)
+    answers, leave_ms = await run_phase(client, [(7, version, room_name, token)
+                                                 for room_name, token in zip(room_names, tokens)], pipelined)
+    if any(operation != 8 for operation, _, _, _ in answers):
+        raise RuntimeError(f'{name}: leaves failed')
+    return create_ms, refresh_ms, list_ms, leave_ms, client.connects
+
+async def run(args):
+    port = args.tcp_port
+    proxy = None
+    if args.delay_ms:
+        proxy = await delay_proxy(args.tcp_port + 10, args.tcp_port, args.delay_ms / 1000)
+        port = args.tcp_port + 10
+    print(f'{args.requests} requests per phase, v{args.version}, {args.delay_ms} ms added each way')
+    print(f'{"client":<11} {"create ms":>10} {"refresh ms":>11} {"list ms":>8} {"leave ms":>9} {"tcp conns":>10}')
+    for name, client in (('connect', Connect(port, args.version)),
+                         ('sequential', Channel(port, args.version)),
+                         ('pipelined', Channel(port, args.version))):
+        create_ms, refresh_ms, list_ms, leave_ms, connects = await measure(client, name, args)
+        print(f'{name:<11} {create_ms:>10.3f} {refresh_ms:>11.3f} {list_ms:>8.3f} {leave_ms:>9.3f} {connects:>10}')
+        if isinstance(client, Channel):
+            client.control.close()
+    if proxy is not None:
+        proxy.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--version', type=int, default=2)
+    parser.add_argument('--delay-ms', type=float, default=0, help='latency added each way by a proxy')
+    parser.add_argument('--mode', default='threaded', help='server UDP engine')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--tcp-port', type=int, default=19900)
+    parser.add_argument('--udp-port', type=int, default=19901)
+    args = parser.parse_args()
+
+    server = start_server(args.mode, args.tcp_port, args.udp_port, args.workers,
+                          extra_args=['--log-level', 'WARNING'])
+    try:
+        asyncio.run(run(args))
+    finally:
+        stop_server(server)
+
+if __name__ == '__main__':
+    main()
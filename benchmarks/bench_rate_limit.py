@@ -0,0 +1,125 @@
+"""
+# Rate limit benchmark
+Start server.py without and then with --member-rate / --room-rate, and have
+one member of a room flood it from another process while --senders members
+chat at --rate messages/sec and every member listens. Reports:
+- flood datagrams sent and what the server dropped by member and room limit
+- delivery of the normal messages: received share and p50 / p99 latency
+- server CPU seconds over the run, read from /proc
+
+usage:
+    python benchmarks/bench_rate_limit.py --room-size 20 --duration 5
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+from bench_udp_engine import HOST, join_room, percentile, start_server, stop_server
+from chat_client import ChatClient, EndpointPool
+from loadgen import scrape_metric, server_cpu_seconds
+from wire import PROTOCOL_V2, build_udp_packet
+
+ROOM_NAME = 'rate-limit'
+
+def flood(tcp_port, udp_port, duration, sent):
+    """Join the room and send as fast as possible for duration seconds"""
+    token, _ = join_room(tcp_port, ROOM_NAME, 'flooder', PROTOCOL_V2)
+    packet = bytes(build_udp_packet(ROOM_NAME, token, 'flood', PROTOCOL_V2))
+    flooder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    deadline = time.perf_counter() + duration
+    count = 0
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            flooder.sendto(packet, (HOST, udp_port))
+        count += 100
+    sent.value = count
+
+async def receive(client, latencies):
+    async for _, _, message in client:
+        if message != 'flood':
+            latencies.append(time.perf_counter_ns() - int(message))
+
+async def send(client, rate, duration, counts):
+    interval = 1 / rate
+    await asyncio.sleep(random.uniform(0, interval))
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        await client.send(str(time.perf_counter_ns()))
+        counts[0] += 1
+        await asyncio.sleep(interval)
+
+async def chat(args, server_pid):
+    endpoints = EndpointPool((HOST, 0))
+    clients = [ChatClient(HOST, args.tcp_port, args.udp_port, PROTOCOL_V2, endpoints) for _ in range(args.room_size)]
+    await clients[0].join(ROOM_NAME, 'user-0')
+    await asyncio.gather(*(client.join(ROOM_NAME, f'user-{index}') for index, client in enumerate(clients) if index))
+    latencies = []
+    receivers = [asyncio.create_task(receive(client, latencies)) for client in clients]
+
+    flood_sent = multiprocessing.Value('q', 0)
+    flooder = multiprocessing.Process(target=flood, args=(args.tcp_port, args.udp_port, args.duration, flood_sent))
+    cpu_before = server_cpu_seconds(server_pid)
+    flooder.start()
+    counts = [0]
+    await asyncio.gather(*(send(client, args.rate, args.duration, counts) for client in clients[:args.senders]))
+    await asyncio.get_running_loop().run_in_executor(None, flooder.join)
+    await asyncio.sleep(1.0)
+    cpu_after = server_cpu_seconds(server_pid)
+    for client in clients:
+        await client.close()
+    await asyncio.gather(*receivers)
+    endpoints.close()
+
+    dropped = {name: scrape_metric(args.metrics_port, 1, name)
+               for name in ('chat_udp_member_rate_limited_total', 'chat_udp_room_rate_limited_total')}
+    return {
+        'flood_sent': flood_sent.value,
+        'member_dropped': dropped['chat_udp_member_rate_limited_total'],
+        'room_dropped': dropped['chat_udp_room_rate_limited_total'],
+        'delivered': len(latencies) / (counts[0] * (args.room_size - 1)),
+        'p50_ms': percentile(latencies, 50) / 1e6,
+        'p99_ms': percentile(latencies, 99) / 1e6,
+        'server_cpu': (cpu_after - cpu_before) if cpu_before is not None else 0.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', default='asyncio', help='server UDP engine')
+    parser.add_argument('--room-size', type=int, default=20)
+    parser.add_argument('--senders', type=int, default=4, help='members chatting normally')
+    parser.add_argument('--rate', type=float, default=5.0, help='messages/sec per normal sender')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds of flooding')
+    parser.add_argument('--member-rate', type=float, default=20)
+    parser.add_argument('--room-rate', type=float, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--tcp-port', type=int, default=19080)
+    parser.add_argument('--udp-port', type=int, default=19081)
+    parser.add_argument('--metrics-port', type=int, default=19082)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    limits = ['--member-rate', str(args.member_rate), '--room-rate', str(args.room_rate)]
+    print(f'{args.room_size} members, {args.senders} chatting at {args.rate:g}/sec, one flooding for {args.duration:g} s')
+    print(f'{"limits":<28} {"flood sent":>10} {"member drop":>11} {"room drop":>9} '
+          f'{"delivered":>9} {"p50 ms":>8} {"p99 ms":>8} {"cpu s":>6}')
+    for label, extra_args in (('none', []), (f'member {args.member_rate:g}/s, room {args.room_rate:g}/s', limits)):
+        server = start_server(args.mode, args.tcp_port, args.udp_port, extra_args=[
+            '--log-level', 'WARNING', '--metrics-port', str(args.metrics_port), *extra_args])
+        try:
+            result = asyncio.run(chat(args, server.pid))
+        finally:
+            stop_server(server)
+        print(f'{label:<28} {result["flood_sent"]:>10} {result["member_dropped"]:>11.0f} {result["room_dropped"]:>9.0f} '
+              f'{result["delivered"]:>9.2%} {result["p50_ms"]:>8.2f} {result["p99_ms"]:>8.2f} {result["server_cpu"]:>6.2f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+# Reliability benchmark
+Start server.py and a lossy UDP proxy in front of it that drops --loss of
+the datagrams the server sends (and --upstream-loss of those it receives).
+For each protocol version one room of --room-size ChatClients chats through
+the proxy, every member sending --count messages, and the run reports:
+- deliveries received out of (room size - 1) per message sent
+- p50 / p99 / p99.9 latency from send to receipt, retransmissions included
+- for v3, messages recovered after a NACK and messages given up on
+
+Messages a sender's datagram lost on the way in were never numbered and
+cannot be recovered by any version, hence --upstream-loss defaults to 0.
+
+usage:
+    python benchmarks/bench_reliability.py --loss 0.05 --protocols 2 3
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+from bench_udp_engine import HOST, percentile, start_server, stop_server
+from chat_client import ChatClient, EndpointPool
+
+class LossyProxy(asyncio.DatagramProtocol):
+    """Relay datagrams between clients and the server, dropping some of them
+    Each client gets its own upstream socket, so the server still sees one
+    address per client.
+    """
+
+    def __init__(self, server_address, loss, upstream_loss):
+        self.server_address = server_address
+        self.loss = loss
+        self.upstream_loss = upstream_loss
+        self.transport = None
+        # {client address: upstream socket}
+        self.upstreams = {}
+        self.relayed = 0
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        upstream = self.upstreams.get(addr)
+        if upstream is None:
+            upstream = self.upstreams[addr] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            upstream.bind((HOST, 0))
+            upstream.setblocking(False)
+            asyncio.get_running_loop().add_reader(upstream.fileno(), self.relay_down, upstream, addr)
+        if random.random() < self.upstream_loss:
+            self.dropped += 1
+            return
+        upstream.sendto(data, self.server_address)
+
+    def relay_down(self, upstream, addr):
+        while True:
+            try:
+                data = upstream.recv(65536)
+            except BlockingIOError:
+                return
+            if random.random() < self.loss:
+                self.dropped += 1
+                continue
+            self.relayed += 1
+            self.transport.sendto(data, addr)
+
+    def close(self):
+        loop = asyncio.get_running_loop()
+        for upstream in self.upstreams.values():
+            loop.remove_reader(upstream.fileno())
+            upstream.close()
+        self.transport.close()
+
+async def receive(client, username, latencies, seen):
+    """Record the latency of every message from another member until the client is closed"""
+    async for _, _, message in client:
+        try:
+            sender, number, sent_ns = message.split(':')
+        except ValueError:
+            continue
+        if sender == username or (username, sender, number) in seen:
+            continue
+        seen.add((username, sender, number))
+        latencies.append(time.perf_counter_ns() - int(sent_ns))
+
+async def send(client, username, count, interval):
+    await asyncio.sleep(random.uniform(0, interval))
+    for number in range(count):
+        await client.send(f'{username}:{number}:{time.perf_counter_ns()}')
+        await asyncio.sleep(interval)
+
+async def run(version, args, proxy_port):
+    endpoints = EndpointPool((HOST, 0))
+    room_name = f'reliability-v{version}'
+    usernames = [f'user-{index}' for index in range(args.room_size)]
+    clients = [ChatClient(HOST, args.tcp_port, proxy_port, version, endpoints) for _ in usernames]
+    # The owner first, it creates the room
+    await clients[0].join(room_name, usernames[0])
+    await asyncio.gather(*(client.join(room_name, username) for client, username in zip(clients[1:], usernames[1:])))
+    await asyncio.sleep(0.5)
+
+    latencies = []
+    seen = set()
+    receivers = [asyncio.create_task(receive(client, username, latencies, seen))
+                 for client, username in zip(clients, usernames)]
+    await asyncio.gather(*(send(client, username, args.count, 1 / args.rate)
+                           for client, username in zip(clients, usernames)))
+    # Time for the last NACKs and retransmissions
+    await asyncio.sleep(args.drain)
+    for client in clients:
+        await client.close()
+    await asyncio.gather(*receivers)
+    endpoints.close()
+
+    expected = args.room_size * args.count * (args.room_size - 1)
+    return {
+        'version': f'v{version}',
+        'received': len(latencies),
+        'expected': expected,
+        'loss': 1 - len(latencies) / expected,
+        'p50_ms': percentile(latencies, 50) / 1e6,
+        'p99_ms': percentile(latencies, 99) / 1e6,
+        'p999_ms': percentile(latencies, 99.9) / 1e6,
+        'recovered': sum(client.recovered for client in clients),
+        'lost': sum(client.lost for client in clients),
+    }
+
+async def run_all(args):
+    loop = asyncio.get_running_loop()
+    _, proxy = await loop.create_datagram_endpoint(
+        lambda: LossyProxy((HOST, args.udp_port), args.loss, args.upstream_loss), local_addr=(HOST, args.proxy_port))
+    try:
+        return [await run(version, args, args.proxy_port) for version in args.protocols], proxy
+    finally:
+        proxy.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--protocols', nargs='+', type=int, default=[2, 3], help='protocol versions to run')
+    parser.add_argument('--mode', default='asyncio', help='server UDP engine')
+    parser.add_argument('--loss', type=float, default=0.05, help='share of server to client datagrams dropped')
+    parser.add_argument('--upstream-loss', type=float, default=0.0, help='share of client to server datagrams dropped')
+    parser.add_argument('--room-size', type=int, default=10)
+    parser.add_argument('--count', type=int, default=100, help='messages each member sends')
+    parser.add_argument('--rate', type=float, default=20.0, help='messages/sec per member')
+    parser.add_argument('--drain', type=float, default=2.0, help='seconds to wait for retransmissions after sending')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--tcp-port', type=int, default=19050)
+    parser.add_argument('--udp-port', type=int, default=19051)
+    parser.add_argument('--proxy-port', type=int, default=19052)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    server = start_server(args.mode, args.tcp_port, args.udp_port, extra_args=['--log-level', 'WARNING'])
+    try:
+        results, proxy = asyncio.run(run_all(args))
+    finally:
+        stop_server(server)
+
+    print(f'{args.room_size} members x {args.count} messages, {args.loss:.1%} downstream '
+          f'and {args.upstream_loss:.1%} upstream loss, {proxy.dropped} datagrams dropped')
+    print(f'{"version":<8} {"received":>15} {"loss":>7} {"p50 ms":>8} {"p99 ms":>8} {"p99.9 ms":>9} '
+          f'{"recovered":>10} {"lost":>6}')
+    for result in results:
+        print(f'{result["version"]:<8} {result["received"]:>7}/{result["expected"]:<7} {result["loss"]:>7.2%} '
+              f'{result["p50_ms"]:>8.2f} {result["p99_ms"]:>8.2f} {result["p999_ms"]:>9.2f} '
+              f'{result["recovered"]:>10} {result["lost"]:>6}')
+
+if __name__ == '__main__':
+    main()
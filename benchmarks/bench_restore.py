@@ -0,0 +1,88 @@
+"""
+# Registry restore benchmark
+Fill a RoomRegistry with --members members in --rooms rooms, every member
+with an address, snapshot it with snapshot.write_snapshot() and log
+--changes joins and leaves after it. Then restore it into a new registry
+the way server.py --state-dir does at startup and report:
+- snapshot size and the time to write it
+- startup: reading the snapshot's room table and replaying the change log,
+  the time before the server serves again
+- the first use of one room, which builds it from its records
+- building every other room, which the server does in the background
+
+usage:
+    python benchmarks/bench_restore.py --members 1000000 --rooms 10000
+"""
+import argparse
+import os
+import secrets
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snapshot
+from room_registry import RoomRegistry
+
+def fill(registry, members, rooms):
+    room_names = [f'room-{index}' for index in range(rooms)]
+    for index in range(members):
+        room_name = room_names[index % rooms]
+        address = ('10.0.%d.%d' % (index >> 16 & 255, index >> 8 & 255), 1024 + index % 60000)
+        token = secrets.token_hex(16)
+        if index < rooms:
+            registry.create_room(room_name, token, address, 2)
+        else:
+            registry.join(room_name, token, address, 2)
+    return room_names
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, default=1000000)
+    parser.add_argument('--rooms', type=int, default=10000)
+    parser.add_argument('--changes', type=int, default=10000, help='joins and leaves logged after the snapshot')
+    args = parser.parse_args()
+
+    registry = RoomRegistry()
+    started = time.perf_counter()
+    room_names = fill(registry, args.members, args.rooms)
+    print(f'{args.members} members in {args.rooms} rooms filled in {time.perf_counter() - started:.1f} s')
+
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        snapshot.write_snapshot(directory, 1, registry.snapshot_rooms())
+        written = time.perf_counter() - started
+        size = os.path.getsize(snapshot.snapshot_path(directory))
+        registry.swap_changes(snapshot.ChangeLog(directory, 1))
+        for index in range(args.changes // 2):
+            room_name = room_names[index % args.rooms]
+            member = registry.join(room_name, secrets.token_hex(16), None, 2)
+            registry.leave(room_name, member.token)
+        registry.changes.close()
+        print(f'snapshot: {size / 1e6:.1f} MB written in {written * 1e3:.0f} ms')
+
+        restored = RoomRegistry()
+        started = time.perf_counter()
+        generation, saved_at, rooms, records = snapshot.read_snapshot(directory)
+        restored.restore(rooms, records, time.time() - saved_at)
+        for change in snapshot.read_changes(directory, generation):
+            restored.apply_change(*change)
+        startup = time.perf_counter() - started
+        print(f'startup: room table and {args.changes} changes in {startup * 1e3:.1f} ms, '
+              f'{len(restored)} rooms and {restored.member_count()} members')
+
+        room_name = room_names[-1]
+        started = time.perf_counter()
+        restored.validate(room_name, restored.owner(room_name))
+        print(f'first use of a room of {len(restored.members(room_name))} members: '
+              f'{(time.perf_counter() - started) * 1e3:.2f} ms')
+
+        started = time.perf_counter()
+        while restored.restore_some(64):
+            pass
+        print(f'every room built in {time.perf_counter() - started:.2f} s, '
+              f'{restored.member_count()} members match: {restored.member_count() == registry.member_count()}')
+
+if __name__ == '__main__':
+    main()
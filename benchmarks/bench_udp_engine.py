@@ -0,0 +1,178 @@
+"""
+# UDP engine benchmark
+Start server.py in each --mode, join one room with an owner and a joiner,
+send chat messages from the joiner and measure on the owner side:
+- messages/sec delivered through the server
+- p50 / p99 latency from send to delivery
+- loss
+
+usage:
+    python benchmarks/bench_udp_engine.py --count 20000 --window 64
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from wire import (PACKET_SIZE, PROTOCOL_V1, TCP_HEADER_SIZE, build_tcp_packet, build_udp_packet, parse_tcp_header,
+                  split_udp_messages)
+
+HOST = '127.0.0.1'
+
+def start_server(mode, tcp_port, udp_port, workers=1, extra_args=()):
+    """Start server.py as a subprocess and wait until it accepts TCP connections"""
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'server.py'), '--mode', mode, '--workers', str(workers),
+         '--host', HOST, '--tcp-port', str(tcp_port), '--udp-port', str(udp_port), *extra_args],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection((HOST, tcp_port), timeout=0.5).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f'server in {mode} mode did not start')
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+def recv_exact(conn, size):
+    """Receive exactly size bytes from a TCP connection"""
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Server closed the connection')
+        data += chunk
+    return bytes(data)
+
+def recv_tcp_packet(conn, version=PROTOCOL_V1):
+    """Receive one TCP packet using the sizes in its header
+    Returns:
+        (operation, state, room_name, operation_payload)
+    """
+    room_name_size, operation, state, operation_payload_size, _ = parse_tcp_header(recv_exact(conn, TCP_HEADER_SIZE))
+    body = recv_exact(conn, room_name_size + operation_payload_size)
+    # Drain the zero padding of a v1 packet
+    padding = PACKET_SIZE - TCP_HEADER_SIZE - len(body)
+    if version == PROTOCOL_V1 and padding > 0:
+        recv_exact(conn, padding)
+    return operation, state, body[:room_name_size], body[room_name_size:]
+
+def join_room(tcp_port, room_name, username, version):
+    """Join or create a room over TCP and return (token, tcp source port)"""
+    conn = socket.create_connection((HOST, tcp_port))
+    try:
+        conn.sendall(build_tcp_packet(0, version, room_name, username, version))
+        recv_tcp_packet(conn, version)  # operation 1: status
+        _, _, _, token = recv_tcp_packet(conn, version)  # operation 2: token
+        return token.decode(), conn.getsockname()[1]
+    finally:
+        conn.close()
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * pct / 100))
+    return values[index]
+
+def run(mode, version, count, window, tcp_port, udp_port, workers=1):
+    server = start_server(mode, tcp_port, udp_port, workers)
+    try:
+        room_name = f'bench-{mode}'
+        owner_token, _ = join_room(tcp_port, room_name, 'owner', version)
+        joiner_token, _ = join_room(tcp_port, room_name, 'joiner', version)
+
+        # The server delivers to the address the owner's first datagram came from
+        owner = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        owner.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        owner.bind(('', 0))
+        owner.settimeout(1.0)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        owner.sendto(build_udp_packet(room_name, owner_token, '', version), (HOST, udp_port))
+        sender.sendto(build_udp_packet(room_name, joiner_token, '', version), (HOST, udp_port))
+        time.sleep(0.2)
+
+        latencies = []
+        last_received = [time.perf_counter()]
+        in_flight = threading.Semaphore(window)
+        done = threading.Event()
+
+        def receive():
+            while not done.is_set():
+                try:
+                    data = owner.recv(4096)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                # v3 registration ACKs carry no message, batches several
+                for _, _, message in split_udp_messages(data, version):
+                    latencies.append(time.perf_counter_ns() - int(message.decode()))
+                    in_flight.release()
+                last_received[0] = time.perf_counter()
+                if len(latencies) >= count:
+                    done.set()
+
+        receiver = threading.Thread(target=receive, daemon=True)
+        receiver.start()
+
+        started = time.perf_counter()
+        for _ in range(count):
+            # Stop sending once the window stays full: the rest is lost
+            if not in_flight.acquire(timeout=1.0):
+                break
+            message = str(time.perf_counter_ns())
+            sender.sendto(build_udp_packet(room_name, joiner_token, message, version), (HOST, udp_port))
+        done.wait(timeout=2.0)
+        done.set()
+        # Waiting for messages that never arrive is not throughput
+        elapsed = last_received[0] - started
+        owner.close()
+        sender.close()
+
+        received = len(latencies)
+        return {
+            'mode': f'{mode}/v{version}',
+            'received': received,
+            'msgs_per_sec': received / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 50) / 1e6,
+            'p99_ms': percentile(latencies, 99) / 1e6,
+            'loss': 1 - received / count,
+        }
+    finally:
+        stop_server(server)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['threaded', 'asyncio'])
+    parser.add_argument('--protocols', nargs='+', type=int, default=[2], help='protocol versions to run')
+    parser.add_argument('--count', type=int, default=20000, help='messages to send per mode')
+    parser.add_argument('--window', type=int, default=64, help='maximum messages in flight')
+    parser.add_argument('--workers', type=int, default=1, help='server worker processes')
+    parser.add_argument('--tcp-port', type=int, default=19000)
+    parser.add_argument('--udp-port', type=int, default=19001)
+    args = parser.parse_args()
+
+    print(f'{"mode":<13} {"received":>9} {"msgs/sec":>10} {"p50 ms":>8} {"p99 ms":>8} {"loss":>7}')
+    for mode in args.modes:
+        for version in args.protocols:
+            result = run(mode, version, args.count, args.window, args.tcp_port, args.udp_port, args.workers)
+            print(f'{result["mode"]:<13} {result["received"]:>9} {result["msgs_per_sec"]:>10.0f} '
+                  f'{result["p50_ms"]:>8.3f} {result["p99_ms"]:>8.3f} {result["loss"]:>7.2%}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+# Wire codec benchmark
+Nanoseconds per call of the wire.py encoders and decoders for a chat
+message of --message-size bytes, per protocol version:
+- build: a new frame for every call
+- pack_into: the frame written into a buffer reused across calls
+- cached: the prebuilt status, error and ACK frames
+- parse: the header and body of a received frame
+
+usage:
+    python benchmarks/bench_wire.py --message-size 100 --number 200000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+
+from wire import (BATCH_FRAME, FLAG_ACK, FLAG_BATCH, FLAG_RETRANSMIT, PACKET_SIZE, PROTOCOL_V3, SUPPORTED_VERSIONS,
+                  build_ack_packet, build_error_packet, build_tcp_packet, build_udp_packet, error_packet,
+                  pack_history, pack_tcp_packet_into, pack_udp_packet_into, parse_tcp_header, parse_udp_packet,
+                  parse_v3_header, split_batch, split_history, split_udp_packet, success_packet)
+
+ROOM_NAME = 'benchmark-room'
+TOKEN = 'f' * 32
+USERNAME = 'benchmark-user'
+
+def cases(version, message):
+    """(name, callable) of every operation timed for version"""
+    room_name = ROOM_NAME.encode()
+    token = TOKEN.encode()
+    buffer = bytearray(PACKET_SIZE + len(message))
+    udp_packet = bytes(build_udp_packet(ROOM_NAME, TOKEN, message, version, FLAG_RETRANSMIT, 42))
+    tcp_packet = bytes(build_tcp_packet(0, version, ROOM_NAME, USERNAME, version))
+    view = memoryview(udp_packet)
+    _, _, message_start = parse_udp_packet(view)
+    result = [
+        ('build udp', lambda: build_udp_packet(ROOM_NAME, TOKEN, message, version, FLAG_RETRANSMIT, 42)),
+        ('pack_into udp', lambda: pack_udp_packet_into(buffer, 0, room_name, token, message, version,
+                                                       FLAG_RETRANSMIT, 42)),
+        ('parse udp', lambda: parse_udp_packet(memoryview(udp_packet))),
+        ('split udp', lambda: split_udp_packet(udp_packet, version)),
+        ('build tcp', lambda: build_tcp_packet(0, version, ROOM_NAME, USERNAME, version)),
+        ('pack_into tcp', lambda: pack_tcp_packet_into(buffer, 0, 0, version, room_name, token, version)),
+        ('parse tcp header', lambda: parse_tcp_header(tcp_packet)),
+        ('build error', lambda: build_error_packet('Invalid room or token', version)),
+        ('cached error', lambda: error_packet('Invalid room or token', version)),
+        ('build success', lambda: build_tcp_packet(1, 0, ROOM_NAME, 'Success', version)),
+        ('cached success', lambda: success_packet(ROOM_NAME, version)),
+    ]
+    if version == PROTOCOL_V3:
+        records = [(seq, udp_packet) for seq in range(20)]
+        history = pack_history(records)
+        batch = b''.join([bytes(build_udp_packet(ROOM_NAME, '', '', version, FLAG_BATCH)),
+                          *(BATCH_FRAME.pack(len(udp_packet)) + udp_packet for _ in range(8))])
+        result += [
+            ('parse v3 header', lambda: parse_v3_header(view, message_start)),
+            ('build ack', lambda: build_udp_packet(ROOM_NAME, '', '', version, FLAG_ACK, 42)),
+            ('cached ack', lambda: build_ack_packet(ROOM_NAME, 42)),
+            ('split batch of 8', lambda: split_batch(batch)),
+            ('pack history of 20', lambda: pack_history(records)),
+            ('split history of 20', lambda: split_history(history)),
+        ]
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--message-size', type=int, default=100)
+    parser.add_argument('--number', type=int, default=200000, help='calls per measurement')
+    parser.add_argument('--repeat', type=int, default=5, help='measurements, the fastest is reported')
+    parser.add_argument('--protocols', type=int, nargs='+', default=list(SUPPORTED_VERSIONS))
+    args = parser.parse_args()
+
+    message = b'm' * args.message_size
+    names = [name for name, _ in cases(PROTOCOL_V3, message)]
+    timings = {}
+    for version in args.protocols:
+        for name, call in cases(version, message):
+            best = min(timeit.repeat(call, number=args.number, repeat=args.repeat))
+            timings[name, version] = best / args.number * 1e9
+
+    print(f'{args.message_size} byte messages, ns/op, fastest of {args.repeat} x {args.number} calls')
+    print(f'{"operation":<20}' + ''.join(f'{"v" + str(version):>9}' for version in args.protocols))
+    for name in names:
+        print(f'{name:<20}' + ''.join(f'{timings[name, version]:>9.0f}' if (name, version) in timings
+                                      else f'{"-":>9}' for version in args.protocols))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+# Wire codec fuzzer
+Round-trip --iterations random frames through the wire.py encoders and
+decoders, seeded so a failure replays with the same --seed:
+- UDP frames of every version, random room names, tokens, Flags, Seq and
+  messages, zero bytes and v1 frames filled to the last byte included;
+  build_udp_packet() and pack_udp_packet_into() at a random offset must
+  write the same bytes and parse back to what went in
+- TCP frames of every version, header sizes up to 2^29 - 1 and RequestIds
+  included
+- v3 batches, NACK ranges, operation 4 history and operation 12 room list
+  payloads
+- random garbage through the parsers, only ValueError, IndexError and
+  struct.error may come out of them
+The first mismatch is printed with its iteration and the run exits 1.
+
+usage:
+    python benchmarks/fuzz_wire.py --iterations 100000 --seed 1
+"""
+import argparse
+import os
+import random
+import struct
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+
+from wire import (BATCH_FRAME, FLAG_ACK, FLAG_BATCH, MAX_PAYLOAD_SIZE, MAX_REQUEST_ID, PACKET_SIZE, PROTOCOL_V1,
+                  PROTOCOL_V3, SUPPORTED_VERSIONS, TCP_HEADER, TCP_HEADER_SIZE, build_ack_packet, build_error_packet,
+                  build_tcp_packet, build_udp_packet, error_packet, pack_history, pack_nack, pack_room_list,
+                  pack_tcp_packet_into, pack_udp_packet_into, parse_tcp_header, parse_udp_packet, parse_v3_header,
+                  split_batch, split_history, split_nack, split_room_list, split_udp_packet, success_packet,
+                  tcp_packet_size, udp_packet_size, with_request_id)
+
+class Mismatch(Exception):
+    pass
+
+def check(condition, what, *values):
+    if not condition:
+        raise Mismatch(f'{what}: {values!r}')
+
+def random_bytes(rng, size):
+    return rng.randbytes(size)
+
+def random_text(rng, size):
+    """Up to size bytes of UTF-8, multi-byte characters included"""
+    text = b''
+    while True:
+        character = rng.choice('abcxyz0123-_ éあ').encode()
+        if len(text) + len(character) > size:
+            return text
+        text += character
+
+def random_message(rng, room_name, token, version):
+    """A message that fits one frame, v1 ones up to the last byte of PACKET_SIZE"""
+    if version == PROTOCOL_V1:
+        room_left = PACKET_SIZE - 2 - len(room_name) - len(token)
+        size = rng.choice((0, 1, room_left - 1, room_left, rng.randrange(room_left + 1)))
+        # A v1 message's trailing zeros cannot be told from padding
+        return random_bytes(rng, size).rstrip(b'\x00')
+    return random_bytes(rng, rng.choice((0, 1, rng.randrange(200), rng.randrange(8000))))
+
+def fuzz_udp(rng):
+    version = rng.choice(SUPPORTED_VERSIONS)
+    room_name = random_text(rng, rng.randrange(256))
+    token = random_text(rng, rng.choice((0, 32, rng.randrange(256))))
+    message = random_message(rng, room_name, token, version)
+    flags = rng.getrandbits(8)
+    seq = rng.getrandbits(64)
+
+    packet = build_udp_packet(room_name, token, message, version, flags, seq)
+    size = udp_packet_size(len(room_name), len(token), len(message), version)
+    check(len(packet) == size, 'udp size', version, len(packet), size)
+    offset = rng.randrange(64)
+    buffer = bytearray(random_bytes(rng, offset + size + rng.randrange(64)))
+    written = pack_udp_packet_into(buffer, offset, room_name, token, message, version, flags, seq)
+    check(written == size and buffer[offset:offset + size] == packet, 'pack_udp_packet_into', version, offset)
+
+    check(split_udp_packet(bytes(packet), version) == (room_name, token, message), 'split_udp_packet', version)
+    parsed_room, parsed_token, message_start = parse_udp_packet(memoryview(packet))
+    check((parsed_room.encode(), parsed_token.encode()) == (room_name, token), 'parse_udp_packet', version)
+    if version == PROTOCOL_V3:
+        check(parse_v3_header(memoryview(packet), message_start) == (flags, seq), 'parse_v3_header', flags, seq)
+        ack = build_ack_packet(room_name.decode(), seq)
+        check(ack == build_udp_packet(room_name, b'', b'', PROTOCOL_V3, FLAG_ACK, seq), 'build_ack_packet', seq)
+
+def fuzz_tcp(rng):
+    version = rng.choice(SUPPORTED_VERSIONS)
+    room_name = random_text(rng, rng.randrange(256))
+    payload = random_bytes(rng, rng.choice((0, 1, PACKET_SIZE - TCP_HEADER_SIZE - len(room_name),
+                                            rng.randrange(200), rng.randrange(10000))))
+    operation = rng.getrandbits(8)
+    state = rng.getrandbits(8)
+    request_id = rng.choice((0, 1, MAX_REQUEST_ID, rng.getrandbits(32)))
+
+    packet = build_tcp_packet(operation, state, room_name, payload, version, request_id)
+    size = tcp_packet_size(len(room_name), len(payload), version)
+    check(len(packet) == size, 'tcp size', version, len(packet), size)
+    check(parse_tcp_header(packet[:TCP_HEADER_SIZE]) == (len(room_name), operation, state, len(payload), request_id),
+          'parse_tcp_header', version)
+    untagged = build_tcp_packet(operation, state, room_name, payload, version)
+    check(with_request_id(untagged, request_id) == packet, 'with_request_id', request_id)
+    body = packet[TCP_HEADER_SIZE:]
+    check(body[:len(room_name)] == room_name and body[len(room_name):len(room_name) + len(payload)] == payload,
+          'tcp body', version)
+    check(not any(body[len(room_name) + len(payload):]), 'tcp padding', version)
+    offset = rng.randrange(64)
+    buffer = bytearray(random_bytes(rng, offset + size))
+    written = pack_tcp_packet_into(buffer, offset, operation, state, room_name, payload, version, request_id)
+    check(written == size and buffer[offset:offset + size] == packet, 'pack_tcp_packet_into', version, offset)
+
+    # Header sizes the body of no test frame reaches
+    payload_size = rng.choice((MAX_PAYLOAD_SIZE, rng.randrange(MAX_PAYLOAD_SIZE), 2**64 - 1))
+    header = TCP_HEADER.pack(len(room_name), operation, state, request_id, payload_size)
+    check(parse_tcp_header(header) == (len(room_name), operation, state, payload_size, request_id),
+          'header size', payload_size)
+    wide = bytes(3) + request_id.to_bytes(4, 'big') + (2**130 + 5).to_bytes(25, 'big')
+    check(parse_tcp_header(wide)[3:] == (2**130 + 5, request_id), 'wide header size')
+
+    message = random_text(rng, rng.randrange(100)).decode(errors='ignore')
+    check(error_packet(message, version) == bytes(build_error_packet(message, version)), 'error_packet', message)
+    name = room_name.decode(errors='ignore')
+    check(success_packet(name, version) == bytes(build_tcp_packet(1, 0, name, 'Success', version)), 'success_packet')
+
+def fuzz_v3_payloads(rng):
+    room_name = random_text(rng, rng.randrange(256))
+    packets = [bytes(build_udp_packet(room_name, random_text(rng, 32), random_bytes(rng, rng.randrange(300)),
+                                      PROTOCOL_V3, 0, rng.getrandbits(64)))
+               for _ in range(rng.randrange(1, 10))]
+    batch = b''.join([bytes(build_udp_packet(room_name, b'', b'', PROTOCOL_V3, FLAG_BATCH)),
+                      *(BATCH_FRAME.pack(len(packet)) + packet for packet in packets)])
+    check(split_batch(batch) == packets, 'split_batch', len(packets))
+
+    ranges = [(rng.getrandbits(64), rng.getrandbits(16)) for _ in range(rng.randrange(10))]
+    nack = pack_nack(ranges)
+    check(split_nack(nack) == ranges, 'split_nack', ranges)
+    check(split_nack(nack + random_bytes(rng, rng.randrange(10))) == ranges, 'split_nack cut short', ranges)
+
+    records = [(rng.getrandbits(64), packet) for packet in packets]
+    check(split_history(pack_history(records)) == records, 'split_history', len(records))
+
+    rooms = [(random_text(rng, rng.randrange(256)).decode(), rng.getrandbits(32)) for _ in range(rng.randrange(10))]
+    room_list = pack_room_list(rooms)
+    check(split_room_list(room_list) == rooms, 'split_room_list', rooms)
+    cut = split_room_list(room_list[:rng.randrange(len(room_list) + 1)])
+    check(cut == rooms[:len(cut)], 'split_room_list cut short', rooms)
+
+def fuzz_garbage(rng):
+    data = random_bytes(rng, rng.randrange(600))
+    version = rng.choice(SUPPORTED_VERSIONS)
+    for parse in (lambda: split_udp_packet(data, version), lambda: parse_tcp_header(data),
+                  lambda: parse_v3_header(memoryview(data), rng.randrange(len(data) + 1)),
+                  lambda: split_batch(data), lambda: split_nack(data), lambda: split_history(data),
+                  lambda: split_room_list(data)):
+        try:
+            parse()
+        except (ValueError, IndexError, struct.error):
+            pass
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    fuzzers = (fuzz_udp, fuzz_tcp, fuzz_v3_payloads, fuzz_garbage)
+    for iteration in range(args.iterations):
+        rng = random.Random(f'{args.seed}-{iteration}')
+        fuzzer = fuzzers[iteration % len(fuzzers)]
+        try:
+            fuzzer(rng)
+        except Exception as e:
+            print(f'iteration {iteration} ({fuzzer.__name__}, --seed {args.seed}) failed: {e!r}')
+            sys.exit(1)
+    print(f'{args.iterations} iterations, seed {args.seed}: every frame round-tripped')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""
+# Load generator
+Simulate headless clients with chat_client.ChatClient. Each client joins
+its room over TCP, registers for its messages on a UDP socket shared with
+clients of other rooms and sends chat messages at --rate messages/sec. Messages carry their send time and every
+member but the sender should receive each one, so a run reports:
+- join latency p50 / p99 and failed joins
+- delivery latency p50 / p99 / p99.9 from send to receipt
+- loss: deliveries missing out of (room size - 1) per message sent
+- server CPU seconds and utilisation, read from /proc
+
+Scenarios (--scenario), options given on the command line override them:
+- small-rooms: 500 rooms of 4 clients, every client sending
+- huge-room: one room of 2000 clients, 20 of them sending
+- join-storm: 20000 clients joining 200 rooms as fast as possible, no chat
+- idle-expiry: 5000 clients that register and go quiet, timed until the
+  server has expired every one of them (chat_members on the metrics endpoint)
+
+The clients run on one event loop in this process, on a small machine
+they compete with the server for CPU.
+
+usage:
+    python benchmarks/loadgen.py --scenario small-rooms --duration 10
+    python benchmarks/loadgen.py --scenario huge-room --mode asyncio --workers 2
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+from bench_udp_engine import HOST, percentile, start_server, stop_server
+from chat_client import ChatClient, EndpointPool, JoinError
+
+SCENARIOS = {
+    'small-rooms': {'rooms': 500, 'room_size': 4, 'senders': 4, 'rate': 1.0, 'duration': 10},
+    'huge-room': {'rooms': 1, 'room_size': 2000, 'senders': 20, 'rate': 5.0, 'duration': 10},
+    'join-storm': {'rooms': 200, 'room_size': 100, 'senders': 0, 'rate': 0.0, 'duration': 0},
+    'idle-expiry': {'rooms': 100, 'room_size': 50, 'senders': 0, 'rate': 0.0, 'duration': 0},
+}
+# Server settings of the idle-expiry scenario
+IDLE_THRESHOLD = 5
+IDLE_GRANULARITY = 0.5
+
+class Stats:
+    def __init__(self):
+        self.join_latencies = []
+        self.join_failures = 0
+        self.delivery_latencies = []
+        self.sent = 0
+        self.expected = 0
+        self.received = 0
+        # Datagrams that are not chat messages, e.g. error packets
+        self.errors = 0
+
+class LoadClient:
+    """A ChatClient and where it belongs in the scenario"""
+
+    def __init__(self, room_name, username, index, client):
+        self.room_name = room_name
+        self.username = username
+        # Position in the room, 0 is the owner
+        self.index = index
+        self.client = client
+        self.joined = False
+
+    async def join(self, stats):
+        started = time.perf_counter()
+        try:
+            await self.client.join(self.room_name, self.username)
+        except (OSError, asyncio.IncompleteReadError, JoinError):
+            stats.join_failures += 1
+            return
+        self.joined = True
+        stats.join_latencies.append(time.perf_counter() - started)
+
+    async def receive(self, stats):
+        """Record the delivery latency of every message until the client is closed"""
+        async for _, _, message in self.client:
+            try:
+                sent_ns = int(message)
+            except ValueError:
+                stats.errors += 1
+                continue
+            stats.received += 1
+            stats.delivery_latencies.append(time.perf_counter_ns() - sent_ns)
+
+async def send_messages(client, rate, duration, room_size, stats):
+    """Send rate messages/sec for duration seconds, starting at a random offset"""
+    interval = 1 / rate
+    await asyncio.sleep(random.uniform(0, interval))
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        await client.client.send(str(time.perf_counter_ns()))
+        stats.sent += 1
+        stats.expected += room_size - 1
+        await asyncio.sleep(interval)
+
+def server_cpu_seconds(pid):
+    """User + system CPU of pid and its child processes (the workers), None off Linux"""
+    try:
+        with open(f'/proc/{pid}/stat') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/task/{pid}/children') as children:
+            child_pids = [int(child) for child in children.read().split()]
+    except OSError:
+        return None
+    # utime and stime are fields 14 and 15, counted after the ')' that ends field 2
+    seconds = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    for child_pid in child_pids:
+        seconds += server_cpu_seconds(child_pid) or 0
+    return seconds
+
+def scrape_metric(metrics_port, workers, name):
+    """Sum of a metric over the workers' endpoints"""
+    total = 0
+    for port in range(metrics_port, metrics_port + workers):
+        with urllib.request.urlopen(f'http://{HOST}:{port}/metrics', timeout=2) as response:
+            for line in response.read().decode().splitlines():
+                if line.startswith(name + ' '):
+                    total += float(line.split()[1])
+    return total
+
+async def join_all(clients, concurrency, stats):
+    """Join every client, owners first so they create their rooms"""
+    slots = asyncio.Semaphore(concurrency)
+
+    async def join(client):
+        async with slots:
+            await client.join(stats)
+
+    owners = [client for client in clients if client.index == 0]
+    joiners = [client for client in clients if client.index != 0]
+    started = time.perf_counter()
+    await asyncio.gather(*(join(client) for client in owners))
+    await asyncio.gather(*(join(client) for client in joiners))
+    return time.perf_counter() - started
+
+async def run_scenario(name, settings, args, server_pid):
+    stats = Stats()
+    endpoints = EndpointPool((HOST, 0))
+    clients = [LoadClient(f'{name}-{room}', f'user-{room}-{index}', index,
+                          ChatClient(HOST, args.tcp_port, args.udp_port, args.protocol, endpoints))
+               for room in range(settings['rooms']) for index in range(settings['room_size'])]
+    report = {'clients': len(clients)}
+
+    # Joining registers each client's UDP address too
+    join_time = await join_all(clients, args.concurrency, stats)
+    registered = time.perf_counter()
+    report['joins_per_sec'] = len(stats.join_latencies) / join_time
+    report['sockets'] = len(endpoints.endpoints)
+    joined = [client for client in clients if client.joined]
+    if name == 'join-storm':
+        endpoints.close()
+        return stats, report
+    receivers = [asyncio.create_task(client.receive(stats)) for client in joined]
+    # Let the server bind every address before the first message
+    await asyncio.sleep(1.0)
+
+    cpu_started = server_cpu_seconds(server_pid)
+    started = time.perf_counter()
+    if name == 'idle-expiry':
+        # Every client goes quiet now, wait for the server to expire them all
+        loop = asyncio.get_running_loop()
+        while await loop.run_in_executor(None, scrape_metric, args.metrics_port, args.workers, 'chat_members') > 0:
+            if time.perf_counter() - started > IDLE_THRESHOLD * 10:
+                break
+            await asyncio.sleep(IDLE_GRANULARITY / 2)
+        report['expired_after'] = time.perf_counter() - registered
+    else:
+        senders = [client for client in joined if client.index < settings['senders']]
+        await asyncio.gather(*(send_messages(client, settings['rate'], settings['duration'],
+                                             settings['room_size'], stats) for client in senders))
+        # Deliveries still in flight
+        await asyncio.sleep(1.0)
+    elapsed = time.perf_counter() - started
+    cpu_finished = server_cpu_seconds(server_pid)
+    if cpu_started is not None and cpu_finished is not None:
+        report['server_cpu'] = cpu_finished - cpu_started
+        report['server_cpu_share'] = (cpu_finished - cpu_started) / elapsed
+    for client in joined:
+        await client.client.close()
+    await asyncio.gather(*receivers)
+    endpoints.close()
+    return stats, report
+
+def print_report(name, settings, stats, report):
+    print(f'scenario {name}: {report["clients"]} clients in {settings["rooms"]} rooms of {settings["room_size"]}, '
+          f'sharing {report["sockets"]} UDP sockets')
+    print(f'  joins:     {len(stats.join_latencies)} ok, {stats.join_failures} failed, '
+          f'{report["joins_per_sec"]:.0f} joins/sec, '
+          f'p50 {percentile(stats.join_latencies, 50) * 1e3:.2f} ms, '
+          f'p99 {percentile(stats.join_latencies, 99) * 1e3:.2f} ms')
+    if stats.sent:
+        latencies = stats.delivery_latencies
+        print(f'  messages:  {stats.sent} sent, {stats.received} of {stats.expected} deliveries received, '
+              f'loss {1 - stats.received / stats.expected:.2%}, {stats.errors} errors')
+        print(f'  delivery:  p50 {percentile(latencies, 50) / 1e6:.2f} ms, '
+              f'p99 {percentile(latencies, 99) / 1e6:.2f} ms, '
+              f'p99.9 {percentile(latencies, 99.9) / 1e6:.2f} ms')
+    if 'expired_after' in report:
+        print(f'  expiry:    every member gone {report["expired_after"]:.1f} s after the last join, '
+              f'rooms close when their owner expires '
+              f'(threshold {IDLE_THRESHOLD} s, granularity {IDLE_GRANULARITY} s)')
+    if 'server_cpu' in report:
+        print(f'  server:    {report["server_cpu"]:.2f} CPU seconds, {report["server_cpu_share"]:.0%} of one core')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=SCENARIOS, default='small-rooms')
+    parser.add_argument('--mode', default='asyncio', help='server UDP engine')
+    parser.add_argument('--workers', type=int, default=1, help='server worker processes')
+    parser.add_argument('--protocol', type=int, default=2, help='protocol version of the clients')
+    parser.add_argument('--rooms', type=int)
+    parser.add_argument('--room-size', type=int)
+    parser.add_argument('--senders', type=int, help='clients sending in each room')
+    parser.add_argument('--rate', type=float, help='messages/sec per sending client')
+    parser.add_argument('--duration', type=float, help='seconds of sending')
+    parser.add_argument('--concurrency', type=int, default=500, help='joins in flight')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--tcp-port', type=int, default=19030)
+    parser.add_argument('--udp-port', type=int, default=19031)
+    parser.add_argument('--metrics-port', type=int, default=19040)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    settings = dict(SCENARIOS[args.scenario])
+    for key in settings:
+        if getattr(args, key) is not None:
+            settings[key] = getattr(args, key)
+
+    extra_args = ['--log-level', 'WARNING', '--metrics-port', str(args.metrics_port)]
+    if args.scenario == 'idle-expiry':
+        extra_args += ['--inactive-threshold', str(IDLE_THRESHOLD), '--expiry-granularity', str(IDLE_GRANULARITY)]
+    server = start_server(args.mode, args.tcp_port, args.udp_port, args.workers, extra_args)
+    try:
+        stats, report = asyncio.run(run_scenario(args.scenario, settings, args, server.pid))
+    finally:
+        stop_server(server)
+    print_report(args.scenario, settings, stats, report)
+
+if __name__ == '__main__':
+    main()
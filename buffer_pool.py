@@ -0,0 +1,23 @@
+import collections
+
+class BufferPool:
+    """Preallocated receive buffers handed out to the UDP handlers and reused
+    Buffers are only allocated when every pooled one is in use, and at most
+    count buffers are kept when they come back.
+    """
+
+    def __init__(self, count, size):
+        self.size = size
+        self.count = count
+        # deque append/pop are atomic, so handler threads can release without a lock
+        self.buffers = collections.deque(bytearray(size) for _ in range(count))
+
+    def acquire(self):
+        try:
+            return self.buffers.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def release(self, buffer):
+        if len(self.buffers) < self.count:
+            self.buffers.append(buffer)
@@ -0,0 +1,694 @@
+"""
+# Headless chat client
+ChatClient speaks the protocol of client.py without prompts or threads, so
+bots, bridges and load tests can run thousands of clients on one event loop:
+
+    async with ChatClient('127.0.0.1') as client:
+        await client.join('room', 'alice', history=20)
+        await client.send('hello')
+        async for room_name, token, message in client:
+            ...
+
+With history, join also asks for the room's last messages on the same TCP
+connection and they come out of the iterator before anything sent later.
+
+A v3 client watches the room's sequence numbers for gaps and NACKs them, the
+server sends the lost messages again. They come out of the iterator when
+they arrive, after the messages that overtook them, and a message still
+missing after NACK_RETRIES NACKs is counted in lost.
+
+Clients share UDP sockets through an EndpointPool. The server sends a
+member's messages to the address its datagrams come from and every message
+carries its room name, so a shared socket hands each datagram to the client
+it holds for that room. A socket holds at most one client per room: two
+members of the same room on one address could not tell their copies apart.
+
+A v3 client created with compression=True asks for compressed messages at
+join. If the server grants it the client fetches the server's dictionary,
+once per server, and compresses what it sends too.
+
+A ChatSession is in many rooms at once, for bridges and bots: one TCP
+connection carries the requests of all its rooms and one UDP socket their
+messages, which come out of one iterator. Requests are pipelined on the
+connection, so joining dozens of rooms at once takes about one round trip:
+
+    await asyncio.gather(*(session.join(room_name, 'bot') for room_name in room_names))
+
+    async with ChatSession('127.0.0.1') as session:
+        await session.join('room-a', 'bot')
+        await session.join('room-b', 'bot')
+        await session.send('room-b', 'hello')
+        async for room_name, token, message in session:
+            ...
+"""
+import asyncio
+import logging
+import socket
+
+from compression import Codec
+from wire import (CAPABILITY_COMPRESSION, FLAG_ACK, FLAG_BATCH, FLAG_COMPRESSED, FLAG_NACK, FLAG_RETRANSMIT,
+                  MAX_REQUEST_ID, PACKET_SIZE, PROTOCOL_V1, PROTOCOL_V2, PROTOCOL_V3, ROOM_PAGE_SIZE, TCP_HEADER_SIZE,
+                  build_tcp_packet, build_udp_packet, compress_packet, decompress_packet, pack_nack,
+                  parse_tcp_header, parse_v3_header, split_batch, split_history, split_room_list, split_udp_packet)
+
+logger = logging.getLogger('chat.client')
+
+# Receive buffer of a shared UDP socket, it takes the messages of many clients
+ENDPOINT_RCVBUF = 1 << 20
+# Messages queued for a client that is not reading, more are dropped
+MAX_QUEUED = 1000
+# v3 reliability
+# seconds a gap stays open before it is NACKed, so a reordered message can fill it
+NACK_DELAY = 0.02
+# seconds between NACKs of the messages still missing
+NACK_INTERVAL = 0.1
+# NACKs sent for a missing message before it is given up on
+NACK_RETRIES = 5
+# missing messages asked for in one NACK, what the server sends again at most
+MAX_NACK = 64
+# missing messages tracked, older gaps are given up on
+MAX_MISSING = 1024
+# seconds between heartbeat ACKs, they reveal a lost last message
+ACK_INTERVAL = 1.0
+
+# {(host, tcp_port): Codec} of every server a client was granted compression by
+codecs = {}
+
+class JoinError(Exception):
+    """The server refused to create or join a room, or another request"""
+
+def parse_history(operation_payload):
+    """Split an operation 4 payload into its messages
+    Returns:
+        list of (seq, room_name, token, message), oldest first
+    """
+    messages = []
+    for seq, frame in split_history(operation_payload):
+        # The server keeps every message framed as v2
+        room_name, token, message = split_udp_packet(frame, PROTOCOL_V2)
+        messages.append((seq, room_name.decode(errors='replace'), token.decode(errors='replace'),
+                         message.decode(errors='replace')))
+    return messages
+
+class ControlConnection:
+    """A TCP connection to the server that carries the requests of many clients at once
+    Every request is sent with a RequestId as soon as it is made, without
+    waiting for the answers of the requests before it, and a reader task hands
+    each answer to its request by RequestId, whatever order they come back in.
+    The first request opens the connection and so does the first one after it
+    was lost; requests still waiting for their answers then fail with
+    ConnectionError. The server closes connections idle for its --control-timeout.
+    """
+
+    def __init__(self, host='127.0.0.1', tcp_port=9000):
+        self.host = host
+        self.tcp_port = tcp_port
+        self.writer = None
+        # Task reading the answers
+        self.receiver = None
+        self.lock = asyncio.Lock()
+        self.connects = 0
+        # {request_id: (future, version)} of the requests sent and not answered yet
+        self.pending = {}
+        self.last_request_id = 0
+
+    async def request(self, operation, state, room_name, operation_payload, version):
+        """Send one request and wait for its answer
+        Returns:
+            (operation, state, room_name, operation_payload) of the answer
+        Raises:
+            ConnectionError: if the connection was lost before the answer arrived
+        """
+        writer = await self._connect()
+        request_id = self._next_request_id()
+        future = asyncio.get_running_loop().create_future()
+        # A request cancelled while it waits stays pending, the reader still has to skip its answer
+        self.pending[request_id] = (future, version)
+        writer.write(build_tcp_packet(operation, state, room_name, operation_payload, version, request_id))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            self.pending.pop(request_id, None)
+            raise
+        return await future
+
+    async def _connect(self):
+        """Writer of the open connection, opened if there is none"""
+        async with self.lock:
+            if self.writer is None or self.writer.is_closing():
+                reader, self.writer = await asyncio.open_connection(self.host, self.tcp_port)
+                self.connects += 1
+                self.receiver = asyncio.ensure_future(self._receive(reader, self.writer))
+            return self.writer
+
+    def _next_request_id(self):
+        """A RequestId no pending request has, never 0"""
+        request_id = self.last_request_id
+        while True:
+            request_id = request_id % MAX_REQUEST_ID + 1
+            if request_id not in self.pending:
+                self.last_request_id = request_id
+                return request_id
+
+    async def _receive(self, reader, writer):
+        """Hand every answer read from the connection to its request until the connection ends"""
+        error = ConnectionError('Server closed the connection')
+        try:
+            while True:
+                room_name_size, operation, state, operation_payload_size, request_id = parse_tcp_header(
+                    await reader.readexactly(TCP_HEADER_SIZE))
+                body = await reader.readexactly(room_name_size + operation_payload_size)
+                entry = self.pending.pop(request_id, None)
+                if entry is None:
+                    # No answer: the server refused the connection or a request it could not read
+                    error = ConnectionError(body[room_name_size:].decode(errors='replace'))
+                    break
+                future, version = entry
+                # Drain the zero padding of a v1 packet
+                padding = PACKET_SIZE - TCP_HEADER_SIZE - len(body)
+                if version == PROTOCOL_V1 and padding > 0:
+                    await reader.readexactly(padding)
+                if not future.done():
+                    future.set_result((operation, state, body[:room_name_size], body[room_name_size:]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            if self.writer is writer:
+                self.writer = self.receiver = None
+                self._fail_pending(error)
+
+    def _fail_pending(self, error):
+        pending, self.pending = self.pending, {}
+        for future, _ in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def close(self):
+        if self.receiver is not None:
+            self.receiver.cancel()
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = self.receiver = None
+        self._fail_pending(ConnectionError('Connection closed'))
+
+class ClientEndpoint(asyncio.DatagramProtocol):
+    """A UDP socket shared by clients of different rooms"""
+
+    def __init__(self):
+        self.transport = None
+        # {room_name bytes: ChatClient}
+        self.clients = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, ENDPOINT_RCVBUF)
+
+    def datagram_received(self, data, addr):
+        # The server's error packets are TCP frames: RoomNameSize 0, Operation 1
+        if len(data) < 2 or data[0] == 0:
+            error = data[32:].rstrip(b'\x00').decode(errors='replace')
+            logger.warning('Server error: %s', error)
+            return
+        client = self.clients.get(data[2:2 + data[0]])
+        if client is not None:
+            client.datagram_received(data)
+
+    def error_received(self, exc):
+        logger.warning('UDP error: %s', exc)
+
+    def connection_lost(self, exc):
+        for client in list(self.clients.values()):
+            client.deliver_end()
+
+class EndpointPool:
+    """UDP sockets shared by many clients, opened as they are needed"""
+
+    def __init__(self, local_address=('0.0.0.0', 0)):
+        self.local_address = local_address
+        self.endpoints = []
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, room_name, client):
+        """An endpoint with no other client in room_name, now holding client"""
+        room_key = room_name.encode()
+        async with self.lock:
+            for endpoint in self.endpoints:
+                if room_key not in endpoint.clients:
+                    break
+            else:
+                loop = asyncio.get_running_loop()
+                _, endpoint = await loop.create_datagram_endpoint(ClientEndpoint, local_addr=self.local_address)
+                self.endpoints.append(endpoint)
+            endpoint.clients[room_key] = client
+            return endpoint
+
+    def release(self, endpoint, room_name):
+        """Remove the room's client from endpoint, closing the socket once nobody uses it"""
+        endpoint.clients.pop(room_name.encode(), None)
+        if not endpoint.clients and endpoint in self.endpoints:
+            self.endpoints.remove(endpoint)
+            endpoint.transport.close()
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.transport.close()
+        self.endpoints = []
+
+class ChatClient:
+    """One member of one chatroom
+    Args:
+        host, tcp_port, udp_port: the server
+        version: protocol version to speak
+        endpoints: EndpointPool to share UDP sockets with other clients,
+            a pool of the client's own if None
+        compression: ask a v3 server for compressed messages
+        control: ControlConnection to share with other clients, if None
+            the client opens a connection of its own for each call
+        messages: asyncio.Queue to share with other clients, ended by its owner
+    """
+
+    def __init__(self, host='127.0.0.1', tcp_port=9000, udp_port=9001, version=PROTOCOL_V2, endpoints=None,
+                 compression=False, control=None, messages=None):
+        self.host = host
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.version = version
+        self.compression = compression and version == PROTOCOL_V3
+        # compression.Codec once the server granted compression
+        self.codec = None
+        self.undecodable = 0
+        self.endpoints = endpoints if endpoints is not None else EndpointPool()
+        self.own_endpoints = endpoints is None
+        self.control = control if control is not None else ControlConnection(host, tcp_port)
+        self.own_control = control is None
+        self.room_name = None
+        self.token = None
+        self.endpoint = None
+        # (room_name, token, message), None once the client is closed
+        self.messages = messages if messages is not None else asyncio.Queue(MAX_QUEUED)
+        self.own_messages = messages is None
+        self.dropped = 0
+        # v3: highest Seq received, {missing Seq: NACKs sent for it}
+        self.highest_seq = None
+        self.missing = {}
+        self.recovered = 0
+        self.lost = 0
+        self.nack_timer = None
+        self.heartbeat = None
+
+    async def join(self, room_name, username, history=0, create=None):
+        """Create or join room_name over TCP and register for its messages
+        Args:
+            history: number of the room's recent messages to receive first
+            create: True to only create the room, False to only join it,
+                None to join it or create it if it does not exist
+        Returns:
+            the token the server assigned
+        Raises:
+            JoinError: if the server refused
+        """
+        state = self.version | CAPABILITY_COMPRESSION if self.compression else self.version
+        # 0: create or join, 9: create, 10: join
+        operation = 0 if create is None else 9 if create else 10
+        try:
+            # 2: unique token, State says whether compression was granted
+            operation, state, _, operation_payload = await self.control.request(
+                operation, state, room_name, username, self.version)
+            if operation != 2 or state & ~CAPABILITY_COMPRESSION:
+                raise JoinError(operation_payload.decode())
+            token = operation_payload.decode()
+            # Operation 5 is framed in the version the join negotiated, on the same connection
+            if state & CAPABILITY_COMPRESSION:
+                self.codec = await self._request_codec(room_name)
+            if history:
+                messages = await self._request_history(room_name, token, 'last', history)
+        finally:
+            self._release_control()
+
+        self.room_name = room_name
+        self.token = token
+        if history:
+            for seq, _, sender_token, message in messages:
+                if self.version == PROTOCOL_V3:
+                    self._track(seq)
+                self.deliver(room_name, sender_token, message)
+        self.endpoint = await self.endpoints.acquire(room_name, self)
+        # An empty message registers the endpoint's address with the server,
+        # a v3 server answers with the room's latest Seq
+        self._send('')
+        if self.version == PROTOCOL_V3:
+            self.heartbeat = asyncio.get_running_loop().call_later(ACK_INTERVAL, self._send_heartbeat)
+        return self.token
+
+    async def history(self, count=None, since=None):
+        """The room's last count messages, or the messages after sequence number since
+        With neither, every message the room keeps.
+        Returns:
+            list of (seq, room_name, token, message), oldest first
+        """
+        if self.token is None:
+            raise RuntimeError('join a room before asking for its history')
+        try:
+            if since is not None:
+                return await self._request_history(self.room_name, self.token, 'since', since)
+            if count is None:
+                # Sequence numbers start at 1, every kept message is after 0
+                return await self._request_history(self.room_name, self.token, 'since', 0)
+            return await self._request_history(self.room_name, self.token, 'last', count)
+        finally:
+            self._release_control()
+
+    async def refresh_token(self):
+        """Swap the client's token for a new one, the old one is no longer valid
+        The client stays in the room with its address, its messages are sent
+        with the new token from now on.
+        Returns:
+            the new token
+        Raises:
+            JoinError: if the server did not know the client
+        """
+        if self.token is None:
+            raise RuntimeError('join a room before refreshing its token')
+        try:
+            # 2: unique token
+            operation, _, _, operation_payload = await self.control.request(
+                13, self.version, self.room_name, self.token, self.version)
+        finally:
+            self._release_control()
+        if operation != 2:
+            raise JoinError(operation_payload.decode())
+        self.token = operation_payload.decode()
+        return self.token
+
+    async def leave(self):
+        """Leave the room over TCP and close the client, the token is no longer valid
+        Raises:
+            JoinError: if the server did not know the client, it is closed all the same
+        """
+        if self.token is None:
+            raise RuntimeError('join a room before leaving it')
+        try:
+            # 8: left
+            operation, state, _, operation_payload = await self.control.request(
+                7, self.version, self.room_name, self.token, self.version)
+            if operation != 8 or state != 0:
+                raise JoinError(operation_payload.decode())
+        finally:
+            await self.close()
+
+    def _release_control(self):
+        """Close the client's own connection once a call is done with it"""
+        if self.own_control:
+            self.control.close()
+
+    async def _request_history(self, room_name, token, mode, count):
+        """Operation 3 request, mode is 'last' or 'since'"""
+        # 4: messages
+        operation, state, _, operation_payload = await self.control.request(
+            3, self.version, room_name, f'{mode} {count} {token}', self.version)
+        if operation != 4 or state != 0:
+            raise JoinError(operation_payload.decode())
+        return parse_history(operation_payload)
+
+    async def _request_codec(self, room_name):
+        """Operation 5 request for the server's dictionary, unless the client has it already"""
+        codec = codecs.get((self.host, self.tcp_port))
+        known = f'{codec.dictionary_id:08x}' if codec is not None else ''
+        # 6: dictionary
+        operation, state, _, operation_payload = await self.control.request(5, 0, room_name, known, self.version)
+        if operation != 6 or state != 0:
+            raise JoinError(operation_payload.decode())
+        if codec is None or int.from_bytes(operation_payload[:4], 'big') != codec.dictionary_id:
+            codec = codecs[(self.host, self.tcp_port)] = Codec(operation_payload[4:])
+        return codec
+
+    async def send(self, message):
+        """Send a chat message to the room"""
+        if self.endpoint is None:
+            raise RuntimeError('join a room before sending')
+        self._send(message)
+
+    def _send(self, message, flags=0):
+        seq = self.highest_seq or 0
+        packet = build_udp_packet(self.room_name, self.token, message, self.version, flags, seq)
+        if self.codec is not None and not flags:
+            packet = compress_packet(packet, self.codec)
+        self.endpoint.transport.sendto(packet, (self.host, self.udp_port))
+
+    def datagram_received(self, data):
+        """Handle a datagram of the client's room"""
+        if self.version == PROTOCOL_V3:
+            flags, seq = parse_v3_header(data, 2 + data[0] + data[1])
+            if flags & FLAG_COMPRESSED:
+                try:
+                    data = decompress_packet(data, self.codec)
+                except ValueError as e:
+                    # Lost like any other datagram, the gap is NACKed once the next message arrives
+                    self.undecodable += 1
+                    logger.warning('Dropped a message that could not be decompressed: %s', e)
+                    return
+            if flags & FLAG_BATCH:
+                for packet in split_batch(data):
+                    self.datagram_received(packet)
+                return
+            if self.highest_seq is None and flags & FLAG_ACK:
+                # The answer to the registration: the messages up to seq came before the client
+                self.highest_seq = seq
+            # Seq 0: the server keeps no history, nothing can be NACKed
+            elif seq:
+                if not self._track(seq):
+                    return
+                if flags & FLAG_RETRANSMIT:
+                    self.recovered += 1
+            if flags & FLAG_ACK:
+                return
+        room_name, token, message = split_udp_packet(data, self.version)
+        token = token.decode(errors='replace')
+        # Batches carry the client's own messages too
+        if token == self.token:
+            return
+        self.deliver(room_name.decode(errors='replace'), token, message.decode(errors='replace'))
+
+    def _track(self, seq):
+        """Note that Seq seq arrived and NACK the gap it reveals
+        Returns:
+            False if it had arrived before
+        """
+        if self.highest_seq is None:
+            self.highest_seq = seq
+            return True
+        if seq <= self.highest_seq:
+            return self.missing.pop(seq, None) is not None
+        for missing in range(max(self.highest_seq + 1, seq - MAX_MISSING), seq):
+            self.missing[missing] = 0
+        self.lost += max(seq - MAX_MISSING - self.highest_seq - 1, 0)
+        self.highest_seq = seq
+        while len(self.missing) > MAX_MISSING:
+            del self.missing[next(iter(self.missing))]
+            self.lost += 1
+        if self.missing and self.nack_timer is None:
+            self.nack_timer = asyncio.get_running_loop().call_later(NACK_DELAY, self._send_nack)
+        return True
+
+    def _send_nack(self):
+        """NACK the missing messages, giving up on those NACKed NACK_RETRIES times"""
+        self.nack_timer = None
+        if self.endpoint is None:
+            return
+        # [first, count] of each missing range
+        ranges = []
+        asked = 0
+        for seq in sorted(self.missing):
+            if self.missing[seq] >= NACK_RETRIES:
+                del self.missing[seq]
+                self.lost += 1
+                continue
+            if asked == MAX_NACK:
+                continue
+            self.missing[seq] += 1
+            asked += 1
+            if ranges and ranges[-1][0] + ranges[-1][1] == seq:
+                ranges[-1][1] += 1
+            else:
+                ranges.append([seq, 1])
+        if ranges:
+            self._send(pack_nack(ranges), FLAG_NACK)
+        if self.missing:
+            self.nack_timer = asyncio.get_running_loop().call_later(NACK_INTERVAL, self._send_nack)
+
+    def _send_heartbeat(self):
+        if self.endpoint is None:
+            return
+        if self.highest_seq is None:
+            # The registration or its answer was lost
+            self._send('')
+        else:
+            self._send('', FLAG_ACK)
+        self.heartbeat = asyncio.get_running_loop().call_later(ACK_INTERVAL, self._send_heartbeat)
+
+    def deliver(self, room_name, token, message):
+        try:
+            self.messages.put_nowait((room_name, token, message))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def deliver_end(self):
+        self.endpoint = None
+        for timer in (self.nack_timer, self.heartbeat):
+            if timer is not None:
+                timer.cancel()
+        self.nack_timer = self.heartbeat = None
+        if not self.own_messages:
+            return
+        try:
+            self.messages.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Next (room_name, sender_token, message) received"""
+        item = await self.messages.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+    async def close(self):
+        if self.endpoint is not None:
+            self.endpoints.release(self.endpoint, self.room_name)
+        if self.own_endpoints:
+            self.endpoints.close()
+        self._release_control()
+        self.deliver_end()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+class ChatSession:
+    """A client in many chatrooms over one TCP connection and one UDP socket
+    Each room is a ChatClient that shares the session's ControlConnection,
+    EndpointPool and message queue. The session is in a room at most once,
+    so the pool never needs a second socket.
+    Args:
+        host, tcp_port, udp_port, version, compression: as for ChatClient
+    """
+
+    def __init__(self, host='127.0.0.1', tcp_port=9000, udp_port=9001, version=PROTOCOL_V2, compression=False):
+        self.host = host
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.version = version
+        self.compression = compression
+        self.control = ControlConnection(host, tcp_port)
+        self.endpoints = EndpointPool()
+        # {room_name: ChatClient}
+        self.rooms = {}
+        # (room_name, token, message) of every room, None once the session is closed
+        self.messages = asyncio.Queue(MAX_QUEUED)
+
+    async def join(self, room_name, username, history=0, create=None):
+        """Create or join room_name, see ChatClient.join
+        Raises:
+            JoinError: if the server refused or the session is in the room already
+        """
+        if room_name in self.rooms:
+            raise JoinError(f'Already in room {room_name}')
+        client = ChatClient(self.host, self.tcp_port, self.udp_port, self.version, self.endpoints,
+                            self.compression, self.control, self.messages)
+        # Taken while the join waits its turn on the connection
+        self.rooms[room_name] = client
+        try:
+            return await client.join(room_name, username, history, create)
+        except BaseException:
+            del self.rooms[room_name]
+            raise
+
+    async def leave(self, room_name):
+        """Leave room_name, see ChatClient.leave"""
+        client = self.room(room_name)
+        del self.rooms[room_name]
+        await client.leave()
+
+    async def send(self, room_name, message):
+        await self.room(room_name).send(message)
+
+    async def history(self, room_name, count=None, since=None):
+        return await self.room(room_name).history(count, since)
+
+    async def refresh_token(self, room_name):
+        return await self.room(room_name).refresh_token()
+
+    async def list_rooms(self, prefix='', limit=None, cursor=None):
+        """A page of the server's rooms whose names start with prefix, in name order
+        Args:
+            limit: most rooms on the page, the server's default if None
+            cursor: the cursor of the previous page, None for the first page
+        Returns:
+            (rooms, cursor): (room_name, member_count) pairs, and the cursor of
+            the next page or None if this is the last
+        Raises:
+            JoinError: if the server refused
+        """
+        operation_payload = '' if limit is None and cursor is None else str(ROOM_PAGE_SIZE if limit is None else limit)
+        if cursor is not None:
+            operation_payload += f' {cursor}'
+        # 12: rooms, RoomName the next cursor
+        operation, _, next_cursor, operation_payload = await self.control.request(
+            11, self.version, prefix, operation_payload, self.version)
+        if operation != 12:
+            raise JoinError(operation_payload.decode())
+        return split_room_list(operation_payload), next_cursor.decode() or None
+
+    async def iter_rooms(self, prefix='', page_size=ROOM_PAGE_SIZE):
+        """Every (room_name, member_count) of the rooms whose names start with prefix, a page at a time"""
+        cursor = None
+        while True:
+            rooms, cursor = await self.list_rooms(prefix, page_size, cursor)
+            for room in rooms:
+                yield room
+            if cursor is None:
+                return
+
+    def room(self, room_name):
+        """The ChatClient of a room the session joined"""
+        client = self.rooms.get(room_name)
+        if client is None or client.token is None:
+            raise RuntimeError(f'join room {room_name} first')
+        return client
+
+    @property
+    def dropped(self):
+        return sum(client.dropped for client in self.rooms.values())
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Next (room_name, sender_token, message) received in any room"""
+        item = await self.messages.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+    async def close(self):
+        for client in list(self.rooms.values()):
+            await client.close()
+        self.rooms = {}
+        self.endpoints.close()
+        self.control.close()
+        try:
+            self.messages.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
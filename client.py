@@ -1,63 +1,52 @@
-import socket
-import threading
+import asyncio
+
+from chat_client import ChatClient, ChatSession, JoinError
+from wire import PROTOCOL_V3
 
 # TCP server address and port
 tcp_server_address = '0.0.0.0'
 tcp_server_port = 9000  # TCP port for chatroom management
 
-# UDP server address and port
-udp_server_address = '0.0.0.0'
+# UDP server port, on the same host
 udp_server_port = 9001  # UDP port for chat messages
 
-address = ''
-port = 0 # auto assign port
-
 SPACE = '     '
 
-def process_udp_message(data):
-    room_name_size = data[0]
-    token_size = data[1]
-    room_name = data[2:2 + room_name_size]
-    token = data[2 + room_name_size:2 + room_name_size + token_size]
-    message = data[2 + room_name_size + token_size:4096]
-    return room_name, token, message
-
-def display_recv_message(data):
-    # display message to user
-    room_name, token, message = process_udp_message(data)
-    print(f'\n{SPACE}room_name: {room_name.decode()}')
-    print(f'{SPACE}token: {token.decode()}')
-    print(f'{SPACE}message: {message.decode()}')
-
-def recv_and_display_message():
-    while True:
-        try:
-            data, server = sock.recvfrom(4096)
-            if data == b'':
-                break
-            display_recv_message(data)
-        except ConnectionResetError:
-            print('Server disconnected')
-            break
-        except Exception as e:
-            print(f'Error receiving message: {e}')
-            break
+# Protocol versions, flags and framing, see wire.py
+PROTOCOL_VERSION = PROTOCOL_V3
+# Recent messages of the room shown after joining
+HISTORY_ON_JOIN = 20
 
 """
 # TCP for chatroom management
 ## tcp packet format:
-Header | RoomNameSize(1byte) + Operation(1byte) + State(1byte) + OperationPayloadSize(29byte)
-Body | RoomName(RoomNameSize) + OperationPayload(29byte)
+Header | RoomNameSize(1byte) + Operation(1byte) + State(1byte) + RequestId(4byte) + OperationPayloadSize(25byte)
+Body | RoomName(RoomNameSize) + OperationPayload(OperationPayloadSize)
+RequestId 0: answered in order, operation 1 first; otherwise answered with one frame
+carrying the RequestId when done, possibly out of order (chat_client.ControlConnection)
 
 Operation:
 0: request to create chatroom or join chatroom (client send server roomname and username)
 1: server respond to request containing status code
 2: server respond to request containing unique token that is assigned client name 
 that recognize client as the owner of the chatroom
+5: request the compression dictionary
+6: server respond to request containing the dictionary
+7: request to leave a chatroom
+8: server respond to request confirming the client left
+9: request to create a chatroom only, 10: request to join one only, answered with operation 2
+11: request a page of the chatroom directory, optionally of the rooms whose names start with a prefix
+12: server respond to request containing the rooms and their member counts
+13: request a new token in place of the client's, answered with operation 2
 
 State = status code:
 0: Success
 1: Failed
+In an operation 0, 3, 7, 9, 10, 11 or 13 request, State = requested protocol version:
+0 or 1: v1, every frame is zero-padded to 4096 bytes
+2: v2, every frame is sized to its header (32 + RoomNameSize + OperationPayloadSize)
+3: v3, TCP frames as in v2, UDP frames carry Flags and Seq
+ORed with 0x80 to ask for compression, granted by operation 2 with State 0x80
 
 OperationPayload:
 if operation == 0:
@@ -70,41 +59,20 @@ if operation == 2:
     State = status code
     RoomName = room name
     OperationPayload = unique token
+if operation == 5:
+    OperationPayload = id of the dictionary the client has, as 8 hex digits, or nothing
+if operation == 6:
+    OperationPayload = DictionaryId(4byte) + Dictionary, left out when the client has it
+if operation == 7 or operation == 8 or operation == 13:
+    RoomName = room name
+    OperationPayload = unique token
+if operation == 11:
+    RoomName = prefix of the room names to list, or nothing
+    OperationPayload = Limit + ' ' + Cursor, Limit alone for the first page, or nothing
+if operation == 12:
+    RoomName = Cursor of the next page, nothing after the last page
+    OperationPayload = NameSize(1byte) + Name + MemberCount(4byte) per room, in name order
 """
-def build_tcp_packet(operation, state, room_name, operation_payload):
-    try:
-        # Check size limits
-        if len(room_name) > 255:
-            return build_error_packet("Room name exceeds maximum size of 255 bytes")
-        if len(operation_payload) > (2**29 - 1):
-            return build_error_packet("Operation payload exceeds maximum size of 2^29 - 1 bytes")
-
-        packet = bytearray(4096) 
-        # Header(32bytes)
-        packet[0] = len(room_name) # RoomNameSize(1byte)
-        packet[1] = operation # Operation(1byte)
-        packet[2] = state # State(1byte)
-        packet[3:32] = len(operation_payload).to_bytes(29, byteorder='big') # OperationPayloadSize(29byte)
-        # Body(RoomNameSize + OperationPayload)
-        packet[32:32 + len(room_name)] = room_name.encode() # RoomName(RoomNameSize bytes, max 255byte)
-        packet[32 + len(room_name):32 + len(room_name) + len(operation_payload)] = operation_payload.encode() # OperationPayload(max 2^29 - 1 bytes)
-
-        return packet
-    except Exception as e:
-        return build_error_packet(str(e))
-
-def build_error_packet(error_message):
-    """Build a packet with operation=1 (error response) and state=1 (failed)"""
-    packet = bytearray(4096)
-    # Header(32bytes)
-    packet[0] = 0  # RoomNameSize = 0 for error messages
-    packet[1] = 1  # Operation = 1 (error response)
-    packet[2] = 1  # State = 1 (failed)
-    packet[3:32] = len(error_message.encode())  # OperationPayloadSize
-    # Body (only OperationPayload)
-    packet[32:32 + len(error_message.encode())] = error_message.encode()
-    return packet
-
 """
 # UDP for chat
 - packet format:
@@ -114,96 +82,128 @@ def build_error_packet(error_message):
     - body:
         - RoomName(RoomNameSize)
         - Token(TokenSize)
-        - Message(4096 - RoomNameSize - TokenSize)
+        - Flags(1byte) + Seq(8byte) in v3 only, Flags: 0x01 ACK, 0x02 NACK, 0x04 RETRANSMIT, 0x08 BATCH,
+          0x10 COMPRESSED
+        - Message(4096 - RoomNameSize - TokenSize) in v1, zero-padded
+        - Message(rest of the datagram) in v2 and v3
+- v3: the server numbers each room's messages in Seq, a client NACKs the gaps
+  with Message = First(8byte) + Count(2byte) per missing range (see server.py)
+- v3 batch: Message = FrameSize(2byte) + Frame for every message, each Frame a v3 packet
+- v3 compressed: Message is compressed with the server's dictionary (see compression.py),
+  a compressed batch's Message is decompressed before it is split
 """
-def build_udp_packet(room_name, token, message):
-    packet = bytearray(4096)
-    packet[0] = len(room_name)
-    packet[1] = len(token)
-    packet[2: 2+len(room_name)] = room_name.encode()
-    packet[2+len(room_name): 2+len(room_name)+len(token)] = token.encode()
-    packet[2+len(room_name)+len(token): 2+len(room_name)+len(token)+len(message)] = message.encode()
-    return packet
-
-if __name__ == '__main__':
-    # tcp connection
-    sock_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        sock_tcp.connect((tcp_server_address, tcp_server_port))
-    except ConnectionRefusedError:
-        print(f'Failed to connect to server at {tcp_server_address}:{tcp_server_port}')
-        print('Please ensure the server is running and the port is correct')
-        exit(1)
+async def read_input(prompt):
+    """input() without blocking the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(None, input, prompt)
+
+async def display_messages(client):
+    async for room_name, token, message in client:
+        print(f'\n{SPACE}room_name: {room_name}')
+        print(f'{SPACE}token: {token}')
+        print(f'{SPACE}message: {message}')
+
+def parse_room_message(message, room_names):
+    """(room_name, message) of a message typed in a session of several rooms
+    '@room message' goes to that room, anything else to the first room.
+    """
+    if message.startswith('@'):
+        room_name, _, text = message[1:].partition(' ')
+        if room_name in room_names:
+            return room_name, text
+    return room_names[0], message
+
+async def run_session(room_names, username):
+    """Chat in several rooms over one TCP connection and one UDP socket"""
+    async with ChatSession(tcp_server_address, tcp_server_port, udp_server_port, PROTOCOL_VERSION) as session:
+        # The joins are pipelined on the session's connection
+        results = await asyncio.gather(*(session.join(room_name, username, HISTORY_ON_JOIN)
+                                         for room_name in room_names), return_exceptions=True)
+        for room_name, result in zip(room_names, results):
+            if isinstance(result, OSError):
+                print(f'Failed to connect to server at {tcp_server_address}:{tcp_server_port}')
+                return
+            if isinstance(result, JoinError):
+                print(f'Failed to join {room_name}: {result}')
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                print(f'{room_name}: unique token {result}')
+        room_names = list(session.rooms)
+        if not room_names:
+            return
+        print(f'Messages go to {room_names[0]}, start one with @room to send it to another room')
+
+        receiver = asyncio.create_task(display_messages(session))
+        while True:
+            room_name, message = parse_room_message(await read_input('Enter your message: '), room_names)
+            if len(message) > 4096 - len(username):
+                print('Message Length exceeds 4096 bytes')
+                break
+            await session.send(room_name, message)
+        receiver.cancel()
 
+async def list_rooms(prefix):
+    """Print the rooms whose names start with prefix and their member counts"""
+    async with ChatSession(tcp_server_address, tcp_server_port, udp_server_port, PROTOCOL_VERSION) as session:
+        try:
+            async for room_name, member_count in session.iter_rooms(prefix):
+                print(f'{room_name}: {member_count} members')
+        except OSError:
+            print(f'Failed to connect to server at {tcp_server_address}:{tcp_server_port}')
+        except JoinError as e:
+            print(f'Failed : {e}')
+
+async def main():
     # user input username
-    username = input('Enter your username: ')
+    username = await read_input('Enter your username: ')
     username_length = len(username)
     if username_length > 255:
         print('Username Length exceeds 255 bytes')
-        exit(1)
-
-    # user input roomname
-    roomname = input('Enter the room name: ')
-    roomname_length = len(roomname)
-    if roomname_length > 255:
+        return
+
+    # user input roomname, several separated by commas, or ?prefix to search the rooms
+    roomname = await read_input('Enter the room name: ')
+    if roomname.startswith('?'):
+        await list_rooms(roomname[1:].strip())
+        return
+    room_names = [name.strip() for name in roomname.split(',') if name.strip()]
+    if any(len(name) > 255 for name in room_names):
         print('Room name exceeds maximum size of 255 bytes')
-        exit(1) 
-
-    # Operation:
-    # 0: request to create chatroom or join chatroom (client send server roomname and username)
-    # 1: server respond to request containing status code
-    # 2: server respond to request containing unique token that is assigned client name 
-    # 0: send request
-    sock_tcp.sendall(build_tcp_packet(0, 0, roomname, username))
-    # 1: receive response
-    response = sock_tcp.recv(4096)
-    if response[0] == 0 and response[1] == 1: # failed
-        print(f'Failed : {response[32:].decode()}')
-        exit(1)
-    #2: receive unique token
-    response = sock_tcp.recv(4096)
-    # decode unique token
-    roomname_size = response[0]
-    operation = response[1]
-    state = response[2]
-    operation_payload_size = int.from_bytes(response[3:32], byteorder='big')
-    room_name = response[32:32 + roomname_size]
-    unique_token = response[32 + roomname_size:32 + roomname_size + operation_payload_size].decode() # e.g) b'27448'
-    print(f'Unique token: {unique_token}')
-    if operation == 2 and state == 1:
-        print(f'Failed: {room_name.decode()}')
-        exit(1)
-
-    # udp connection use unique token as port
-    try:
-        udp_port = int(unique_token)  # Convert token to integer
-    except ValueError:
-        print('Error: Invalid token format')
-        exit(1)
-        
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    # empty string means 0.0.0.0
-    sock.bind((address, udp_port))
-
-    # Start thread to receive messages from server
-    thread = threading.Thread(target=recv_and_display_message, daemon=True)
-    thread.start()
+        return
+    if len(room_names) > 1:
+        await run_session(room_names, username)
+        return
 
-    try:
+    async with ChatClient(tcp_server_address, tcp_server_port, udp_server_port, PROTOCOL_VERSION) as client:
+        # tcp connection: create or join the chatroom and get the unique token
+        try:
+            unique_token = await client.join(roomname, username, HISTORY_ON_JOIN)
+        except ConnectionRefusedError:
+            print(f'Failed to connect to server at {tcp_server_address}:{tcp_server_port}')
+            print('Please ensure the server is running and the port is correct')
+            return
+        except JoinError as e:
+            print(f'Failed : {e}')
+            return
+        print(f'Unique token: {unique_token}')
+
+        # Display messages from the server while reading input
+        receiver = asyncio.create_task(display_messages(client))
         while True:
-            message = input('Enter your message: ')
+            message = await read_input('Enter your message: ')
             message_length = len(message)
             if message_length > 4096 - username_length:
                 print('Message Length exceeds 4096 bytes')
-                exit(1)
-
+                break
 
             print(f'roomname: {roomname}, unique_token: {unique_token}, message: {message}')
-            send_message = build_udp_packet(roomname, unique_token, message)
             # send message to server
-            sock.sendto(send_message, (udp_server_address, udp_server_port))
+            await client.send(message)
             print('Send message to server')
-    except KeyboardInterrupt:
+        receiver.cancel()
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, EOFError):
         print('\nExiting...')
-    finally:
-        sock.close()
\ No newline at end of file
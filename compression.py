@@ -0,0 +1,128 @@
+"""
+# Message compression
+v3 clients that ask for it at join get messages whose body is compressed,
+flagged FLAG_COMPRESSED in the v3 Flags, and may send them compressed too.
+- a message body is compressed as raw deflate (no zlib header or checksum,
+  UDP has its own) with a 4 KB window, the size of the largest v1 message
+- the compressor is primed with a shared dictionary of text chat messages
+  commonly hold, so a short message can refer back to it; without a
+  dictionary short messages barely shrink
+- client and server must use the same dictionary, the server sends its
+  dictionary to a client whose copy does not match its dictionary id
+- messages under MIN_COMPRESS_SIZE bytes, and messages compression would
+  not shrink, are sent as they are
+Training a dictionary from a file of sample messages, one per line:
+    python compression.py train messages.txt chat.dict
+    python server.py --compression-dictionary chat.dict
+"""
+import argparse
+import collections
+import zlib
+
+# Window of the raw deflate streams, 2^12 = 4096 bytes
+WINDOW_BITS = 12
+# deflate cannot refer back further than the window less its 262 byte lookahead
+DICTIONARY_SIZE = (1 << WINDOW_BITS) - 262
+LEVEL = 6
+# Memory for the compressor's hash table, a small one makes priming it cheap
+MEM_LEVEL = 4
+# Shorter messages do not shrink enough to pay for decompressing them
+MIN_COMPRESS_SIZE = 64
+# Largest message body decompressed, a UDP datagram's payload
+MAX_MESSAGE_SIZE = 65507
+
+class Codec:
+    """Compresses message bodies with a shared dictionary
+    The compressor and decompressor are primed with the dictionary once and
+    copied for every message, so each message is compressed on its own.
+    Args:
+        dictionary: bytes both sides prime their streams with, b'' for none
+    """
+
+    def __init__(self, dictionary=b''):
+        self.dictionary = bytes(dictionary[-DICTIONARY_SIZE:])
+        # crc32 of the dictionary, 0 without one
+        self.dictionary_id = zlib.crc32(self.dictionary)
+        if self.dictionary:
+            self.compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL, zdict=self.dictionary)
+            self.decompressor = zlib.decompressobj(-WINDOW_BITS, zdict=self.dictionary)
+        else:
+            self.compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL)
+            self.decompressor = zlib.decompressobj(-WINDOW_BITS)
+
+    def compress(self, message):
+        """message compressed, None if it is too short or would not shrink"""
+        if len(message) < MIN_COMPRESS_SIZE:
+            return None
+        compressor = self.compressor.copy()
+        compressed = compressor.compress(message) + compressor.flush()
+        if len(compressed) >= len(message):
+            return None
+        return compressed
+
+    def decompress(self, data, max_size=MAX_MESSAGE_SIZE):
+        """The message compressed in data
+        Raises:
+            ValueError: if data is not a complete compressed message of at most max_size bytes
+        """
+        decompressor = self.decompressor.copy()
+        try:
+            message = decompressor.decompress(data, max_size)
+        except zlib.error as e:
+            raise ValueError(f'Invalid compressed message: {e}')
+        if decompressor.unconsumed_tail:
+            raise ValueError(f'Compressed message is larger than {max_size} bytes')
+        if not decompressor.eof:
+            raise ValueError('Compressed message is cut short')
+        return message
+
+def load_dictionary(path):
+    with open(path, 'rb') as dictionary:
+        return dictionary.read()
+
+def train_dictionary(samples, size=DICTIONARY_SIZE):
+    """Build a dictionary out of the words and phrases most common in samples
+    A phrase is worth its length times the number of times it occurs. The
+    most valuable ones go last, closest to the message, where deflate
+    refers to them with the shortest distances.
+    Args:
+        samples: messages as bytes
+    Returns:
+        the dictionary, at most size bytes
+    """
+    counts = collections.Counter()
+    for sample in samples:
+        words = sample.split()
+        # Phrases of up to 4 words, with the space that follows them in the message
+        for length in range(1, 5):
+            for start in range(len(words) - length + 1):
+                counts[b' '.join(words[start:start + length]) + b' '] += 1
+    ranked = sorted((phrase for phrase, count in counts.items() if count > 1),
+                    key=lambda phrase: counts[phrase] * len(phrase), reverse=True)
+    chosen = []
+    dictionary = bytearray()
+    for phrase in ranked:
+        if len(dictionary) + len(phrase) > size:
+            if size - len(dictionary) < 8:
+                break
+            continue
+        # A phrase already in the dictionary can be referred to there
+        if phrase in dictionary:
+            continue
+        chosen.append(phrase)
+        dictionary += phrase
+    return b''.join(reversed(chosen))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shared dictionary for message compression')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    train = subparsers.add_parser('train', help='build a dictionary from sample messages, one per line')
+    train.add_argument('samples')
+    train.add_argument('dictionary')
+    train.add_argument('--size', type=int, default=DICTIONARY_SIZE)
+    args = parser.parse_args()
+    with open(args.samples, 'rb') as samples:
+        dictionary = train_dictionary([line.rstrip(b'\n') for line in samples], args.size)
+    with open(args.dictionary, 'wb') as output:
+        output.write(dictionary)
+    print(f'{len(dictionary)} byte dictionary, id {zlib.crc32(dictionary):08x}')
@@ -0,0 +1,60 @@
+import math
+import threading
+
+class TimingWheel:
+    """Timing wheel of items keyed on their expiry deadline
+    The wheel has one slot per granularity seconds up to horizon seconds
+    ahead. advance() only visits the slots that came due since the last call,
+    so the work per call is proportional to the items in those slots and not
+    to every scheduled item. Deadlines further than horizon ahead are put in
+    the last slot and are expected to be rescheduled when it comes due.
+    """
+
+    def __init__(self, horizon, granularity, now):
+        self.granularity = granularity
+        self.size = int(math.ceil(horizon / granularity)) + 1
+        self.slots = [set() for _ in range(self.size)]
+        # {item: tick}, so an item is in at most one slot
+        self.ticks = {}
+        # Next tick to be processed by advance()
+        self.current = int(now // granularity)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def schedule(self, item, deadline):
+        """Schedule item to come due at deadline, replacing an earlier schedule"""
+        # Never due before the deadline: round up to the next tick
+        tick = int(math.ceil(deadline / self.granularity))
+        with self.lock:
+            tick = min(max(tick, self.current), self.current + self.size - 1)
+            old_tick = self.ticks.get(item)
+            if old_tick is not None:
+                self.slots[old_tick % self.size].discard(item)
+            self.slots[tick % self.size].add(item)
+            self.ticks[item] = tick
+
+    def discard(self, item):
+        with self.lock:
+            tick = self.ticks.pop(item, None)
+            if tick is not None:
+                self.slots[tick % self.size].discard(item)
+
+    def advance(self, now):
+        """Remove and return the items of every slot due at now"""
+        target = int(now // self.granularity)
+        due = []
+        with self.lock:
+            # After a long pause every slot is due once
+            if target - self.current >= self.size:
+                self.current = target - self.size + 1
+            while self.current <= target:
+                slot = self.slots[self.current % self.size]
+                if slot:
+                    due.extend(slot)
+                    for item in slot:
+                        del self.ticks[item]
+                    slot.clear()
+                self.current += 1
+        return due
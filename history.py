@@ -0,0 +1,79 @@
+import collections
+
+class MessageHistory:
+    """Most recent frames of a room in one preallocated byte ring
+    Frames are copied back to back into a bytearray of capacity bytes and
+    the oldest ones are overwritten as new ones arrive, so the memory of a
+    room's history is fixed whatever the traffic. At most max_messages
+    frames are kept. Every frame gets the next sequence number, which
+    clients use to ask for what they missed.
+    Not thread-safe, callers hold the room's lock.
+    """
+
+    def __init__(self, capacity, max_messages):
+        self.buffer = bytearray(capacity)
+        self.max_messages = max_messages
+        # (offset, length) of each kept frame, oldest first
+        self.records = collections.deque()
+        # Sequence number of records[0], the next one is first_seq + len(records)
+        self.first_seq = 1
+        # Where the next frame is written
+        self.write = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def next_seq(self):
+        return self.first_seq + len(self.records)
+
+    def _evict(self):
+        self.records.popleft()
+        self.first_seq += 1
+
+    def append(self, frame):
+        """Copy frame into the ring
+        Returns:
+            the frame's sequence number
+        """
+        size = len(frame)
+        capacity = len(self.buffer)
+        if size > capacity:
+            # Too large to keep, but it still takes a sequence number
+            while self.records:
+                self._evict()
+            self.first_seq += 1
+            return self.first_seq - 1
+        start = self.write
+        if start + size > capacity:
+            # The rest of the buffer is too short: its frames are the oldest, drop them and wrap
+            while self.records and self.records[0][0] >= start:
+                self._evict()
+            start = 0
+        # Drop the oldest frames the new one overwrites
+        while self.records and start <= self.records[0][0] < start + size:
+            self._evict()
+        if len(self.records) >= self.max_messages:
+            self._evict()
+        self.buffer[start:start + size] = frame
+        self.records.append((start, size))
+        self.write = start + size
+        return self.next_seq - 1
+
+    def since(self, seq, count=None):
+        """Frames with a sequence number above seq, oldest first
+        Args:
+            count: most frames returned, all of them if None
+        Returns:
+            list of (seq, frame bytes)
+        """
+        skip = max(seq + 1 - self.first_seq, 0)
+        stop = len(self.records) if count is None else min(skip + count, len(self.records))
+        return [(self.first_seq + index, bytes(self.buffer[offset:offset + length]))
+                for index, (offset, length) in enumerate(self.records) if skip <= index < stop]
+
+    def last(self, count=None):
+        """The count most recent frames, oldest first, every frame kept if count is None"""
+        if count is None:
+            return self.since(0)
+        return self.since(self.next_seq - 1 - count)
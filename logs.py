@@ -0,0 +1,102 @@
+"""
+# Logging
+The server logs through the 'chat' loggers. configure_logging() puts a
+QueueHandler in front of the console handler, so a thread that logs only
+enqueues the record and a QueueListener thread formats and writes it.
+Records up to WARNING are sampled per call site: at most sample_rate of
+them per second get through and the next one that does says how many were
+suppressed. Packet-path call sites check logger.isEnabledFor(logging.DEBUG)
+before building their arguments, so with debug off they cost one check.
+"""
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+LOGGER_NAME = 'chat'
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s'
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+# Records waiting for the listener, more are dropped rather than block the caller
+QUEUE_SIZE = 10000
+
+_listener = None
+
+class SampleFilter(logging.Filter):
+    """Let through at most rate records per second from each call site
+    Records above level are never sampled.
+    """
+
+    def __init__(self, rate, level=logging.WARNING):
+        super().__init__()
+        self.rate = rate
+        self.level = level
+        # {(pathname, lineno): [second, passed, suppressed]}
+        self.sites = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+        key = (record.pathname, record.lineno)
+        second = int(record.created)
+        with self.lock:
+            site = self.sites.get(key)
+            if site is None:
+                site = self.sites[key] = [second, 0, 0]
+            elif site[0] != second:
+                site[0] = second
+                site[1] = 0
+            if site[1] >= self.rate:
+                site[2] += 1
+                return False
+            site[1] += 1
+            suppressed = site[2]
+            site[2] = 0
+        if suppressed:
+            record.msg = f'{record.msg} ({suppressed} similar suppressed)'
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def configure_logging(level='INFO', sample_rate=10, stream=None):
+    """Send the 'chat' loggers through a queue to stream (stdout by default)
+    Call once per process: the listener thread does not survive a fork.
+    Args:
+        level: name or number of the lowest level logged
+        sample_rate: records per second let through from each call site, up to WARNING
+    """
+    global _listener
+    stop_logging()
+    log_queue = queue.Queue(QUEUE_SIZE)
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SampleFilter(sample_rate))
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.handlers[:] = [queue_handler]
+    logger.setLevel(level)
+    logger.propagate = False
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+
+def stop_logging():
+    """Write out the queued records and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        try:
+            _listener.stop()
+        except queue.Full:
+            pass
+        _listener = None
@@ -0,0 +1,188 @@
+"""
+# Metrics
+Counters, gauges and latency histograms, rendered in the Prometheus text
+format on a local HTTP endpoint and dumped as a one-line snapshot to the
+log every few seconds.
+Recording is meant to stay on in production:
+- Counter.inc is one add
+- Gauge values are computed only when the metrics are read
+- Histogram.record puts a value in a log-linear (HDR-style) bucket: 16
+  sub-buckets per power of two, so any quantile is known to within about
+  6% with a fixed 640-slot array and no allocation per value
+Updates take no lock, a lock costs more than the update itself. With the
+threaded engine two threads updating the same metric at the same instant
+can lose one update, which the GIL makes rare; readers only copy.
+"""
+import http.server
+import logging
+import threading
+import time
+
+# Values below 2 * SUB_BUCKETS have a bucket each, above that each power of
+# two is split into SUB_BUCKETS buckets
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# Enough buckets for values up to 2**40 (18 minutes in nanoseconds)
+HISTOGRAM_BUCKETS = 40 * SUB_BUCKETS
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+logger = logging.getLogger('chat.metrics')
+
+class Counter:
+    """Monotonic count of events"""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter',
+                f'{self.name} {self.value}']
+
+    def summary(self):
+        return f'{self.name}={self.value}'
+
+class Gauge:
+    """Value read from function whenever the metrics are collected"""
+
+    def __init__(self, name, help_text, function):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} gauge',
+                f'{self.name} {self.function()}']
+
+    def summary(self):
+        return f'{self.name}={self.function()}'
+
+def bucket_index(value):
+    """Log-linear bucket of an integer value, negative values count as 0"""
+    if value < 2 * SUB_BUCKETS:
+        return value if value > 0 else 0
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    index = ((shift + 1) << SUB_BUCKET_BITS) + (value >> shift) - SUB_BUCKETS
+    return index if index < HISTOGRAM_BUCKETS else HISTOGRAM_BUCKETS - 1
+
+def bucket_upper_bound(index):
+    """Largest value that falls in bucket index"""
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    return ((index % SUB_BUCKETS + SUB_BUCKETS + 1) << shift) - 1
+
+class Histogram:
+    """Distribution of latencies recorded in nanoseconds, rendered in seconds"""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.sum = 0
+
+    def record(self, nanoseconds):
+        self.counts[bucket_index(nanoseconds)] += 1
+        self.count += 1
+        self.sum += nanoseconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile q, in nanoseconds"""
+        counts = list(self.counts)
+        count = sum(counts)
+        if not count:
+            return 0
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return bucket_upper_bound(index)
+        return bucket_upper_bound(HISTOGRAM_BUCKETS - 1)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} summary']
+        for q in QUANTILES:
+            lines.append(f'{self.name}{{quantile="{q}"}} {self.quantile(q) / 1e9:.9f}')
+        lines.append(f'{self.name}_sum {self.sum / 1e9:.9f}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+    def summary(self):
+        return (f'{self.name}[n={self.count} p50={self.quantile(0.5) / 1e3:.1f}us '
+                f'p99={self.quantile(0.99) / 1e3:.1f}us]')
+
+class MetricsRegistry:
+    """Every metric of the process, in the order they were added"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text):
+        return self._add(Counter(name, help_text))
+
+    def gauge(self, name, help_text, function):
+        return self._add(Gauge(name, help_text, function))
+
+    def histogram(self, name, help_text):
+        return self._add(Histogram(name, help_text))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """One line with every metric, for the log"""
+        return ' '.join(metric.summary() for metric in self.metrics)
+
+def serve_metrics(metrics, host, port):
+    """Serve metrics.render() at http://host:port/metrics from a daemon thread
+    Returns:
+        the running http.server.ThreadingHTTPServer
+    """
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info('Metrics on http://%s:%d/metrics', host, port)
+    return server
+
+def start_snapshots(metrics, interval):
+    """Log metrics.summary() every interval seconds from a daemon thread"""
+
+    def dump():
+        while True:
+            time.sleep(interval)
+            logger.info(metrics.summary())
+
+    thread = threading.Thread(target=dump, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,73 @@
+import collections
+import threading
+
+# What BoundedQueue.put drops when the queue is full
+DROP_POLICIES = ('drop-newest', 'drop-oldest', 'fair')
+
+class BoundedQueue:
+    """Queue of at most depth items between threads whose put() never blocks
+    When the queue is full the policy picks the item that is dropped:
+    - drop-newest: the item being put, what waits keeps its place
+    - drop-oldest: the item that waited longest, it is the most stale
+    - fair: the oldest item of the key with the most items waiting, and
+      get() takes the keys in turn, so one busy key cannot crowd out the
+      others; finding that key looks at every key with items waiting
+    """
+
+    def __init__(self, depth, policy='drop-newest'):
+        if policy not in DROP_POLICIES:
+            raise ValueError(f'Unknown drop policy {policy!r}')
+        self.depth = depth
+        self.policy = policy
+        self.not_empty = threading.Condition(threading.Lock())
+        # {key: deque of items}, in the order get() takes the keys
+        self.queues = collections.OrderedDict()
+        self.size = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.size
+
+    def put(self, item, key=None):
+        """Queue item under key
+        Returns:
+            the item dropped to make room, None if nothing was dropped
+        """
+        if self.policy != 'fair':
+            key = None
+        with self.not_empty:
+            dropped = None
+            if self.size >= self.depth:
+                self.dropped += 1
+                if self.policy == 'drop-newest':
+                    return item
+                victim = key
+                if self.policy == 'fair':
+                    victim = max(self.queues, key=lambda queued_key: len(self.queues[queued_key]))
+                queue = self.queues[victim]
+                dropped = queue.popleft()
+                self.size -= 1
+                if not queue:
+                    del self.queues[victim]
+            queue = self.queues.get(key)
+            if queue is None:
+                queue = self.queues[key] = collections.deque()
+            queue.append(item)
+            self.size += 1
+            self.not_empty.notify()
+            return dropped
+
+    def get(self):
+        """Take the next item, waiting for one"""
+        with self.not_empty:
+            while not self.size:
+                self.not_empty.wait()
+            key, queue = next(iter(self.queues.items()))
+            item = queue.popleft()
+            self.size -= 1
+            if queue:
+                # The next get() serves the next key
+                self.queues.move_to_end(key)
+            else:
+                del self.queues[key]
+            return item
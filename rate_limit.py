@@ -0,0 +1,29 @@
+class TokenBucket:
+    """Token bucket limit of rate events per second with bursts of up to burst
+    The bucket's state lives on the limited object, in its bucket_tokens and
+    bucket_time attributes, so limiting a million members costs two floats
+    each and no table. An object starting with bucket_time 0 starts full.
+    Updates take no lock: two threads charging the same object at the same
+    instant can lose one charge, which the GIL makes rare.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+    def allow(self, holder, now):
+        """Take one token from holder's bucket
+        Args:
+            now: time.monotonic()
+        Returns:
+            False if the bucket is empty
+        """
+        tokens = holder.bucket_tokens + (now - holder.bucket_time) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        holder.bucket_time = now
+        if tokens < 1:
+            holder.bucket_tokens = tokens
+            return False
+        holder.bucket_tokens = tokens - 1
+        return True
@@ -0,0 +1,331 @@
+"""
+# Room state backends
+The backend is the authority on which rooms exist, who owns them and which
+node serves each member, so several server nodes can serve the same rooms.
+Each node keeps its own members, their addresses and the room history in
+its RoomRegistry and only asks the backend when that local cache misses.
+Every backend implements:
+    create_room(room_name, owner_token, node, version) -> True if created
+    join(room_name, token, node, version) -> (owner_token, owner_node, owner_version), None if refused
+    leave(room_name, token) -> (left, room_deleted)
+    claim(token, node): node serves the member from now on
+    refresh(room_name, token, new_token) -> True if the member's token is new_token now
+    member(token) -> (room_name, node, version), None if unknown
+    room(room_name) -> (owner_token, owner_node, owner_version), None if unknown
+    room_nodes(room_name) -> nodes serving members of the room
+    register_node(node, address), nodes() -> {node: relay address}
+    subscribe(callback): callback(event, room_name, token, node) after every change
+        'leave': token left the room
+        'delete': the room was deleted with all its members
+        'moved': node serves token from now on
+        'refresh': token is replaced, the new token comes in place of node
+        'nodes': room_nodes(room_name) changed
+    close()
+LocalBackend answers from the RoomRegistry of a single node, which is then
+the only copy of the state. MemoryBackend keeps the state of every node in
+a state_server.py, and RemoteBackend asks that state server over TCP, a
+stand-in for a networked store.
+"""
+import json
+import logging
+import socket
+import threading
+
+logger = logging.getLogger('chat.backend')
+
+class BackendError(Exception):
+    """The state server failed a request"""
+
+class LocalBackend:
+    """Room state of a node that shares it with no other, read from its RoomRegistry
+    The server changes the registry itself, so there is nothing to keep in
+    step and no events to publish.
+    """
+    shared = False
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.node_addresses = {}
+
+    def create_room(self, room_name, owner_token, node, version):
+        # The registry refuses a room created since, and a token it knows
+        return room_name not in self.registry and self.registry.member_for_token(owner_token) is None
+
+    def join(self, room_name, token, node, version):
+        return self.room(room_name)
+
+    def leave(self, room_name, token):
+        return True, room_name not in self.registry
+
+    def claim(self, token, node):
+        pass
+
+    def refresh(self, room_name, token, new_token):
+        return (self.registry.member(room_name, token) is not None
+                and self.registry.member_for_token(new_token) is None)
+
+    def member(self, token):
+        member = self.registry.member_for_token(token)
+        return (member.room_name, member.node, member.version) if member is not None else None
+
+    def room(self, room_name):
+        owner_token = self.registry.owner(room_name)
+        owner = self.registry.member(room_name, owner_token) if owner_token is not None else None
+        return (owner_token, owner.node, owner.version) if owner is not None else None
+
+    def room_nodes(self, room_name):
+        return list({member.node for member in self.registry.members(room_name)})
+
+    def restore_room(self, room_name, owner_token, members):
+        # Restored into the registry already
+        pass
+
+    def register_node(self, node, address):
+        self.node_addresses[node] = tuple(address)
+
+    def nodes(self):
+        return dict(self.node_addresses)
+
+    def subscribe(self, callback):
+        pass
+
+    def close(self):
+        pass
+
+class MemoryBackend:
+    """Room state of every node, kept by a state_server.py"""
+    # Nodes of other processes can only see the state through a state server
+    shared = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {room_name: [owner_token, {token: None}, {node: members served}]}
+        self.rooms = {}
+        # {token: [room_name, node, version]}
+        self.members = {}
+        # {node: relay address}
+        self.node_addresses = {}
+        self.subscribers = []
+
+    def _publish(self, events):
+        for event in events:
+            for callback in self.subscribers:
+                callback(*event)
+
+    def _count(self, room, node, change):
+        """Change the members node serves in room, True if it started or stopped serving it"""
+        counts = room[2]
+        counts[node] = counts.get(node, 0) + change
+        if counts[node] <= 0:
+            del counts[node]
+            return True
+        return counts[node] == 1 and change > 0
+
+    def create_room(self, room_name, owner_token, node, version):
+        with self.lock:
+            if room_name in self.rooms or owner_token in self.members:
+                return False
+            room = self.rooms[room_name] = [owner_token, {owner_token: None}, {}]
+            self.members[owner_token] = [room_name, node, version]
+            self._count(room, node, 1)
+        self._publish([('nodes', room_name, None, None)])
+        return True
+
+    def join(self, room_name, token, node, version):
+        with self.lock:
+            room = self.rooms.get(room_name)
+            if room is None or token in self.members:
+                return None
+            room[1][token] = None
+            self.members[token] = [room_name, node, version]
+            changed = self._count(room, node, 1)
+            _, owner_node, owner_version = self.members[room[0]]
+            owner = (room[0], owner_node, owner_version)
+        if changed:
+            self._publish([('nodes', room_name, None, None)])
+        return owner
+
+    def leave(self, room_name, token):
+        with self.lock:
+            member = self.members.get(token)
+            room = self.rooms.get(room_name)
+            if member is None or room is None or member[0] != room_name:
+                return False, False
+            del self.members[token]
+            del room[1][token]
+            changed = self._count(room, member[1], -1)
+            if token == room[0] or not room[1]:
+                for remaining in room[1]:
+                    del self.members[remaining]
+                del self.rooms[room_name]
+                events = [('delete', room_name, None, None)]
+                room_deleted = True
+            else:
+                events = [('leave', room_name, token, None)]
+                if changed:
+                    events.append(('nodes', room_name, None, None))
+                room_deleted = False
+        self._publish(events)
+        return True, room_deleted
+
+    def claim(self, token, node):
+        with self.lock:
+            member = self.members.get(token)
+            if member is None or member[1] == node:
+                return
+            room = self.rooms[member[0]]
+            changed = self._count(room, member[1], -1)
+            changed = self._count(room, node, 1) or changed
+            member[1] = node
+            events = [('moved', member[0], token, node)]
+            if changed:
+                events.append(('nodes', member[0], None, None))
+        self._publish(events)
+
+    def refresh(self, room_name, token, new_token):
+        with self.lock:
+            member = self.members.get(token)
+            if member is None or member[0] != room_name or new_token in self.members:
+                return False
+            room = self.rooms[room_name]
+            self.members[new_token] = self.members.pop(token)
+            # Keep the members in join order
+            room[1] = {new_token if other == token else other: None for other in room[1]}
+            if room[0] == token:
+                room[0] = new_token
+        self._publish([('refresh', room_name, token, new_token)])
+        return True
+
+    def member(self, token):
+        member = self.members.get(token)
+        return tuple(member) if member is not None else None
+
+    def room(self, room_name):
+        with self.lock:
+            room = self.rooms.get(room_name)
+            if room is None:
+                return None
+            _, owner_node, owner_version = self.members[room[0]]
+            return room[0], owner_node, owner_version
+
+    def room_nodes(self, room_name):
+        room = self.rooms.get(room_name)
+        return list(room[2]) if room is not None else []
+
+    def restore_room(self, room_name, owner_token, members):
+        """Replace what is kept of a room restored from a snapshot, publishing nothing
+        Args:
+            members: list of (token, node, version), None deletes the room
+        """
+        with self.lock:
+            room = self.rooms.pop(room_name, None)
+            if room is not None:
+                for token in room[1]:
+                    self.members.pop(token, None)
+            if members is None:
+                return
+            room = self.rooms[room_name] = [owner_token, {}, {}]
+            for token, node, version in members:
+                room[1][token] = None
+                self.members[token] = [room_name, node, version]
+                self._count(room, node, 1)
+
+    def register_node(self, node, address):
+        self.node_addresses[node] = tuple(address)
+
+    def nodes(self):
+        return dict(self.node_addresses)
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def close(self):
+        self.subscribers = []
+
+class RemoteBackend:
+    """Room state kept by a state_server.py at address
+    Requests are JSON lines over one TCP connection and wait for their
+    answer, events arrive on a second connection read by a daemon thread.
+    """
+    shared = True
+
+    def __init__(self, address):
+        self.address = address
+        self.lock = threading.Lock()
+        self.conn = socket.create_connection(address)
+        self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.conn.makefile('rb')
+        self.events = None
+
+    def call(self, op, *args):
+        """Send one request and wait for its result
+        Raises:
+            BackendError: if the state server failed it or went away
+        """
+        request = json.dumps({'op': op, 'args': args}).encode() + b'\n'
+        with self.lock:
+            try:
+                self.conn.sendall(request)
+                line = self.reader.readline()
+            except OSError as e:
+                raise BackendError(f'State server unreachable: {e}')
+        if not line:
+            raise BackendError('State server closed the connection')
+        response = json.loads(line)
+        if 'error' in response:
+            raise BackendError(response['error'])
+        return response['result']
+
+    def create_room(self, room_name, owner_token, node, version):
+        return self.call('create_room', room_name, owner_token, node, version)
+
+    def join(self, room_name, token, node, version):
+        owner = self.call('join', room_name, token, node, version)
+        return tuple(owner) if owner is not None else None
+
+    def leave(self, room_name, token):
+        return tuple(self.call('leave', room_name, token))
+
+    def claim(self, token, node):
+        self.call('claim', token, node)
+
+    def refresh(self, room_name, token, new_token):
+        return self.call('refresh', room_name, token, new_token)
+
+    def member(self, token):
+        member = self.call('member', token)
+        return tuple(member) if member is not None else None
+
+    def room(self, room_name):
+        room = self.call('room', room_name)
+        return tuple(room) if room is not None else None
+
+    def room_nodes(self, room_name):
+        return self.call('room_nodes', room_name)
+
+    def register_node(self, node, address):
+        self.call('register_node', node, list(address))
+
+    def nodes(self):
+        return {int(node): tuple(address) for node, address in self.call('nodes').items()}
+
+    def subscribe(self, callback):
+        """Call callback for every event from a daemon thread"""
+        self.events = socket.create_connection(self.address)
+        self.events.sendall(json.dumps({'op': 'subscribe', 'args': []}).encode() + b'\n')
+        events = self.events.makefile('rb')
+
+        def read_events():
+            for line in events:
+                try:
+                    callback(*json.loads(line)['event'])
+                except Exception as e:
+                    logger.warning('Error handling backend event: %s', e)
+            logger.warning('State server closed the event stream')
+
+        threading.Thread(target=read_events, daemon=True).start()
+
+    def close(self):
+        for conn in (self.conn, self.events):
+            if conn is not None:
+                conn.close()
@@ -0,0 +1,98 @@
+import bisect
+import threading
+
+# Names per chunk, a chunk is split in two once it holds twice CHUNK_SIZE names
+CHUNK_SIZE = 512
+
+class RoomDirectory:
+    """Room names in sorted order, listed a page at a time
+    The names are kept in sorted chunks of up to 2 * CHUNK_SIZE names. A name
+    is found by bisecting the chunks' first names and then its chunk, so
+    adding or removing one moves at most a chunk's worth of references, and a
+    page of k names after a cursor or under a prefix costs O(log n + k)
+    however many rooms there are, instead of a scan and sort of all of them.
+    """
+
+    def __init__(self, names=()):
+        names = sorted(set(names))
+        self.chunks = [names[start:start + CHUNK_SIZE] for start in range(0, len(names), CHUNK_SIZE)]
+        # First name of every chunk
+        self.firsts = [chunk[0] for chunk in self.chunks]
+        self.size = len(names)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def _chunk_index(self, name):
+        """Index of the chunk name is or would be in"""
+        return max(bisect.bisect_right(self.firsts, name) - 1, 0)
+
+    def add(self, name):
+        """Add name, False if it was there already"""
+        with self.lock:
+            if not self.chunks:
+                self.chunks.append([name])
+                self.firsts.append(name)
+                self.size = 1
+                return True
+            index = self._chunk_index(name)
+            chunk = self.chunks[index]
+            position = bisect.bisect_left(chunk, name)
+            if position < len(chunk) and chunk[position] == name:
+                return False
+            chunk.insert(position, name)
+            self.firsts[index] = chunk[0]
+            self.size += 1
+            if len(chunk) > 2 * CHUNK_SIZE:
+                self.chunks[index:index + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+                self.firsts[index + 1:index + 1] = [chunk[CHUNK_SIZE]]
+            return True
+
+    def discard(self, name):
+        """Remove name, False if it was not there"""
+        with self.lock:
+            if not self.chunks:
+                return False
+            index = self._chunk_index(name)
+            chunk = self.chunks[index]
+            position = bisect.bisect_left(chunk, name)
+            if position == len(chunk) or chunk[position] != name:
+                return False
+            del chunk[position]
+            self.size -= 1
+            if not chunk:
+                del self.chunks[index]
+                del self.firsts[index]
+            else:
+                self.firsts[index] = chunk[0]
+            return True
+
+    def page(self, limit, after=None, prefix=''):
+        """Up to limit names starting with prefix, in order, after the name after if it is given
+        Returns:
+            (names, more): more is True if further names start with prefix
+        """
+        names = []
+        with self.lock:
+            if not self.chunks:
+                return names, False
+            if after is None or after < prefix:
+                index = self._chunk_index(prefix)
+                position = bisect.bisect_left(self.chunks[index], prefix)
+            else:
+                index = self._chunk_index(after)
+                position = bisect.bisect_right(self.chunks[index], after)
+            while index < len(self.chunks):
+                chunk = self.chunks[index]
+                while position < len(chunk):
+                    name = chunk[position]
+                    if not name.startswith(prefix):
+                        return names, False
+                    if len(names) == limit:
+                        return names, True
+                    names.append(name)
+                    position += 1
+                index += 1
+                position = 0
+        return names, False
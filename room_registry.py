@@ -0,0 +1,527 @@
+import itertools
+import threading
+import time
+
+from history import MessageHistory
+from room_directory import RoomDirectory
+from snapshot import OP_BIND, OP_CREATE, OP_DELETE, OP_DETACH, OP_JOIN, OP_LEAVE, OP_REFRESH, iter_members
+
+class Member:
+    """A client in a chatroom"""
+    __slots__ = ('token', 'room_name', 'address', 'version', 'compressed', 'node', 'last_active',
+                 'bucket_tokens', 'bucket_time')
+
+    def __init__(self, token, room_name, address, version, node=0, compressed=False):
+        self.token = token
+        self.room_name = room_name
+        # UDP address the room's messages are sent to, None until the
+        # client's first datagram binds it
+        self.address = address
+        # Protocol version negotiated at join
+        self.version = version
+        # True if the client negotiated compressed messages at join
+        self.compressed = compressed
+        # Server node the client sends its datagrams to
+        self.node = node
+        self.last_active = time.time()
+        # TokenBucket state of the member's rate limit, full until the first datagram
+        self.bucket_tokens = 0.0
+        self.bucket_time = 0.0
+
+    def __repr__(self):
+        return f'Member(token={self.token!r}, room_name={self.room_name!r}, address={self.address!r})'
+
+class Room:
+    """A chatroom, valid while its owner is a member"""
+    __slots__ = ('name', 'owner_token', 'members', 'lock', 'history', 'pending', 'pending_bytes',
+                 'bucket_tokens', 'bucket_time')
+
+    def __init__(self, name, owner_token):
+        self.name = name
+        self.owner_token = owner_token
+        # {token: Member}
+        self.members = {}
+        self.lock = threading.Lock()
+        # MessageHistory of recent frames, allocated with the first message
+        self.history = None
+        # Frames waiting for the room's coalescing window to close
+        self.pending = []
+        self.pending_bytes = 0
+        # TokenBucket state of the room's rate limit
+        self.bucket_tokens = 0.0
+        self.bucket_time = 0.0
+
+class RoomRegistry:
+    """All chatrooms and their members, safe to use from any thread
+    Creating, joining, leaving and binding addresses take the registry lock
+    and then the room's lock. Snapshotting a room for fan-out only takes the
+    room's lock, and validating a token is two dict lookups without a lock,
+    so messages in different rooms never contend.
+    Tokens are unique across rooms.
+    With a shared room backend a node's registry caches the rooms it serves
+    members of: those members, members it looked up, and the owner, served
+    by whichever node Member.node names.
+    Each room keeps its last messages in a MessageHistory of
+    history_capacity bytes and at most history_messages frames, 0 turns
+    history off.
+    A registry restored from a snapshot builds each room from its packed
+    records the first time the room is used, or when restore_some() gets to
+    it, so restoring takes as long as reading the room table. Logged changes
+    to a room not built yet wait for it. The registry lock is reentrant so a
+    room being built can make its changes. Every change is written to the
+    ChangeLog in changes, under the registry lock, in the order the changes
+    are made.
+    Indexes:
+        rooms: {room_name: Room}, room to owner through Room.owner_token
+        tokens: {token: Member}
+        Room.members: {token: Member}
+        addresses: {address: (Member, ...)}, a client in several rooms sends
+            to all of them from one address; the tuple is replaced, never
+            changed, so it is read without the lock
+        directory: RoomDirectory of every room name, built or not, kept in
+            step as rooms are created and deleted
+        restoring: {room_name: (first record, member count)} of rooms not built yet
+    """
+
+    def __init__(self, history_capacity=65536, history_messages=256):
+        self.lock = threading.RLock()
+        self.rooms = {}
+        self.tokens = {}
+        self.addresses = {}
+        self.directory = RoomDirectory()
+        self.history_capacity = history_capacity
+        self.history_messages = history_messages
+        self.changes = None
+        self.restoring = {}
+        self.restore_records = None
+        self.restore_shift = 0.0
+        self.restore_members = 0
+        # {room_name: [change, ...]} logged changes waiting for their room to be built
+        self.restore_changes = {}
+        # on_restore(room, members) is called for every room built from the snapshot, under the lock
+        self.on_restore = None
+
+    def __contains__(self, room_name):
+        return self._room(room_name) is not None
+
+    def __len__(self):
+        return len(self.rooms) + len(self.restoring)
+
+    def room_names(self):
+        return list(self.rooms) + list(self.restoring)
+
+    def member_count(self):
+        return sum(len(room.members) for room in list(self.rooms.values())) + self.restore_members
+
+    def room(self, room_name):
+        """The Room, None if it does not exist"""
+        room = self.rooms.get(room_name)
+        if room is None and self.restoring:
+            room = self._room(room_name)
+        return room
+
+    def owner(self, room_name):
+        """Token of the room's owner, None if the room does not exist"""
+        room = self._room(room_name)
+        return room.owner_token if room else None
+
+    def _room(self, room_name):
+        """The Room, built from the snapshot if it has not been yet"""
+        room = self.rooms.get(room_name)
+        if room is None and self.restoring:
+            with self.lock:
+                room = self._restore_room(room_name)
+        return room
+
+    def _locked_room(self, room_name):
+        """_room() with the lock held"""
+        room = self.rooms.get(room_name)
+        if room is None and self.restoring:
+            room = self._restore_room(room_name)
+        return room
+
+    def restore(self, rooms, records, shift):
+        """Restore the rooms of a snapshot into an empty registry, building none of them yet
+        Args:
+            rooms, records: what snapshot.read_snapshot() read
+            shift: seconds added to every member's last activity, the time the server was down
+        """
+        with self.lock:
+            self.directory = RoomDirectory(itertools.chain(self.rooms, rooms))
+            self.restoring = rooms
+            self.restore_records = records
+            self.restore_shift = shift
+            self.restore_members = sum(count for _, count in rooms.values())
+
+    def _restore_room(self, room_name):
+        room = self.rooms.get(room_name)
+        entry = self.restoring.pop(room_name, None)
+        if room is not None or entry is None:
+            return room
+        first, count = entry
+        members = []
+        for token, version, compressed, node, address, last_active in iter_members(self.restore_records, first, count):
+            member = Member(token, room_name, address, version, node, compressed)
+            member.last_active = last_active + self.restore_shift
+            if room is None:
+                # The owner's record comes first
+                room = Room(room_name, token)
+            room.members[token] = member
+            self._index(member)
+            members.append(member)
+        self.restore_members -= count
+        if not self.restoring:
+            self.restore_records = None
+        if room is None:
+            self.directory.discard(room_name)
+            return None
+        self.rooms[room_name] = room
+        for change in self.restore_changes.pop(room_name, ()):
+            self.apply_change(*change)
+        room = self.rooms.get(room_name)
+        if room is not None and self.on_restore is not None:
+            self.on_restore(room, list(room.members.values()))
+        return room
+
+    def restore_some(self, count):
+        """Build up to count rooms of the snapshot being restored
+        Returns:
+            the number of rooms left to build
+        """
+        with self.lock:
+            for room_name in list(itertools.islice(self.restoring, count)):
+                self._restore_room(room_name)
+            return len(self.restoring)
+
+    def snapshot_rooms(self):
+        """Every room with its members, owner first, for snapshot.write_snapshot()"""
+        while self.restore_some(1024):
+            pass
+        rooms = []
+        for room in list(self.rooms.values()):
+            with room.lock:
+                owner = room.members.get(room.owner_token)
+                if owner is not None:
+                    rooms.append((room.name, [owner] + [member for member in room.members.values()
+                                                        if member is not owner]))
+        return rooms
+
+    def swap_changes(self, changes):
+        """Write changes to the ChangeLog changes from now on
+        Returns:
+            the ChangeLog written to until now
+        """
+        with self.lock:
+            previous = self.changes
+            self.changes = changes
+            return previous
+
+    def apply_change(self, op, room_name, token, version, node, address, compressed=False, new_token=None):
+        """Make a change read from a change log again, a change already made is skipped
+        Returns:
+            False if the change waits for its room to be built from the snapshot
+        """
+        with self.lock:
+            if room_name in self.restoring:
+                self.restore_changes.setdefault(room_name, []).append(
+                    (op, room_name, token, version, node, address, compressed, new_token))
+                return False
+        if op == OP_CREATE:
+            self.create_room(room_name, token, address, version, node, compressed)
+        elif op == OP_JOIN:
+            self.join(room_name, token, address, version, node, compressed)
+        elif op == OP_LEAVE:
+            self.leave(room_name, token)
+        elif op == OP_BIND:
+            member = self.member(room_name, token)
+            if member is not None:
+                self.bind_address(member, address)
+        elif op == OP_DELETE:
+            self.delete_room(room_name)
+        elif op == OP_DETACH:
+            self.detach(token, node)
+        elif op == OP_REFRESH:
+            self.refresh_token(room_name, token, new_token)
+        return True
+
+    def create_room(self, room_name, owner_token, owner_address, version, node=0, compressed=False):
+        """Create a room with its owner as the first member
+        Returns:
+            the owner's Member, None if the room already exists or the token is taken
+        """
+        with self.lock:
+            if self._locked_room(room_name) is not None or owner_token in self.tokens:
+                return None
+            room = Room(room_name, owner_token)
+            owner = Member(owner_token, room_name, owner_address, version, node, compressed)
+            room.members[owner_token] = owner
+            self.rooms[room_name] = room
+            self.directory.add(room_name)
+            self._index(owner)
+            if self.changes is not None:
+                self.changes.record(OP_CREATE, room_name, owner_token, version, node, owner_address, compressed)
+            return owner
+
+    def join(self, room_name, token, address, version, node=0, compressed=False):
+        """Add a member to a valid room
+        Returns:
+            the new Member, None if the room is not valid or the token is taken
+        """
+        with self.lock:
+            room = self._locked_room(room_name)
+            if room is None or token in self.tokens:
+                return None
+            with room.lock:
+                if room.owner_token not in room.members:
+                    return None
+                member = Member(token, room_name, address, version, node, compressed)
+                room.members[token] = member
+            self._index(member)
+            if self.changes is not None:
+                self.changes.record(OP_JOIN, room_name, token, version, node, address, compressed)
+            return member
+
+    def leave(self, room_name, token):
+        """Remove a member, and the room if the owner left or it became empty
+        Returns:
+            (member, room_deleted), member is None if it was not in the room
+        """
+        with self.lock:
+            room = self._locked_room(room_name)
+            if room is None:
+                return None, False
+            with room.lock:
+                member = room.members.pop(token, None)
+                if member is None:
+                    return None, False
+                self._unindex(member)
+                if self.changes is not None:
+                    self.changes.record(OP_LEAVE, room_name, token)
+                room_deleted = token == room.owner_token or not room.members
+                if room_deleted:
+                    for remaining in room.members.values():
+                        self._unindex(remaining)
+                    room.members.clear()
+            if room_deleted:
+                del self.rooms[room_name]
+                self.directory.discard(room_name)
+            return member, room_deleted
+
+    def delete_room(self, room_name):
+        """Remove a room with all its members
+        Returns:
+            the members removed
+        """
+        with self.lock:
+            room = self._locked_room(room_name)
+            if room is None:
+                return []
+            del self.rooms[room_name]
+            self.directory.discard(room_name)
+            if self.changes is not None:
+                self.changes.record(OP_DELETE, room_name)
+            with room.lock:
+                members = list(room.members.values())
+                for member in members:
+                    self._unindex(member)
+                room.members.clear()
+            return members
+
+    def detach(self, token, node):
+        """Record that node serves the member now and stop sending to it from here
+        Returns:
+            the Member, None if it is not in a room
+        """
+        with self.lock:
+            member = self.tokens.get(token)
+            if member is None:
+                return None
+            self._unindex_address(member)
+            member.address = None
+            member.node = node
+            if self.changes is not None:
+                self.changes.record(OP_DETACH, member.room_name, token, node=node)
+            return member
+
+    def refresh_token(self, room_name, token, new_token):
+        """Replace a member's token with new_token, the member keeps its address and history
+        Returns:
+            the Member, None if it is not in the room or new_token is taken
+        """
+        with self.lock:
+            room = self._locked_room(room_name)
+            if room is None or new_token in self.tokens:
+                return None
+            with room.lock:
+                member = room.members.pop(token, None)
+                if member is None:
+                    return None
+                del self.tokens[token]
+                member.token = new_token
+                room.members[new_token] = member
+                self.tokens[new_token] = member
+                if room.owner_token == token:
+                    room.owner_token = new_token
+            if self.changes is not None:
+                self.changes.record(OP_REFRESH, room_name, token, new_token=new_token)
+            return member
+
+    def bind_address(self, member, address):
+        """Send the member's messages to address from now on"""
+        with self.lock:
+            if self.tokens.get(member.token) is not member:
+                return
+            self._unindex_address(member)
+            member.address = address
+            self._index_address(member)
+            if self.changes is not None:
+                self.changes.record(OP_BIND, member.room_name, member.token, address=address)
+
+    def _index(self, member):
+        self.tokens[member.token] = member
+        if member.address is not None:
+            self._index_address(member)
+
+    def _index_address(self, member):
+        self.addresses[member.address] = self.addresses.get(member.address, ()) + (member,)
+
+    def _unindex(self, member):
+        if self.tokens.get(member.token) is member:
+            del self.tokens[member.token]
+        self._unindex_address(member)
+
+    def _unindex_address(self, member):
+        members = self.addresses.get(member.address) if member.address is not None else None
+        if members is not None and member in members:
+            members = tuple(other for other in members if other is not member)
+            if members:
+                self.addresses[member.address] = members
+            else:
+                del self.addresses[member.address]
+
+    def is_valid(self, room_name):
+        """Check if the room exists and its owner is still a member"""
+        room = self.room(room_name)
+        if room is None:
+            return False
+        with room.lock:
+            return room.owner_token in room.members
+
+    def validate(self, room_name, token):
+        """Member for the token if the room is valid and the token is in it, else None
+        The token is found by hash in the token index, one lookup whatever the
+        number of rooms and members.
+        """
+        member = self.tokens.get(token)
+        if member is None and self.restoring and self._room(room_name) is not None:
+            member = self.tokens.get(token)
+        if member is None or member.room_name != room_name:
+            return None
+        room = self.rooms.get(room_name)
+        if room is None or room.owner_token not in room.members:
+            return None
+        return member
+
+    def member(self, room_name, token):
+        member = self.tokens.get(token)
+        if member is None and self.restoring and self._room(room_name) is not None:
+            member = self.tokens.get(token)
+        if member is None or member.room_name != room_name:
+            return None
+        return member
+
+    def member_for_token(self, token):
+        return self.tokens.get(token)
+
+    def member_for_address(self, address):
+        """The member bound to address, None if none or several are"""
+        members = self.addresses.get(address)
+        if members is None or len(members) != 1:
+            return None
+        return members[0]
+
+    def room_page(self, limit, after=None, prefix=''):
+        """A page of the directory with the member count of each room, see RoomDirectory.page
+        Rooms not built from the snapshot yet are counted from its room table.
+        Returns:
+            ([(room_name, member_count), ...], more)
+        """
+        names, more = self.directory.page(limit, after, prefix)
+        rooms = []
+        for room_name in names:
+            room = self.rooms.get(room_name)
+            if room is not None:
+                rooms.append((room_name, len(room.members)))
+                continue
+            entry = self.restoring.get(room_name)
+            # Deleted since the page was read
+            if entry is not None:
+                rooms.append((room_name, entry[1]))
+        return rooms, more
+
+    def members(self, room_name):
+        """Snapshot of the room's members, safe to iterate while others leave"""
+        room = self.room(room_name)
+        if room is None:
+            return []
+        with room.lock:
+            return list(room.members.values())
+
+    def append_history(self, room_name, frame):
+        """Keep frame in the room's history
+        Returns:
+            the frame's sequence number, None if the room does not exist or history is off
+        """
+        room = self.rooms.get(room_name)
+        if room is None or not self.history_capacity or not self.history_messages:
+            return None
+        with room.lock:
+            if room.history is None:
+                room.history = MessageHistory(self.history_capacity, self.history_messages)
+            return room.history.append(frame)
+
+    def history(self, room_name, count=None, since=None):
+        """The room's last count frames, or the (first count) frames after sequence number since
+        Returns:
+            list of (seq, frame), oldest first
+        """
+        room = self.rooms.get(room_name)
+        if room is None:
+            return []
+        with room.lock:
+            if room.history is None:
+                return []
+            if since is not None:
+                return room.history.since(since, count)
+            return room.history.last(count)
+
+    def add_pending(self, room_name, frame):
+        """Queue frame until the room's coalesced frames are sent
+        Returns:
+            (frames, bytes) queued with frame, None if the room does not exist
+        """
+        room = self.rooms.get(room_name)
+        if room is None:
+            return None
+        with room.lock:
+            room.pending.append(frame)
+            room.pending_bytes += len(frame)
+            return len(room.pending), room.pending_bytes
+
+    def take_pending(self, room_name):
+        """The frames queued by add_pending, oldest first, leaving none queued"""
+        room = self.rooms.get(room_name)
+        if room is None:
+            return []
+        with room.lock:
+            frames = room.pending
+            room.pending = []
+            room.pending_bytes = 0
+            return frames
+
+    def last_seq(self, room_name):
+        """Sequence number of the room's latest message, 0 before the first one"""
+        room = self.rooms.get(room_name)
+        if room is None or room.history is None:
+            return 0
+        return room.history.next_seq - 1
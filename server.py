@@ -1,243 +1,1127 @@
+import argparse
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import os
+import queue
 import socket
 import threading
 import time
 import signal
 import sys
 import hashlib
-# {'roomname': {'token': last_active_time}}
-# if room owner : token = client port number
-# if joiner : token = hash(room_name) % 65535
-chatrooms = {}
-# Store owner information: {'roomname': owner_token}
-room_owners = {}
+import secrets
+
+import batch_io
+import logs
+import snapshot
+import worker_ipc
+from buffer_pool import BufferPool
+from compression import Codec, load_dictionary
+from pipeline import DROP_POLICIES, BoundedQueue
+from expiry import TimingWheel
+from metrics import MetricsRegistry, serve_metrics, start_snapshots
+from rate_limit import TokenBucket
+from room_backend import BackendError, LocalBackend, RemoteBackend
+from room_registry import RoomRegistry
+from wire import (CAPABILITY_COMPRESSION, FLAG_ACK, FLAG_BATCH, FLAG_COMPRESSED, FLAG_NACK, FLAG_RETRANSMIT,
+                  MAX_ROOM_PAGE, PACKET_SIZE, PROTOCOL_V1, PROTOCOL_V2, PROTOCOL_V3, ROOM_PAGE_SIZE,
+                  SUPPORTED_VERSIONS, TCP_HEADER_SIZE, V3_HEADER, V3_HEADER_SIZE, VERSION_MASK, BATCH_FRAME,
+                  build_ack_packet, build_error_packet, build_tcp_packet, error_packet, pack_history, pack_room_list,
+                  pack_udp_packet_into, parse_tcp_header, parse_udp_packet, parse_v3_header, split_nack,
+                  split_room_list, success_packet, udp_packet_size, with_request_id)
+
+logger = logging.getLogger('chat.server')
+
+# All chatrooms, their owners and members
+# every member gets its own random token, unique across rooms
+registry = RoomRegistry()
+# Random bytes in a token, sent as 2 hex characters each
+TOKEN_BYTES = 16
+
+# Room state shared between server nodes (--state-server, --node-id, --relay-address)
+# The backend decides which rooms exist and which node serves each member,
+# registry caches this node's part of it and the backend's events keep it fresh.
+# Without a state server the registry is the only copy and the backend reads it
+backend = LocalBackend(registry)
+node_id = 0
+# UDP socket messages are relayed to and from other nodes on, None without a state server
+relay_socket = None
+# Thread TCP requests are carried out on with a state server, whose calls block on the network;
+# one thread, so requests are carried out one at a time as on the event loop
+backend_executor = None
+# {room_name: [node, ...]} other nodes serving members of a room, dropped by the room's events
+room_nodes = {}
+# Events handled so far, a room_nodes answer older than the last event is not cached
+backend_events = 0
+# {node: relay address} of every node, reloaded when a node or relay peer is unknown
+node_addresses = {}
+NODE_REFRESH_INTERVAL = 1.0
+nodes_refreshed = 0.0
+nodes_lock = threading.Lock()
+# {token: time.monotonic() deadline} tokens the backend did not know, not asked again until then
+unknown_tokens = {}
+UNKNOWN_TOKEN_TTL = 1.0
+MAX_UNKNOWN_TOKENS = 65536
+
+# Instrumentation, served on --metrics-port and logged every --metrics-interval seconds
+metrics = MetricsRegistry()
+udp_received = metrics.counter('chat_udp_packets_received_total', 'UDP datagrams received')
+udp_sent = metrics.counter('chat_udp_packets_sent_total', 'UDP datagrams sent to room members')
+udp_rejected = metrics.counter('chat_udp_packets_rejected_total', 'UDP datagrams with an invalid room or token')
+udp_send_errors = metrics.counter('chat_udp_send_errors_total', 'UDP datagrams dropped because sending failed')
+udp_member_limited = metrics.counter('chat_udp_member_rate_limited_total', 'UDP datagrams dropped by a member\'s rate limit')
+udp_room_limited = metrics.counter('chat_udp_room_rate_limited_total', 'Messages dropped by a room\'s rate limit')
+udp_nacks = metrics.counter('chat_udp_nacks_total', 'NACKs received from v3 clients')
+udp_retransmitted = metrics.counter('chat_udp_retransmitted_total', 'Messages sent again after a NACK')
+udp_coalesced = metrics.counter('chat_udp_messages_coalesced_total', 'Messages held for a room\'s coalescing window')
+udp_batches = metrics.counter('chat_udp_batches_total', 'Batch packets built from coalesced messages')
+udp_compressed = metrics.counter('chat_udp_packets_compressed_total', 'Packets compressed for members that negotiated compression')
+relay_sent = metrics.counter('chat_relay_packets_sent_total', 'Messages relayed to other nodes')
+relay_received = metrics.counter('chat_relay_packets_received_total', 'Messages relayed from other nodes')
+backend_lookups = metrics.counter('chat_backend_lookups_total', 'Tokens the local registry missed and the backend was asked for')
+metrics.gauge('chat_rooms', 'Chatrooms', lambda: len(registry))
+metrics.gauge('chat_members', 'Members of every chatroom', lambda: registry.member_count())
+parse_latency = metrics.histogram('chat_udp_parse_seconds', 'Time to parse a UDP packet header')
+validate_latency = metrics.histogram('chat_udp_validate_seconds', 'Time to validate a UDP packet\'s room and token')
+fanout_latency = metrics.histogram('chat_udp_fanout_seconds', 'Time to send a UDP message to its room')
+join_latency = metrics.histogram('chat_tcp_join_seconds', 'Time to create or join a chatroom over TCP')
+queue_latency = metrics.histogram('chat_udp_queue_wait_seconds', 'Time a datagram waits for a handler thread')
+metrics.gauge('chat_udp_queue_depth', 'Datagrams waiting for a handler thread', lambda: len(udp_queue or ()))
+metrics.gauge('chat_udp_queue_dropped_total', 'Datagrams dropped by the full handler queue',
+              lambda: udp_queue.dropped if udp_queue else 0)
+
+# Warm restart (--state-dir, --snapshot-interval): the registry is snapshotted to state_dir
+# every snapshot_interval seconds and every change in between goes to a change log,
+# flushed every CHANGES_FLUSH_INTERVAL seconds; both are restored at startup
+state_dir = None
+snapshot_interval = 60.0
+CHANGES_FLUSH_INTERVAL = 1.0
+# Snapshot rooms built per step by the background restore, the handlers get the GIL between steps
+RESTORE_BATCH = 64
+
+# Members inactive for longer than inactive_threshold seconds leave their room,
+# checked every expiry_granularity seconds (--inactive-threshold, --expiry-granularity)
+inactive_threshold = 180
+expiry_granularity = 1.0
+# Members keyed on last_active + inactive_threshold
+expiry_wheel = TimingWheel(inactive_threshold, expiry_granularity, time.time())
+
+# Rate limits (--member-rate, --member-burst, --room-rate, --room-burst), None is unlimited
+# datagrams/sec a member may send, checked on its address before anything is decoded
+member_limit = None
+# messages/sec a room may forward, so one member cannot flood every other member
+room_limit = None
+
+# Protocol versions, flags and the framing of every packet are in wire.py
+# ForwardPackets key of the v3 packet for members that negotiated compression
+COMPRESSED_V3 = PROTOCOL_V3 | CAPABILITY_COMPRESSION
+# Messages sent again for one NACK at most
+MAX_RETRANSMIT = 64
+
+# Coalescing (--coalesce-ms, --coalesce-bytes): a room's messages for v3 members
+# are held for coalesce_window seconds and sent together in FLAG_BATCH packets
+# of at most coalesce_bytes, 0 sends every message on its own
+coalesce_window = 0.0
+coalesce_bytes = 1400
+
+# Compression (--compression, --compression-dictionary): v3 clients that ask for it at
+# join get messages compressed by codec, once per message for all of them; None is off
+codec = None
+
+# Receive buffers reused by the threaded UDP engine, sized for its queue when it starts
+buffer_pool = BufferPool(256, PACKET_SIZE)
+# Datagrams received per recvmmsg call by the threaded UDP engine
+RECV_BATCH = 32
+
+# The threaded UDP engine is a pipeline of stages joined by bounded queues:
+#   receive thread -> udp_queue -> handler threads (validate + fan-out) -> send_queue -> send thread
+# (--queue-depth, --drop-policy, --handler-threads, --send-queue-depth)
+# A full udp_queue drops by drop_policy, a full send_queue blocks the handlers
+# until the send thread catches up, which in turn fills udp_queue
+udp_queue_depth = 1024
+drop_policy = 'drop-newest'
+handler_threads = 4
+send_queue_depth = 64
+# The queues, None in asyncio mode where the event loop does every stage
+udp_queue = None
+send_queue = None
+# Smallest fan-out sent with sendmmsg, setting up the batch costs more than it saves below this
+SEND_BATCH_MIN = 64
+
+# Operations whose State is the protocol version the client asks for
+VERSIONED_OPERATIONS = (0, 3, 7, 9, 10, 11, 13)
+# Operations that make a client a member of a room
+JOIN_OPERATIONS = (0, 9, 10)
+# Largest request frame accepted, a v1 request is padded up to exactly this
+MAX_TCP_REQUEST_SIZE = PACKET_SIZE
+# TCP server limits (--tcp-backlog, --max-connections, --tcp-timeout, --control-timeout)
+# connections the kernel queues before they are accepted, capped by net.core.somaxconn
+tcp_backlog = 4096
+# connections served at once, more are refused with an error frame
+max_tcp_connections = 10000
+# seconds a connection may take to send a request frame before it is closed
+tcp_timeout = 10.0
+# seconds a control channel, a connection that sent RequestIds, may stay idle (--control-timeout)
+control_timeout = 300.0
+# requests of one connection being answered at once, it is not read further until one is done
+MAX_PIPELINED = 256
+# connections being served, only touched on the TCP event loop
+tcp_connections = 0
+
+# Multi-worker mode (--workers): every worker owns the rooms room_worker()
+# maps to it, channels carries datagrams and joins for other rooms to their owner
+workers = 1
+worker_id = 0
+channels = None
+# Worker processes, only set in the parent
+worker_pids = []
+# {request_id: future} TCP requests waiting for the owning worker's reply
+pending_requests = {}
+request_ids = itertools.count()
+# Inbox messages handled per wake-up, so a flood does not starve the event loop
+INBOX_BATCH = 64
 
 # Global socket variables for cleanup
 sock_tcp = None
 sock = None
+# The bound UDP socket, sock is its asyncio transport in asyncio mode
+udp_socket = None
+
+# UDP engines selectable with --mode
+SERVER_MODES = ('threaded', 'asyncio')
+# Set once cleanup_resources has run, so a second call does nothing
+cleaned_up = False
 
 def cleanup_resources():
-    """Clean up all resources before server shutdown"""
-    print("\nCleaning up resources...")
+    """Clean up all resources before server shutdown, once however often it is called"""
+    global cleaned_up
+    if cleaned_up:
+        return
+    cleaned_up = True
+    logger.info("Cleaning up resources...")
     
     # Close TCP socket
     if sock_tcp:
         try:
             sock_tcp.close()
-            print("TCP socket closed")
+            logger.info("TCP socket closed")
         except Exception as e:
-            print(f"Error closing TCP socket: {e}")
+            logger.error("Error closing TCP socket: %s", e)
     
     # Close UDP socket
     if sock:
         try:
             sock.close()
-            print("UDP socket closed")
+            logger.info("UDP socket closed")
         except Exception as e:
-            print(f"Error closing UDP socket: {e}")
-    
-    sys.exit(0)
+            logger.error("Error closing UDP socket: %s", e)
+
+    # The change log has every change since the last snapshot
+    if registry.changes:
+        try:
+            registry.changes.flush(sync=True)
+        except Exception as e:
+            logger.error("Error flushing the change log: %s", e)
+
+    # Leave the state server and the other nodes
+    if relay_socket:
+        backend_executor.shutdown(wait=False)
+        backend.close()
+        relay_socket.close()
+
+    # Stop the workers
+    for pid in worker_pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    # Write out what is still queued
+    logs.stop_logging()
 
 def signal_handler(sig, frame):
-    """Handle Ctrl+C signal"""
-    print("\nShutting down server...")
-    cleanup_resources()
+    """Handle Ctrl+C signal
+    Unwinds the main thread, the finally around serve cleans up. In asyncio
+    mode the event loop handles the signals instead, see serve_asyncio.
+    """
+    logger.info("Shutting down server...")
+    sys.exit(0)
 
 # Register signal handler
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
-def process_message(data):
-    # data = usernamelen(1byte) + username + message + filler(0x00) = 4096bytes
-    username_length = data[0]
-    username = data[1:username_length + 1]
-    message = data[username_length + 1:4096]
-    return username, message
-
-def display_message(data):
-    # display message to user
-    username, message = process_message(data)
-    print(f'username: {username.decode()}')
-    print(f'message: {message.decode()}')
-
-def recv_client_message():
-    # receive message from client
-    # data = usernamelen(1byte) + username + message + filler(0x00) = 4096bytes
-    data, address = sock.recvfrom(4096)
-    return data, address
-
-def send_message_to_clients(data, sender_token, room_name):
+def send_message_to_clients(frames, sender_token, room_name, skip_version=None):
+    """Send a message to every client in the room except the sender
+    Args:
+        frames: {protocol_version: packet} the same message built for each version
+        sender_token: token of the client that sent the message
+        room_name: room name
+        skip_version: protocol version of members not to send to, their copy is coalesced
+    """
     if not is_valid_chatroom(room_name):
         return False
     
-    current_time = time.time()
+    tokens = []
+    packets = []
+    for member in registry.members(room_name):
+        # Members that have not sent their first datagram have no address yet
+        if member.token != sender_token and member.address is not None and member.version != skip_version:
+            packets.append((frames[COMPRESSED_V3 if member.compressed else member.version], member.address))
+            tokens.append(member.token)
+    send_to_members(room_name, packets, tokens)
+    return True
+
+def send_to_members(room_name, packets, tokens):
+    """Send (data, address) packets, tokens[i] is the member packets[i] goes to
+    Members a packet cannot be sent to leave the room. With a send stage the
+    packets are queued for the send thread, waiting while its queue is full.
+    """
+    if send_queue is not None:
+        send_queue.put((room_name, packets, tokens))
+    else:
+        deliver_to_members(room_name, packets, tokens)
+
+def deliver_to_members(room_name, packets, tokens):
+    """send_to_members on the calling thread"""
     inactive_tokens = []
-    
-    for token, last_active in list(chatrooms[room_name].items()):
-        if token != sender_token:
-            try:
-                # Here we need to map token back to actual UDP address for sending
-                # This might need to be handled differently depending on your requirements
-                target_port = int(token)
-                sock.sendto(data, ('0.0.0.0', target_port))
-                print(f'Sent message to client with token {token}')
-            except Exception as e:
-                print(f'Error sending message to client with token {token}: {e}')
-                inactive_tokens.append(token)
+    for index, e in send_packets(packets):
+        logger.warning('Error sending message to client with token %s: %s', tokens[index], e)
+        inactive_tokens.append(tokens[index])
+    udp_sent.inc(len(packets) - len(inactive_tokens))
+    if inactive_tokens:
+        udp_send_errors.inc(len(inactive_tokens))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Sent message to %d clients in chatroom %s', len(packets) - len(inactive_tokens), room_name)
     
     for token in inactive_tokens:
         leave_chatroom(room_name, token)
-    
+
+def send_packets(packets):
+    """Send every (data, address) in packets with as few syscalls as possible
+    Uses sendmmsg where available and falls back to one sendto per packet.
+    Returns:
+        list of (index, exception) for the packets that could not be sent
+    """
+    failures = []
+    sent = 0
+    if batch_io.BATCH_AVAILABLE and udp_socket is not None and len(packets) >= SEND_BATCH_MIN:
+        try:
+            sent, failures = batch_io.send_batch(udp_socket.fileno(), packets)
+        except ValueError:
+            # IPv6 or otherwise unsupported address, send one by one
+            sent = 0
+    # Packets the batch did not get to, e.g. when the asyncio socket would block
+    for index in range(sent, len(packets)):
+        data, address = packets[index]
+        try:
+            sock.sendto(data, address)
+        except Exception as e:
+            failures.append((index, e))
+    return failures
+
+def configure_rate_limits(member_rate, member_burst, room_rate, room_burst):
+    """Set the member and room token buckets, a rate of 0 is unlimited"""
+    global member_limit, room_limit
+    member_limit = TokenBucket(member_rate, member_burst) if member_rate else None
+    room_limit = TokenBucket(room_rate, room_burst) if room_rate else None
+
+def over_rate_limit(address):
+    """Check if the member sending from address is over its rate limit
+    This is the early drop: one dict lookup on the address, nothing is decoded
+    or logged. Datagrams from an address no member is bound to, or several
+    are (a client in many rooms), pass and are charged once validated.
+    """
+    if member_limit is None:
+        return False
+    member = registry.member_for_address(address)
+    if member is None or member_limit.allow(member, time.monotonic()):
+        return False
+    udp_member_limited.inc()
     return True
 
-def handle_client(data, address):
-    try:
-        # Display received message
-        display_message(data)
-        # Update last active time for the client
-        chatrooms[room_name][address] = time.time()
-        # Broadcast message to other clients
-        send_message_to_clients(data, address, room_name)
-    except Exception as e:
-        print(f'Error handling client {address}: {e}')
-        if address in chatrooms[room_name]:
-            del chatrooms[room_name][address]
+def configure_coalescing(window, max_bytes):
+    """Set the coalescing window in seconds, 0 turns it off, and the size of a batch packet"""
+    global coalesce_window, coalesce_bytes
+    coalesce_window = window
+    coalesce_bytes = max_bytes
 
-def cleanup_clients():
+def configure_compression(enabled, dictionary_path=None):
+    """Offer compression to v3 clients, primed with the dictionary in dictionary_path if given"""
+    global codec
+    if dictionary_path:
+        codec = Codec(load_dictionary(dictionary_path))
+    elif enabled:
+        codec = Codec()
+    else:
+        codec = None
+
+def configure_history(capacity, max_messages):
+    """Set how many bytes and messages of history each room keeps, before rooms are created"""
+    registry.history_capacity = capacity
+    registry.history_messages = max_messages
+
+def configure_expiry(threshold, granularity):
+    """Set the inactivity threshold and how often expiry runs, before members join"""
+    global inactive_threshold, expiry_granularity, expiry_wheel
+    inactive_threshold = threshold
+    expiry_granularity = granularity
+    expiry_wheel = TimingWheel(threshold, granularity, time.time())
+
+def schedule_expiry(member):
+    expiry_wheel.schedule(member, member.last_active + inactive_threshold)
+
+def expire_clients(current_time):
+    """Remove the members whose expiry came due and who stayed inactive
+    Only members in the due wheel slots are looked at. Members that were
+    active since they were scheduled are rescheduled from their last activity.
+    Returns:
+        number of members that left
+    """
+    expired = 0
+    for member in expiry_wheel.advance(current_time):
+        # Skip members that already left or whose room was deleted
+        if registry.member(member.room_name, member.token) is not member:
+            continue
+        if current_time - member.last_active > inactive_threshold:
+            leave_chatroom(member.room_name, member.token)
+            expired += 1
+        else:
+            schedule_expiry(member)
+    return expired
+
+def restore_state(directory):
+    """Restore the registry from the snapshot and change logs in directory and start saving it there
+    Only the snapshot's room table is read before serving starts, a room is
+    built when it is first used or by the background restore thread. The
+    time the server was down does not count as inactivity.
+    """
+    global state_dir
+    state_dir = directory
+    os.makedirs(directory, exist_ok=True)
+    started = time.perf_counter()
+    registry.on_restore = restored_room
+    loaded = snapshot.read_snapshot(directory)
+    generation = 0
+    if loaded is not None:
+        generation, saved_at, rooms, records = loaded
+        registry.restore(rooms, records, max(time.time() - saved_at, 0.0))
+    restored = time.perf_counter()
+    changed_rooms = set()
+    generations = [number for number in snapshot.change_generations(directory) if number >= generation]
+    for number in generations:
+        for change in snapshot.read_changes(directory, number):
+            if registry.apply_change(*change):
+                changed_rooms.add(change[1])
+    # Rooms the snapshot does not have are made by the changes alone,
+    # bring the backend and the expiry wheel up to date with them
+    for room_name in changed_rooms:
+        room = registry.room(room_name)
+        restored_room(room, registry.members(room_name), room_name)
+    registry.swap_changes(snapshot.ChangeLog(directory, max([generation] + generations) + 1))
+    logger.info('Restored %d rooms and %d members in %.1f ms, replayed %d change logs in %.1f ms',
+                len(registry), registry.member_count(), (restored - started) * 1e3,
+                len(generations), (time.perf_counter() - restored) * 1e3)
+    threading.Thread(target=restore_rooms, daemon=True).start()
+    threading.Thread(target=save_state, daemon=True).start()
+
+def restored_room(room, members, room_name=None):
+    """Hand a room rebuilt from saved state to the backend and schedule its members' expiry
+    A room the change logs deleted is passed as None with its room_name.
+    """
+    if room is None:
+        backend.restore_room(room_name, None, None)
+        return
+    backend.restore_room(room.name, room.owner_token,
+                         [(member.token, member.node, member.version) for member in members])
+    for member in members:
+        schedule_expiry(member)
+
+def restore_rooms():
+    """Build the snapshot's rooms no client has used yet, a few at a time"""
+    started = time.perf_counter()
+    while registry.restore_some(RESTORE_BATCH):
+        time.sleep(0)
+    logger.info('Built every restored room in %.1f s', time.perf_counter() - started)
+
+def save_state():
+    """Flush the change log every second and snapshot the registry every snapshot_interval seconds"""
+    last_snapshot = time.monotonic()
     while True:
-        print('Cleaning up inactive clients...')
-        current_time = time.time()
-        inactive_threshold = 180
-
-        for room_name, clients in list(chatrooms.items()):
-            inactive_clients = []
-            for client, last_active in list(clients.items()):
-                if current_time - last_active > inactive_threshold:
-                    inactive_clients.append(client)
-            
-            for client in inactive_clients:
-                leave_chatroom(room_name, client)
+        time.sleep(CHANGES_FLUSH_INTERVAL)
+        try:
+            if time.monotonic() - last_snapshot < snapshot_interval:
+                registry.changes.flush()
+                continue
+            write_state_snapshot()
+            last_snapshot = time.monotonic()
+        except Exception as e:
+            logger.error('Error saving the registry to %s: %s', state_dir, e)
 
-        time.sleep(60)
+def write_state_snapshot():
+    """Snapshot the registry and delete the change logs it holds
+    Changes are logged to a new change log from before the snapshot starts,
+    so nothing made while it is written is lost.
+    """
+    started = time.perf_counter()
+    changes = snapshot.ChangeLog(state_dir, registry.changes.generation + 1)
+    registry.swap_changes(changes).close()
+    rooms = registry.snapshot_rooms()
+    snapshot.write_snapshot(state_dir, changes.generation, rooms)
+    for generation in snapshot.change_generations(state_dir):
+        if generation < changes.generation:
+            os.remove(snapshot.changes_path(state_dir, generation))
+    logger.info('Snapshot of %d rooms written in %.1f ms', len(rooms), (time.perf_counter() - started) * 1e3)
+
+def cleanup_clients():
+    while True:
+        time.sleep(expiry_granularity)
+        expired = expire_clients(time.time())
+        if expired:
+            logger.info('Cleaned up %d inactive clients', expired)
 
 def is_valid_chatroom(room_name):
     """Check if chatroom exists and owner is still active"""
-    if room_name not in chatrooms or room_name not in room_owners:
-        return False
-    owner_token = room_owners[room_name]
-    return owner_token in chatrooms[room_name]
+    return registry.is_valid(room_name)
 
 def validate_client_token(room_name, token):
     """Check if client has valid token for the room"""
-    if not is_valid_chatroom(room_name):
-        return False
     # Token should match a valid token in the chatroom
-    return token in chatrooms[room_name]
-
-def create_chatroom(room_name, owner_address):
-    if room_name not in chatrooms:
-        chatrooms[room_name] = {}
-        # Generate owner's token from their port number
-        owner_token = str(owner_address[1])
-        room_owners[room_name] = owner_token
-        # Add owner to chatroom with their token
-        chatrooms[room_name][owner_token] = time.time()
-        print(f'Chatroom {room_name} created with owner token {owner_token}')
-    else:
-        print(f'Chatroom {room_name} already exists')
+    return registry.validate(room_name, token) is not None
 
-def join_chatroom(room_name, client_address, token):
-    if not is_valid_chatroom(room_name):
-        print(f'Chatroom {room_name} is not valid')
+def create_chatroom(room_name, owner_address, owner_token, version=PROTOCOL_V1, compressed=False):
+    # The backend decides, a room created on another node exists here too
+    try:
+        created = backend.create_room(room_name, owner_token, node_id, version)
+    except BackendError as e:
+        logger.warning('Could not create chatroom %s: %s', room_name, e)
+        return False
+    if not created:
+        logger.debug('Chatroom %s already exists', room_name)
         return False
-    # Add client to chatroom with their token
-    chatrooms[room_name][token] = time.time()
-    print(f'Client with token {token} joined chatroom {room_name}')
+    # Add owner to chatroom with their token, the UDP address is bound by their first datagram
+    owner = registry.create_room(room_name, owner_token, None, version, node_id, compressed)
+    if owner is None and backend.shared:
+        # A room deleted on another node whose event has not arrived yet
+        drop_cached_room(room_name)
+        owner = registry.create_room(room_name, owner_token, None, version, node_id, compressed)
+    if owner is None:
+        # Created by another client since the backend was asked
+        logger.debug('Chatroom %s already exists', room_name)
+        return False
+    schedule_expiry(owner)
+    logger.info('Chatroom %s created with owner token %s', room_name, owner_token)
+    return True
+
+def join_chatroom(room_name, client_address, token, version=PROTOCOL_V1, compressed=False):
+    try:
+        owner = backend.join(room_name, token, node_id, version)
+    except BackendError as e:
+        logger.warning('Could not join chatroom %s: %s', room_name, e)
+        return False
+    if owner is None:
+        logger.debug('Chatroom %s is not valid', room_name)
+        return False
+    # Add client to chatroom with their token, the UDP address is bound by their first datagram
+    if backend.shared:
+        cache_room(room_name, owner)
+    member = registry.join(room_name, token, None, version, node_id, compressed)
+    if not member:
+        logger.warning('Chatroom %s changed while client with token %s joined it', room_name, token)
+        backend.leave(room_name, token)
+        return False
+    schedule_expiry(member)
+    logger.debug('Client with token %s joined chatroom %s', token, room_name)
     return True
 
 def leave_chatroom(room_name, token):
-    if room_name in chatrooms and token in chatrooms[room_name]:
-        del chatrooms[room_name][token]
-        print(f'Client with token {token} left chatroom {room_name}')
-        
-        # If owner leaves, delete the chatroom
-        if token == room_owners.get(room_name):
-            del chatrooms[room_name]
-            del room_owners[room_name]
-            print(f'Room {room_name} deleted as owner left')
-        # If room becomes empty, delete it
-        elif not chatrooms[room_name]:
-            del chatrooms[room_name]
-            del room_owners[room_name]
-            print(f'Room {room_name} deleted as it became empty')
-    else:
-        print(f'Client with token {token} not in chatroom {room_name}')
+    owner_token = registry.owner(room_name)
+    member, room_deleted = registry.leave(room_name, token)
+    if member is None:
+        logger.debug('Client with token %s not in chatroom %s', token, room_name)
+        return
+    expiry_wheel.discard(member)
+    # The room is only gone once the backend deleted it, other nodes may serve its members
+    try:
+        _, room_deleted = backend.leave(room_name, token)
+    except BackendError as e:
+        logger.warning('Could not remove client with token %s from chatroom %s: %s', token, room_name, e)
+    logger.debug('Client with token %s left chatroom %s', token, room_name)
+    # If owner leaves or the room becomes empty, the room is deleted
+    if room_deleted and token == owner_token:
+        logger.info('Room %s deleted as owner left', room_name)
+    elif room_deleted:
+        logger.info('Room %s deleted as it became empty', room_name)
 
-def process_udp_packet(data):
-    """Process UDP packet with new format"""
+def refresh_member_token(room_name, token):
+    """Give the member with the token a new one, the old token is no longer valid
+    Returns:
+        the Member with its new token, None if the room or token is invalid
+    """
+    member = validate_member(room_name, token)
+    if member is None:
+        return None
+    new_token = assign_token(room_name, member.address, token == registry.owner(room_name))
+    try:
+        if not backend.refresh(room_name, token, new_token):
+            return None
+    except BackendError as e:
+        logger.warning('Could not refresh token %s in chatroom %s: %s', token, room_name, e)
+        return None
+    # The backend's event may have renamed the member already
+    registry.refresh_token(room_name, token, new_token)
+    logger.debug('Client with token %s in chatroom %s refreshed it', token, room_name)
+    return registry.member(room_name, new_token)
+
+def configure_backend(state_server, node, relay_address):
+    """Keep room state in the state server at (host, port), shared with other nodes
+    Binds the relay socket at relay_address and registers it as node's. Must
+    run in the process that serves, before clients join.
+    """
+    global backend, node_id, relay_socket, backend_executor
+    node_id = node
+    backend = RemoteBackend(state_server)
+    backend_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='backend')
+    relay_socket = create_udp_socket(*relay_address)
+    backend.register_node(node, relay_address)
+    backend.subscribe(handle_backend_event)
+    logger.info('Node %d sharing room state through %s:%d, relaying on %s:%d',
+                node, *state_server, *relay_address)
+
+def handle_backend_event(event, room_name, token, node):
+    """Bring the cached room up to date with a change made on any node
+    Changes this node made come back too and find nothing left to do.
+    """
+    global backend_events
+    backend_events += 1
+    room_nodes.pop(room_name, None)
+    if event == 'delete':
+        drop_cached_room(room_name)
+    elif event == 'leave':
+        member, _ = registry.leave(room_name, token)
+        if member is not None:
+            expiry_wheel.discard(member)
+    elif event == 'moved' and node != node_id:
+        # The client sends to another node now, which sends it the room's messages
+        member = registry.detach(token, node)
+        if member is not None:
+            expiry_wheel.discard(member)
+    elif event == 'refresh':
+        # The new token comes in node's place
+        registry.refresh_token(room_name, token, node)
+
+def drop_cached_room(room_name):
+    for member in registry.delete_room(room_name):
+        expiry_wheel.discard(member)
+
+def cache_room(room_name, owner):
+    """Create the room locally, with the owner served by its node, if this node does not know it
+    Args:
+        owner: (owner_token, owner_node, owner_version) from the backend
+    """
+    owner_token, owner_node, owner_version = owner
+    registry.create_room(room_name, owner_token, None, owner_version, owner_node)
+
+def validate_member(room_name, token):
+    """Member for the token if it may send to the room, else None
+    Members this node knows are validated from the registry alone. With a
+    shared backend a miss asks the backend once and caches the member, so
+    only a client's first datagram to this node costs a round trip; tokens
+    the backend does not know are not asked again for UNKNOWN_TOKEN_TTL seconds.
+    """
+    member = registry.validate(room_name, token)
+    if member is not None or not backend.shared:
+        return member
+    now = time.monotonic()
+    if unknown_tokens.get(token, 0) > now:
+        return None
+    backend_lookups.inc()
+    try:
+        found = backend.member(token)
+        owner = backend.room(room_name) if found is not None and found[0] == room_name else None
+    except BackendError as e:
+        logger.warning('Could not look up token %s: %s', token, e)
+        return None
+    if owner is None:
+        if len(unknown_tokens) >= MAX_UNKNOWN_TOKENS:
+            unknown_tokens.clear()
+        unknown_tokens[token] = now + UNKNOWN_TOKEN_TTL
+        return None
+    _, node, version = found
+    cache_room(room_name, owner)
+    registry.join(room_name, token, None, version, node)
+    return registry.validate(room_name, token)
+
+def claim_member(member):
+    """Serve a member that another node served, its datagrams come here now"""
+    try:
+        backend.claim(member.token, node_id)
+    except BackendError as e:
+        logger.warning('Could not claim client with token %s: %s', member.token, e)
+    member.node = node_id
+    schedule_expiry(member)
+
+def node_address(node):
+    """Relay address of node, None if it is not registered"""
+    address = node_addresses.get(node)
+    if address is None:
+        refresh_nodes()
+        address = node_addresses.get(node)
+    return address
+
+def refresh_nodes():
+    """Reload the node addresses, unless they were reloaded in the last NODE_REFRESH_INTERVAL seconds
+    Threads that find a reload under way wait for it.
+    """
+    global nodes_refreshed
+    with nodes_lock:
+        now = time.monotonic()
+        if now - nodes_refreshed < NODE_REFRESH_INTERVAL:
+            return
+        try:
+            node_addresses.update(backend.nodes())
+        except BackendError as e:
+            logger.warning('Could not load node addresses: %s', e)
+        nodes_refreshed = now
+
+def relay_message(room_name, packet):
+    """Send a v2 packet to the other nodes serving members of the room"""
+    nodes = room_nodes.get(room_name)
+    if nodes is None:
+        seen = backend_events
+        try:
+            nodes = [node for node in backend.room_nodes(room_name) if node != node_id]
+        except BackendError as e:
+            logger.warning('Could not look up the nodes of chatroom %s: %s', room_name, e)
+            return
+        if seen == backend_events:
+            room_nodes[room_name] = nodes
+    for node in nodes:
+        address = node_address(node)
+        if address is None:
+            continue
+        try:
+            relay_socket.sendto(packet, address)
+            relay_sent.inc()
+        except OSError as e:
+            logger.warning('Error relaying message to node %d: %s', node, e)
+
+def handle_relayed_message(data, address):
+    """Forward a message another node relayed to this node's members of the room"""
+    if address not in node_addresses.values():
+        refresh_nodes()
+        if address not in node_addresses.values():
+            logger.warning('Dropped relayed datagram from unknown node %s', address)
+            return
+    relay_received.inc()
+    try:
+        data = memoryview(data)
+        room_name, token, message_start = parse_udp_packet(data)
+        if room_name in registry:
+            # Nodes relay v2 packets
+            forward_message(room_name, token, data, message_start, PROTOCOL_V2)
+    except Exception as e:
+        logger.warning('Error handling relayed message from %s: %s', address, e)
+
+def decode_udp_packet(data):
+    """Split a UDP packet of any protocol version into its fields
+    The message runs to the end of the datagram, so a sized v2 packet needs no
+    padding and only the zero padding of a fixed-size v1 packet is stripped.
+    Returns:
+        (room_name, token, message) as bytes
+    """
     # Header
     room_name_size = data[0]
     token_size = data[1]
     
     # Body
+    message_start = 2 + room_name_size + token_size
     room_name = data[2:2 + room_name_size]
-    token = data[2 + room_name_size:2 + room_name_size + token_size]
-    message = data[2 + room_name_size + token_size:4096]
-    print(f'room_name: {room_name.decode()}, token: {token.decode()}, message: {message.decode()}')
+    token = data[2 + room_name_size:message_start]
+    message = data[message_start:]
+    if len(data) == PACKET_SIZE:
+        message = message.rstrip(b'\x00')
+    return room_name, token, message
+
+def process_udp_packet(data):
+    """Process UDP packet with new format"""
+    room_name, token, message = decode_udp_packet(data)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('room_name: %s, token: %s, message: %s', room_name.decode(), token.decode(), message.decode())
     
     return room_name.decode(), token.decode(), message.decode()
 
-def build_udp_packet(room_name, token, message):
-    print(f'room_name: {room_name}, token: {token}, message: {message}')
-    packet = bytearray(4096)
-    packet[0] = len(room_name)
-    packet[1] = len(token)
-    packet[2: 2+len(room_name)] = room_name.encode()
-    packet[2+len(room_name): 2+len(room_name)+len(token)] = token.encode()
-    packet[2+len(room_name)+len(token): 2+len(room_name)+len(token)+len(message)] = message.encode()
-    return packet
+def packet_framing(version):
+    """Framing of a packet from a client of the version, once a v3 header is stripped
+    The sender's negotiated version decides, not the size: a v2 packet may be
+    PACKET_SIZE bytes long too.
+    """
+    return PROTOCOL_V1 if version == PROTOCOL_V1 else PROTOCOL_V2
+
+def convert_udp_packet(data, message_start, framing, version, seq=0, flags=0):
+    """Re-frame a received v1 or v2 packet for a client speaking another protocol version
+    Args:
+        framing: PROTOCOL_V1 or PROTOCOL_V2, how data is framed
+        seq, flags: Seq and Flags of a v3 packet
+    """
+    if version == PROTOCOL_V1:
+        # Zero-pad the sized packet
+        packet = bytearray(PACKET_SIZE)
+        packet[:len(data)] = data
+        return packet
+    message_size = len(data) - message_start
+    if framing == PROTOCOL_V1:
+        # Cut the zero padding off, the slice of a memoryview is not a copy
+        message_size = len(bytes(data[message_start:]).rstrip(b'\x00'))
+    if version == PROTOCOL_V3:
+        return b''.join((data[:message_start], V3_HEADER.pack(flags, seq),
+                         data[message_start:message_start + message_size]))
+    return data[:message_start + message_size]
+
+def strip_v3_header(data, message_start):
+    """The v2 packet with the same room name, token and message as a v3 packet"""
+    return bytes(data[:message_start]) + bytes(data[message_start + V3_HEADER_SIZE:])
+
+def compress_v3_packet(packet, message_start, compressed=None):
+    """The v3 packet with its message compressed and FLAG_COMPRESSED set
+    Args:
+        message_start: where the message starts, after Flags and Seq
+        compressed: the message compressed already, as its sender sent it
+    Returns:
+        the packet itself if compressing does not make it smaller, or compression
+        is off since the member was restored from a server that had it on
+    """
+    if codec is None:
+        return packet
+    if compressed is None:
+        compressed = codec.compress(packet[message_start:])
+        if compressed is None:
+            return packet
+    udp_compressed.inc()
+    header = bytearray(packet[:message_start])
+    header[message_start - V3_HEADER_SIZE] |= FLAG_COMPRESSED
+    return bytes(header) + compressed
+
+def is_empty_message(data, message_start, framing):
+    """Check if a received packet carries no message, v1 packets are all zero padding then"""
+    return len(data) == message_start or (framing == PROTOCOL_V1 and data[message_start] == 0)
+
+class ForwardPackets(dict):
+    """{protocol_version: packet} for one received packet
+    The received packet is forwarded byte-for-byte to clients of its own
+    version and re-framed once, on first use, for the other version.
+    COMPRESSED_V3 is the v3 packet compressed, once for every member that
+    negotiated compression.
+    """
+
+    def __init__(self, data, message_start, framing, compressed=None):
+        super().__init__()
+        self.data = data
+        self.message_start = message_start
+        self.framing = framing
+        # The message as a client compressed it, reused for COMPRESSED_V3
+        self.compressed = compressed
+        # The room's sequence number for the message, sent in v3 packets
+        self.seq = 0
+        self[framing] = data
+
+    def __missing__(self, version):
+        if version == COMPRESSED_V3:
+            packet = compress_v3_packet(self[PROTOCOL_V3], self.message_start + V3_HEADER_SIZE, self.compressed)
+        else:
+            packet = convert_udp_packet(self.data, self.message_start, self.framing, version, self.seq)
+        self[version] = packet
+        return packet
+
+def accept_udp_message(address):
+    """Count a received datagram and apply the early drop
+    Returns:
+        False if the datagram is dropped
+    """
+    udp_received.inc()
+    return not over_rate_limit(address)
+
+def route_udp_message(data, address):
+    """Handle a datagram if this worker owns its room, else forward it to the owner"""
+    if workers > 1 and len(data) >= 2 + data[0]:
+        owner = worker_ipc.room_worker(data[2:2 + data[0]], workers)
+        if owner != worker_id:
+            if not channels.forward_udp(owner, data, address):
+                logger.warning('Dropped datagram from %s: inbox of worker %d is full', address, owner)
+            return
+    handle_udp_message(data, address)
 
 def handle_udp_message(data, address):
+    """Validate a received packet and forward it to the room
+    Args:
+        data: the received datagram, bytes or a memoryview of a pooled buffer
+        address: (ip, port) of the sender
+    """
     try:
-        room_name, token, message = process_udp_packet(data)
-        print(f'room_name: {room_name}, token: {token}, message: {message}')
-        print(f'chatrooms: {chatrooms[room_name]}')
-        for stored_token in chatrooms[room_name]:
-            print(f'stored token: {stored_token}')
-            
-        if not validate_client_token(room_name, token):
-            error_packet = build_error_packet("Invalid room or token")
-            sock.sendto(error_packet, address)
+        started = time.perf_counter_ns()
+        data = memoryview(data)
+        room_name, token, message_start = parse_udp_packet(data)
+        parsed = time.perf_counter_ns()
+        parse_latency.record(parsed - started)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('room_name: %s, token: %s, message: %d bytes, members: %d',
+                         room_name, token, len(data) - message_start, len(registry.members(room_name)))
+            # Time spent logging is not validation
+            parsed = time.perf_counter_ns()
+
+        member = validate_member(room_name, token)
+        validated = time.perf_counter_ns()
+        validate_latency.record(validated - parsed)
+        if member is None:
+            udp_rejected.inc()
+            sock.sendto(error_packet("Invalid room or token"), address)
             return
         
+        # The early drop did not know which member sends from this address, charge it now
+        if member_limit is not None and registry.member_for_address(address) is not member:
+            if not member_limit.allow(member, time.monotonic()):
+                udp_member_limited.inc()
+                return
+        # Messages for the client go to the address it sends from
+        if member.address != address:
+            registry.bind_address(member, address)
+            if member.node != node_id:
+                claim_member(member)
+        compressed = None
+        if member.version == PROTOCOL_V3:
+            flags, seq = parse_v3_header(data, message_start)
+            # ACKs and NACKs are not activity, a client that only listens still expires
+            if flags & (FLAG_ACK | FLAG_NACK):
+                handle_control_packet(member, flags, seq, data[message_start + V3_HEADER_SIZE:], address)
+                return
+            if flags & FLAG_COMPRESSED:
+                if codec is None:
+                    raise ValueError('Compression is off')
+                # Decompressed once for history and the members that did not negotiate
+                # compression, the others get the sender's compressed bytes. Bounded by
+                # what a v2 frame carries, a larger message could not be forwarded
+                compressed = bytes(data[message_start + V3_HEADER_SIZE:])
+                data = bytes(data[:message_start]) + codec.decompress(compressed, PACKET_SIZE - message_start)
+            else:
+                # The client's Seq is not the room's, forward the message framed as v2
+                data = strip_v3_header(data, message_start)
         # Update client activity using their token
-        chatrooms[room_name][token] = time.time()
+        member.last_active = time.time()
+        framing = packet_framing(member.version)
+        # An empty message only registers the client's address
+        if is_empty_message(data, message_start, framing):
+            if member.version == PROTOCOL_V3:
+                # Where the room's sequence stands, gaps after it are worth a NACK
+                send_ack(room_name, registry.last_seq(room_name), address)
+            return
         
-        # Broadcast message to other clients
-        send_message = build_udp_packet(room_name, token, message)
-        if not send_message_to_clients(send_message, token, room_name):
-            error_packet = build_error_packet("Room is no longer valid")
-            sock.sendto(error_packet, address)
+        # A room over its limit drops the message before it takes a sequence number
+        if room_limit is not None:
+            room = registry.room(room_name)
+            if room is not None and not room_limit.allow(room, time.monotonic()):
+                udp_room_limited.inc()
+                return
+
+        sending = time.perf_counter_ns()
+        send_messages = forward_message(room_name, token, data, message_start, framing, compressed)
+        if send_messages is None:
+            sock.sendto(error_packet("Room is no longer valid", member.version), address)
+            return
+        # Members served by other nodes get it from their node
+        if relay_socket is not None:
+            relay_message(room_name, send_messages[PROTOCOL_V2])
+        fanout_latency.record(time.perf_counter_ns() - sending)
+        # The sender gets its message's sequence number instead of a copy
+        if member.version == PROTOCOL_V3 and send_messages.seq:
+            send_ack(room_name, send_messages.seq, address)
             
     except Exception as e:
-        print(f'Error handling UDP message: {e}')
-        error_packet = build_error_packet(str(e))
-        sock.sendto(error_packet, address)
+        logger.warning('Error handling UDP message from %s: %s', address, e)
+        sock.sendto(build_error_packet(str(e)), address)
+
+def forward_message(room_name, token, data, message_start, framing, compressed=None):
+    """Send a message to this node's members of the room except the sender
+    Args:
+        framing: PROTOCOL_V1 or PROTOCOL_V2, how data is framed
+        compressed: the message as its sender compressed it, None if it was not
+    Returns:
+        the ForwardPackets it was sent as, None if the room is no longer valid
+    """
+    # The send stage sends after the pooled buffer is handed back
+    if send_queue is not None:
+        data = bytes(data)
+    # Broadcast the received packet to other clients
+    send_messages = ForwardPackets(data, message_start, framing, compressed)
+    # Keep it for members that join later or lose it
+    send_messages.seq = registry.append_history(room_name, send_messages[PROTOCOL_V2]) or 0
+    # v3 members get their copy in the room's next batch
+    skip_version = PROTOCOL_V3 if coalesce_window else None
+    if not send_message_to_clients(send_messages, token, room_name, skip_version):
+        return None
+    if coalesce_window:
+        coalesce(room_name, send_messages[PROTOCOL_V3])
+    return send_messages
+
+def coalesce(room_name, packet):
+    """Hold a v3 packet for the room's next batch
+    The batch goes out when the coalescing window closes, or right away once
+    it holds coalesce_bytes.
+    """
+    pending = registry.add_pending(room_name, packet)
+    if pending is None:
+        return
+    udp_coalesced.inc()
+    count, size = pending
+    if size + 2 * count + 11 + len(room_name) >= coalesce_bytes:
+        flush_coalesced(room_name)
+    elif count == 1:
+        try:
+            asyncio.get_running_loop().call_later(coalesce_window, flush_coalesced, room_name)
+        except RuntimeError:
+            # A thread of the threaded engine, there is no event loop to wait on
+            timer = threading.Timer(coalesce_window, flush_coalesced, (room_name,))
+            timer.daemon = True
+            timer.start()
+
+def flush_coalesced(room_name):
+    """Send the room's held packets to its v3 members, packed in batches"""
+    packets = registry.take_pending(room_name)
+    if not packets:
+        return
+    batches = build_batch_packets(room_name, packets, coalesce_bytes)
+    udp_batches.inc(len(batches))
+    # Each batch is compressed as a whole, once, when a member negotiated compression
+    compressed_batches = None
+    tokens = []
+    sends = []
+    for member in registry.members(room_name):
+        if member.version == PROTOCOL_V3 and member.address is not None:
+            member_batches = batches
+            if member.compressed:
+                if compressed_batches is None:
+                    compressed_batches = [compress_v3_packet(batch, 2 + batch[0] + batch[1] + V3_HEADER_SIZE)
+                                          for batch in batches]
+                member_batches = compressed_batches
+            for batch in member_batches:
+                sends.append((batch, member.address))
+                tokens.append(member.token)
+    send_to_members(room_name, sends, tokens)
+
+def build_batch_packets(room_name, packets, limit):
+    """Pack v3 packets into FLAG_BATCH packets of at most limit bytes
+    Packets go in order and a packet that ends up alone is sent as it is.
+    The same batches go to every member, senders skip their own messages.
+    """
+    room_name = room_name.encode()
+    header_size = udp_packet_size(len(room_name), 0, 0, PROTOCOL_V3)
+    groups = [[]]
+    sizes = [header_size]
+    for packet in packets:
+        if groups[-1] and sizes[-1] + 2 + len(packet) > limit:
+            groups.append([])
+            sizes.append(header_size)
+        groups[-1].append(packet)
+        sizes[-1] += 2 + len(packet)
+    batches = []
+    for group, size in zip(groups, sizes):
+        if len(group) == 1:
+            batches.append(group[0])
+            continue
+        # Every frame is written straight into the batch
+        batch = bytearray(size)
+        offset = pack_udp_packet_into(batch, 0, room_name, b'', b'', PROTOCOL_V3, FLAG_BATCH)
+        for packet in group:
+            BATCH_FRAME.pack_into(batch, offset, len(packet))
+            batch[offset + 2:offset + 2 + len(packet)] = packet
+            offset += 2 + len(packet)
+        batches.append(batch)
+    return batches
+
+def send_ack(room_name, seq, address):
+    """Tell a v3 client that the room's messages up to seq exist"""
+    sock.sendto(build_ack_packet(room_name, seq), address)
+
+def retransmit_packet(frame, seq):
+    """v3 packet re-sending a message kept in the room's history as a v2 frame"""
+    return convert_udp_packet(frame, 2 + frame[0] + frame[1], PROTOCOL_V2, PROTOCOL_V3, seq, FLAG_RETRANSMIT)
+
+def handle_control_packet(member, flags, seq, payload, address):
+    """Answer the ACK or NACK of a v3 client
+    Args:
+        seq: highest sequence number the client has received
+        payload: for a NACK, the missing ranges as First(8byte) + Count(2byte) each
+    """
+    room_name = member.room_name
+    if flags & FLAG_NACK:
+        udp_nacks.inc()
+        ranges = split_nack(payload)
+    else:
+        # A heartbeat: send what the client is missing at the tail
+        ranges = [(seq + 1, MAX_RETRANSMIT)]
+    packets = []
+    for first, count in ranges:
+        # Messages that fell out of the history are not sent, the client gives up on them
+        for frame_seq, frame in registry.history(room_name, min(count, MAX_RETRANSMIT - len(packets)), since=first - 1):
+            # Past the range, its start fell out of the history
+            if frame_seq >= first + count:
+                break
+            packets.append((retransmit_packet(frame, frame_seq), address))
+    if not packets:
+        return
+    failures = send_packets(packets)
+    udp_retransmitted.inc(len(packets) - len(failures))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Retransmitted %d messages of chatroom %s to %s', len(packets), room_name, address)
 
 """
 # TCP for chatroom management
 ## tcp packet format:
-Header | RoomNameSize(1byte) + Operation(1byte) + State(1byte) + OperationPayloadSize(29byte)
-Body | RoomName(RoomNameSize) + OperationPayload(29byte)
+Header | RoomNameSize(1byte) + Operation(1byte) + State(1byte) + RequestId(4byte) + OperationPayloadSize(25byte)
+Body | RoomName(RoomNameSize) + OperationPayload(OperationPayloadSize)
+A connection carries any number of frames back to back, each one is read as
+its 32 byte header and then RoomNameSize + OperationPayloadSize bytes of body
+(then the zero padding up to 4096 bytes in v1), however the bytes arrive.
+Requests larger than 4096 bytes are refused.
+wire.py builds and parses the frames of server and clients alike.
+
+RequestId:
+0: the request is answered in order, with operation 1 and then its response
+otherwise: the request is pipelined, answered with one frame carrying its RequestId as soon as it
+is done, its response or operation 1 with status code 1; pipelined requests may be answered out
+of order, so a client can send dozens of them without waiting and match the answers by RequestId
 
 Operation:
 0: request to create chatroom or join chatroom (client send server roomname and username)
 1: server respond to request containing status code
 2: server respond to request containing unique token that is assigned client name 
 that recognize client as the owner of the chatroom
+3: request the room's recent messages, usually right after operation 2 on the same connection
+4: server respond to request containing the messages
+5: request the compression dictionary, right after an operation 2 that granted compression
+6: server respond to request containing the dictionary
+7: request to leave a chatroom, the room is deleted if its owner leaves
+8: server respond to request confirming the client left
+9: request to create a chatroom, failing if it exists, answered with operation 2
+10: request to join a chatroom, failing if it does not exist, answered with operation 2
+11: request a page of the chatroom directory, the rooms in name order, optionally those
+    with a name starting with a prefix
+12: server respond to request containing the rooms and their member counts
+13: request a new token in place of the client's, answered with operation 2
 
 State = status code:
 0: Success
 1: Failed
+In an operation 0, 3, 7, 9, 10, 11 or 13 request, State = requested protocol version:
+0 or 1: v1, every frame is zero-padded to 4096 bytes
+2: v2, every frame is sized to its header (32 + RoomNameSize + OperationPayloadSize)
+3: v3, TCP frames as in v2, UDP frames carry Flags and Seq (see UDP for chat)
+The server answers in the requested version and unknown versions fall back to v1
+In an operation 0, 9 or 10 request, State 0x80 (ORed with the version) asks for compression;
+a v3 client of a server started with --compression gets operation 2 with State 0x80,
+and so does the operation 13 request of a client granted it
 
 OperationPayload:
 if operation == 0:
@@ -251,51 +1135,52 @@ if operation == 2:
     State = status code
     RoomName = room name
     OperationPayload = unique token
-"""
-def build_tcp_packet(operation, state, room_name, operation_payload):
-    try:
-        # Check size limits
-        if len(room_name) > 255:
-            return build_error_packet("Room name exceeds maximum size of 255 bytes")
-        if len(operation_payload) > (2**29 - 1):
-            return build_error_packet("Operation payload exceeds maximum size of 2^29 - 1 bytes")
-
-        # Ensure inputs are bytes
-        room_name_bytes = room_name.encode() if isinstance(room_name, str) else room_name
-        operation_payload_bytes = operation_payload.encode() if isinstance(operation_payload, str) else operation_payload
-
-        packet = bytearray(4096) 
-        # Header(32bytes)
-        packet[0] = len(room_name_bytes)  # RoomNameSize(1byte)
-        packet[1] = operation  # Operation(1byte)
-        packet[2] = state  # State(1byte)
-        # Convert operation_payload_size to 29 bytes
-        packet[3:32] = len(operation_payload_bytes).to_bytes(29, byteorder='big')
-        # Body(RoomNameSize + OperationPayload)
-        packet[32:32 + len(room_name_bytes)] = room_name_bytes  # RoomName(RoomNameSize bytes, max 255byte)
-        packet[32 + len(room_name_bytes):32 + len(room_name_bytes) + len(operation_payload_bytes)] = operation_payload_bytes  # OperationPayload(max 2^29 - 1 bytes)
-
-        return packet
-    except Exception as e:
-        return build_error_packet(str(e))
-
-def build_error_packet(error_message):
-    """Build a packet with operation=1 (error response) and state=1 (failed)"""
-    # Ensure error_message is bytes
-    error_message_bytes = error_message.encode() if isinstance(error_message, str) else error_message
-    
-    packet = bytearray(4096)
-    # Header(32bytes)
-    packet[0] = 0  # RoomNameSize = 0 for error messages
-    packet[1] = 1  # Operation = 1 (error response)
-    packet[2] = 1  # State = 1 (failed)
-    # Convert error_message_size to 29 bytes
-    packet[3:32] = len(error_message_bytes).to_bytes(29, byteorder='big')
-    # Body (only OperationPayload)
-    packet[32:32 + len(error_message_bytes)] = error_message_bytes
-    return packet
+if operation == 3:
+    RoomName = room name
+    OperationPayload = 'last' or 'since' + ' ' + Count + ' ' + unique token
+        last: the last Count messages, e.g. 'last 20 9f86d081884c7d659a2feaa0c55ad015'
+        since: the messages after sequence number Count
+if operation == 4:
+    State = status code
+    RoomName = room name
+    OperationPayload = one record per message, oldest first:
+        Seq(8byte) + FrameSize(2byte) + Frame(FrameSize)
+        Frame is the message as a v2 UDP packet (see UDP for chat)
+    Every room keeps its last --history-messages messages, up to --history-bytes bytes
+if operation == 5:
+    OperationPayload = id of the dictionary the client has, as 8 hex digits, or nothing
+if operation == 6:
+    State = status code
+    OperationPayload = DictionaryId(4byte, crc32 of the dictionary) + Dictionary,
+        Dictionary left out when the client has it (see compression.py)
+if operation == 7:
+    RoomName = room name
+    OperationPayload = unique token
+if operation == 8:
+    State = status code
+    RoomName = room name
+    OperationPayload = unique token, no longer valid
+if operation == 9 or operation == 10:
+    RoomName = room name
+    OperationPayload = username
+if operation == 11:
+    RoomName = prefix of the room names to list, nothing for every room
+    OperationPayload = Limit, or Limit + ' ' + Cursor, or nothing for 100 rooms from the first
+        Limit: most rooms to answer with, up to 1000
+        Cursor: the rooms after it are listed, the Cursor of the previous page
+    e.g. '50' for the first 50 rooms, '50 lobby-49' for the 50 after lobby-49
+if operation == 12:
+    State = status code
+    RoomName = Cursor of the next page, nothing if this is the last page
+    OperationPayload = NameSize(1byte) + Name + MemberCount(4byte) per room, in name order
+    A page costs the same however many rooms there are: the names are kept sorted
+    as rooms are created and deleted (see room_directory.py)
+    With several nodes a node lists the rooms it knows of, those its members are in
+if operation == 13:
+    RoomName = room name
+    OperationPayload = unique token; the answer's token replaces it, the client keeps its
+    address and the room's messages, the old token is no longer valid
 
-"""
 ## Control flow
 - start tcp connection
 - client send roomname and username to server
@@ -316,7 +1201,16 @@ def build_error_packet(error_message):
             - server send operation 2, status code 0 to client and unique token
         - else if failed:
             - server send operation 1, status code 1 to client and error message
+- the client may send further requests on the same connection: history, the dictionary,
+  joins of other rooms and leaves, each answered in order with operation 1 and its response,
+  so a client in many rooms needs one connection for all of them
+- or keep the connection as a control channel: send requests with RequestIds without
+  waiting for the answers, up to 256 are carried out at once, the rest wait to be read
 -close tcp connection
+- the server serves every connection on one asyncio event loop, refuses
+  connections beyond --max-connections with operation 1, status code 1
+  and closes connections that send nothing for --tcp-timeout seconds,
+  --control-timeout seconds once they sent a RequestId
 """
 def assign_token(room_name, client_address, is_owner):
     """ Assign a token to the client 
@@ -325,83 +1219,384 @@ def assign_token(room_name, client_address, is_owner):
         client_address: (ip, port) tuple
         is_owner: True if client is room owner
     Returns:
-        token: string representation of port number
+        token: random hex string, not used by any other member
     """
-    if is_owner:
-        # For owner, use their port as token
-        token = str(client_address[1])  # Convert port number to string
-    else:
-        # For joiners, use room name's hash as port
-        token = str(hash(room_name) % 65535)  # Use modulo to ensure valid port range
-    return token
-
-def accept_tcp_connections():
     while True:
-        conn, addr = sock_tcp.accept()
-        print(f'Client {addr} connected')
-        thread = threading.Thread(target=handle_tcp_connection, args=(conn, addr))
-        thread.start()
+        token = secrets.token_hex(TOKEN_BYTES)
+        if registry.member_for_token(token) is None:
+            return token
 
-def handle_tcp_connection(conn, addr):
-    while True:
-        data = conn.recv(4096)
-        if not data:
-            break
+def negotiate_version(requested_version):
+    """Protocol version to speak with a client, v1 if the requested one is unknown
+    Args:
+        requested_version: State of the client's versioned request, capabilities included
+    """
+    requested_version &= VERSION_MASK
+    if requested_version in SUPPORTED_VERSIONS:
+        return requested_version
+    return PROTOCOL_V1
 
-        try:
-            # decode data
-            room_name_size = data[0]
-            operation = data[1]
-            state = data[2]
-            operation_payload_size = int.from_bytes(data[3:32], byteorder='big')
-            
-            # Extract room name and operation payload
-            room_name = data[32:32 + room_name_size]
-            operation_payload = data[32 + room_name_size:32 + room_name_size + operation_payload_size]
-            
-            # Convert to strings for processing
-            room_name_str = room_name.decode()
-            operation_payload_str = operation_payload.decode()
-            
-            print(f'Operation: {operation}, State: {state}, Room Name: {room_name_str}, Operation Payload: {operation_payload_str}')
-            
-            # Send initial success response
-            conn.sendall(build_tcp_packet(1, 0, room_name_str, "Success"))
-            
-            # Handle operation
-            if operation == 0:  # client request to create or join chatroom
-                if room_name_str not in chatrooms:
-                    # Create chatroom
-                    create_chatroom(room_name_str, addr)
-                    # Send token response
-                    token = assign_token(room_name_str, addr, True)
-                    print(f"Assigned token for owner: {token}")
-                    conn.sendall(build_tcp_packet(2, 0, room_name_str, token))
-                else:
-                    # Join chatroom
-                    token = assign_token(room_name_str, addr, False)
-                    print(f"Assigned token for joiner: {token}")
-                    if join_chatroom(room_name_str, addr, token):
-                        # Send token response
-                        conn.sendall(build_tcp_packet(2, 0, room_name_str, token))
-                    else:
-                        # Send error response
-                        conn.sendall(build_error_packet("Failed to join chatroom"))
+def request_version(operation, state, version):
+    """Protocol version a request frame is framed in
+    A request of VERSIONED_OPERATIONS is framed in the version it asks for,
+    other requests in the version negotiated on the connection.
+    """
+    if operation in VERSIONED_OPERATIONS:
+        return negotiate_version(state)
+    return version
+
+def process_tcp_request(operation, state, room_name, operation_payload, addr, version):
+    """Carry out one request and build the frames to answer it with
+    Args:
+        room_name, operation_payload: decoded strings
+        version: protocol version negotiated on the connection
+    Returns:
+        (version, responses): the connection's version from now on and the frames to send
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Operation: %d, State: %d, Room Name: %s, Operation Payload: %s',
+                     operation, state, room_name, operation_payload)
+
+    # State of a versioned request is the requested protocol version
+    if operation in VERSIONED_OPERATIONS:
+        version = negotiate_version(state)
+
+    # Initial success response
+    responses = [success_packet(room_name, version)]
+
+    # Handle operation
+    if operation in JOIN_OPERATIONS:  # client request to create or join chatroom, 9 only creates, 10 only joins
+        # Compression is granted to v3 clients that ask for it, the token response says so in its State
+        compressed = codec is not None and version == PROTOCOL_V3 and bool(state & CAPABILITY_COMPRESSION)
+        token_state = CAPABILITY_COMPRESSION if compressed else 0
+        token = assign_token(room_name, addr, room_name not in registry)
+        if operation != 10 and room_name not in registry and create_chatroom(room_name, addr, token, version,
+                                                                              compressed):
+            # Token response
+            logger.debug("Assigned token for owner: %s", token)
+            responses.append(build_tcp_packet(2, token_state, room_name, token, version))
+        elif operation == 9:
+            responses.append(error_packet("Chatroom already exists", version))
+        else:
+            # Join chatroom, also when another client created it first
+            logger.debug("Assigned token for joiner: %s", token)
+            if join_chatroom(room_name, addr, token, version, compressed):
+                # Token response
+                responses.append(build_tcp_packet(2, token_state, room_name, token, version))
             else:
-                conn.sendall(build_error_packet("Invalid operation"))
-                
-        except Exception as e:
-            error_msg = f"Error handling client message: {str(e)}"
-            print(error_msg)
-            conn.sendall(build_error_packet(error_msg))
-            break
+                # Error response
+                responses.append(error_packet("Failed to join chatroom", version))
+    elif operation == 3:  # client request for the room's recent messages
+        responses.append(build_history_response(room_name, operation_payload, version))
+    elif operation == 5:  # client request for the compression dictionary
+        responses.append(build_dictionary_response(room_name, operation_payload, version))
+    elif operation == 7:  # client request to leave a chatroom
+        responses.append(build_leave_response(room_name, operation_payload, version))
+    elif operation == 11:  # client request for a page of the room directory
+        responses.append(build_room_list_response(room_name, operation_payload, version))
+    elif operation == 13:  # client request for a new token
+        responses.append(build_refresh_response(room_name, operation_payload, version))
+    else:
+        responses.append(error_packet("Invalid operation", version))
+    return version, responses
+
+def build_history_response(room_name, operation_payload, version):
+    """Operation 4 packet with the messages an operation 3 request asks for"""
+    try:
+        mode, count, token = operation_payload.split(' ', 2)
+        count = int(count)
+    except ValueError:
+        return error_packet("Invalid history request", version)
+    if mode not in ('last', 'since'):
+        return error_packet("Invalid history request", version)
+    if validate_member(room_name, token) is None:
+        return error_packet("Invalid room or token", version)
+    if mode == 'since':
+        records = registry.history(room_name, since=count)
+    else:
+        records = registry.history(room_name, count=count)
+    return build_tcp_packet(4, 0, room_name, pack_history(records), version)
+
+def build_dictionary_response(room_name, operation_payload, version):
+    """Operation 6 packet with the compression dictionary, left out if the client has it"""
+    if codec is None:
+        return error_packet("Compression is off", version)
+    payload = codec.dictionary_id.to_bytes(4, 'big')
+    if operation_payload != f'{codec.dictionary_id:08x}':
+        payload += codec.dictionary
+    return build_tcp_packet(6, 0, room_name, payload, version)
+
+def build_leave_response(room_name, token, version):
+    """Operation 8 packet once the member with the token left the room"""
+    if validate_member(room_name, token) is None:
+        return error_packet("Invalid room or token", version)
+    leave_chatroom(room_name, token)
+    return build_tcp_packet(8, 0, room_name, token, version)
+
+def parse_room_list_request(operation_payload):
+    """(limit, cursor) of an operation 11 request, None if it is invalid"""
+    if not operation_payload:
+        return ROOM_PAGE_SIZE, None
+    limit, _, cursor = operation_payload.partition(' ')
+    try:
+        limit = int(limit)
+    except ValueError:
+        return None
+    if limit < 0:
+        return None
+    return min(limit, MAX_ROOM_PAGE), cursor or None
+
+def build_room_list_response(prefix, operation_payload, version):
+    """Operation 12 packet with a page of this worker's rooms whose names start with prefix"""
+    request = parse_room_list_request(operation_payload)
+    if request is None:
+        return error_packet("Invalid room list request", version)
+    limit, cursor = request
+    rooms, more = registry.room_page(limit, cursor, prefix)
+    next_cursor = rooms[-1][0] if more and rooms else ''
+    return build_tcp_packet(12, 0, next_cursor, pack_room_list(rooms), version)
+
+def build_refresh_response(room_name, token, version):
+    """Operation 2 packet with the new token of the member with the token"""
+    member = refresh_member_token(room_name, token)
+    if member is None:
+        return error_packet("Invalid room or token", version)
+    token_state = CAPABILITY_COMPRESSION if member.compressed else 0
+    return build_tcp_packet(2, token_state, room_name, member.token, version)
+
+async def dispatch_tcp_request(operation, state, room_name, operation_payload, addr, version):
+    """process_tcp_request in the worker that owns the room, an operation 11 request in every worker
+    Returns:
+        (version, responses) like process_tcp_request
+    """
+    request = (operation, state, room_name, operation_payload, addr, version)
+    if backend_executor is not None:
+        # Off the event loop, a slow state server would stall every connection and in asyncio mode the UDP fan-out
+        return await asyncio.get_running_loop().run_in_executor(backend_executor, process_tcp_request, *request)
+    if workers == 1:
+        return process_tcp_request(*request)
+    if operation == 11:
+        return await list_rooms_of_workers(request)
+    reply = await request_worker(worker_ipc.room_worker(room_name, workers), request)
+    if reply is None:
+        version = request_version(operation, state, version)
+        return version, [error_packet("Server busy, try again later", version)]
+    return reply
+
+async def request_worker(owner, request):
+    """process_tcp_request(*request) in worker owner
+    Returns:
+        (version, responses), None if the worker's inbox is full
+    """
+    if owner == worker_id:
+        return process_tcp_request(*request)
+    request_id = next(request_ids)
+    future = asyncio.get_running_loop().create_future()
+    pending_requests[request_id] = future
+    try:
+        if not channels.request(owner, request_id, worker_id, request):
+            return None
+        return await asyncio.wait_for(future, tcp_timeout)
+    finally:
+        pending_requests.pop(request_id, None)
+
+async def list_rooms_of_workers(request):
+    """Answer an operation 11 request with a page of every worker's rooms, merged in name order
+    Every worker answers with its own first limit rooms after the cursor,
+    the first limit of all of them are among those.
+    """
+    operation, state, prefix, operation_payload, _, version = request
+    version = request_version(operation, state, version)
+    replies = await asyncio.gather(*(request_worker(owner, request) for owner in range(workers)))
+    pages = []
+    more = False
+    for reply in replies:
+        if reply is None:
+            return version, [error_packet("Server busy, try again later", version)]
+        frame = reply[1][-1]
+        room_name_size, operation, _, operation_payload_size, _ = parse_tcp_header(frame)
+        if operation != 12:
+            # Every worker refuses the same invalid request
+            return reply
+        start = TCP_HEADER_SIZE + room_name_size
+        pages.append(split_room_list(frame[start:start + operation_payload_size]))
+        # A worker's page ends with a cursor if it has more rooms
+        more = more or room_name_size > 0
+    limit, _ = parse_room_list_request(operation_payload)
+    rooms = list(itertools.islice(heapq.merge(*pages), limit + 1))
+    more = more or len(rooms) > limit
+    rooms = rooms[:limit]
+    next_cursor = rooms[-1][0] if more and rooms else ''
+    return version, [success_packet('', version),
+                     build_tcp_packet(12, 0, next_cursor, pack_room_list(rooms), version)]
+
+def handle_inbox():
+    """Handle the messages other workers queued in this worker's inbox"""
+    for _ in range(INBOX_BATCH):
+        message = channels.receive()
+        if message is None:
+            return
+        kind, payload = message
+        if kind == worker_ipc.UDP_FORWARD:
+            # The receiving worker does not know the members of this worker's rooms
+            if not over_rate_limit(payload[1]):
+                handle_udp_message(*payload)
+        elif kind == worker_ipc.TCP_REQUEST:
+            request_id, reply_worker, request = payload
+            try:
+                reply = process_tcp_request(*request)
+            except Exception as e:
+                error_msg = f"Error handling client message: {str(e)}"
+                logger.warning(error_msg)
+                reply = (request[-1], [build_error_packet(error_msg, request[-1])])
+            channels.reply(reply_worker, request_id, reply)
+        elif kind == worker_ipc.TCP_REPLY:
+            request_id, reply = payload
+            future = pending_requests.get(request_id)
+            if future is not None and not future.done():
+                future.set_result(reply)
+
+async def read_tcp_request(reader, version):
+    """Read one request frame, sized by its header
+    Returns:
+        (operation, state, room_name, operation_payload, frame_version, request_id),
+        None if the client closed the connection between frames
+    Raises:
+        ValueError: if the frame is larger than MAX_TCP_REQUEST_SIZE
+        asyncio.IncompleteReadError: if the client closed the connection mid-frame
+    """
+    try:
+        header = await reader.readexactly(TCP_HEADER_SIZE)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise
+    room_name_size, operation, state, operation_payload_size, request_id = parse_tcp_header(header)
+    size = TCP_HEADER_SIZE + room_name_size + operation_payload_size
+    if size > MAX_TCP_REQUEST_SIZE:
+        raise ValueError(f'Request of {size} bytes exceeds {MAX_TCP_REQUEST_SIZE} bytes')
+    body = await reader.readexactly(room_name_size + operation_payload_size)
+    frame_version = request_version(operation, state, version)
+    # A v1 frame is zero-padded to PACKET_SIZE, drop the padding before the next frame
+    if frame_version == PROTOCOL_V1 and size < PACKET_SIZE:
+        await reader.readexactly(PACKET_SIZE - size)
+    return operation, state, body[:room_name_size], body[room_name_size:], frame_version, request_id
+
+async def handle_tcp_stream(reader, writer):
+    """Serve the requests of one TCP connection until the client closes it
+    Requests with a RequestId are answered by tasks of their own, in the order
+    they are done, while the next ones are read.
+    """
+    global tcp_connections
+    addr = writer.get_extra_info('peername')
+    if tcp_connections >= max_tcp_connections:
+        # Refuse right away rather than hold the client until a slot frees up
+        writer.write(error_packet("Server busy, try again later"))
+        writer.close()
+        return
+    tcp_connections += 1
+    logger.debug('Client %s connected', addr)
+    version = PROTOCOL_V1
+    timeout = tcp_timeout
+    # Tasks answering pipelined requests
+    answering = set()
+    try:
+        while True:
+            if len(answering) >= MAX_PIPELINED:
+                await asyncio.wait(answering, return_when=asyncio.FIRST_COMPLETED)
+            try:
+                request = await asyncio.wait_for(read_tcp_request(reader, version), timeout)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                break
+            except ValueError as e:
+                writer.write(build_error_packet(str(e), version))
+                break
+            if request is None:
+                # Half-closed, the requests sent before still get their answers
+                if answering:
+                    await asyncio.wait(answering)
+                break
+
+            operation, state, room_name, operation_payload, version, request_id = request
+            if request_id:
+                # A control channel, idle between bursts of requests
+                timeout = control_timeout
+                task = asyncio.ensure_future(answer_pipelined(writer, request, addr))
+                answering.add(task)
+                task.add_done_callback(answering.discard)
+                continue
+            try:
+                started = time.perf_counter_ns()
+                version, responses = await dispatch_tcp_request(
+                    operation, state, room_name.decode(), operation_payload.decode(), addr, version)
+                if operation in JOIN_OPERATIONS:
+                    join_latency.record(time.perf_counter_ns() - started)
+            except Exception as e:
+                error_msg = f"Error handling client message: {str(e)}"
+                logger.warning(error_msg)
+                writer.write(build_error_packet(error_msg, version))
+                break
+            writer.writelines(responses)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    except asyncio.CancelledError:
+        # The server is shutting down, the connection is closed below. Returning
+        # keeps start_server from logging the cancellation as an error
+        pass
+    finally:
+        for task in answering:
+            task.cancel()
+        tcp_connections -= 1
+        writer.close()
+
+async def answer_pipelined(writer, request, addr):
+    """Answer a request with a RequestId with one frame carrying it, once it is done"""
+    operation, state, room_name, operation_payload, version, request_id = request
+    try:
+        started = time.perf_counter_ns()
+        _, responses = await dispatch_tcp_request(
+            operation, state, room_name.decode(), operation_payload.decode(), addr, version)
+        if operation in JOIN_OPERATIONS:
+            join_latency.record(time.perf_counter_ns() - started)
+        # The status frame before a response says nothing the response does not
+        frame = responses[-1]
+    except Exception as e:
+        error_msg = f"Error handling client message: {str(e)}"
+        logger.warning(error_msg)
+        frame = build_error_packet(error_msg, version)
+    if writer.is_closing():
+        return
+    writer.write(with_request_id(frame, request_id))
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+
+async def serve_tcp_asyncio(tcp_socket):
+    """Accept and serve TCP connections on the running event loop"""
+    # Other workers' datagrams and joins are handled on this loop
+    if channels is not None:
+        asyncio.get_running_loop().add_reader(channels.inbox, handle_inbox)
+    # start_server listens again with its own backlog, keep ours
+    server = await asyncio.start_server(handle_tcp_stream, sock=tcp_socket, backlog=tcp_backlog)
+    async with server:
+        await server.serve_forever()
+
+def serve_tcp_in_thread(tcp_socket):
+    """Run the TCP server on its own event loop in a daemon thread"""
+    thread = threading.Thread(target=asyncio.run, args=(serve_tcp_asyncio(tcp_socket),), daemon=True)
+    thread.start()
+    return thread
 
 """
 # UDP for chat
 ## 
 - chatroom is valid if the owner is in the chatroom
   if the owner is not in the chatroom, a chatroom will be deleted
-- client can join the chatroom if client has the unique token that is equal to client's address
+- client can join the chatroom if client has the unique token the server assigned it over tcp
+- the server sends the room's messages to the address the client's datagrams come from,
+  so right after joining the client sends a packet with an empty message to register it
 - if client(joiner) delete the chatroom, token will be deleted
 - packet format:
     - header:
@@ -410,7 +1605,44 @@ def handle_tcp_connection(conn, addr):
     - body:
         - RoomName(RoomNameSize)
         - Token(TokenSize)
-        - Message(4096 - RoomNameSize - TokenSize)
+        - Flags(1byte) + Seq(8byte) in v3 only, Flags: 0x01 ACK, 0x02 NACK, 0x04 RETRANSMIT, 0x08 BATCH,
+          0x10 COMPRESSED
+        - Message(4096 - RoomNameSize - TokenSize) in v1, zero-padded
+        - Message(rest of the datagram) in v2 and v3
+- with --member-rate / --room-rate, datagrams over a member's or a room's token bucket are
+  dropped without an answer; the member's is checked on the source address before decoding
+- v3 reliability:
+    - every message the room forwards gets the next per-room sequence number, its Seq
+      (0 when --history-bytes is 0: nothing can be retransmitted then)
+    - the server answers a v3 client's registration with Flags=ACK and the room's latest Seq,
+      and each message the client sends with an ACK of the Seq it got
+    - the client watches Seq for gaps and sends Flags=NACK, Seq = highest Seq received,
+      Message = First(8byte) + Count(2byte) for every missing range
+    - the server sends the missing messages again from the room's history with
+      Flags=RETRANSMIT, up to 64 per NACK; messages no longer in the history are gone
+    - the client sends Flags=ACK, Seq = highest Seq received as a heartbeat, the server
+      sends it the messages after Seq the same way, so a lost last message is recovered
+      too; ACKs and NACKs do not keep a client from expiring
+- v3 coalescing (--coalesce-ms): the messages of a busy room are held for a few ms and sent
+  to v3 members together, up to --coalesce-bytes per datagram:
+    - Flags=BATCH, Seq=0, TokenSize=0, Message = FrameSize(2byte) + Frame for every message,
+      Frame being the message's own v3 packet
+    - every v3 member gets the same batches, its own messages included, which it skips
+- v3 compression (--compression, --compression-dictionary), for clients granted it at join:
+    - Flags=COMPRESSED: Message is compressed as compression.py describes, a BATCH packet's
+      whole Message is compressed, its frames inside are not
+    - the server compresses each message or batch once for all these members, a message that
+      would not shrink is sent as it is; other members, history and retransmits get it plain
+    - a client granted compression may send compressed messages, the server forwards the
+      same bytes to the members that get compressed messages
+- several nodes (--state-server, --node-id, --relay-address) serve the same rooms:
+    - a state_server.py keeps which rooms exist and which node serves each member,
+      every node caches its part and the state server's events keep the caches fresh
+    - a client may join through any node and send to any node, the node its datagrams
+      go to serves it from then on; only its first datagram to a node asks the state server
+    - a node relays each message as a v2 packet to the relay address of every other node
+      serving members of the room, which sends it to its own members
+    - history and v3 sequence numbers are kept per node
 - control flow:
     - tcp connection is closed -> start udp connection
     - client send packet to server
@@ -420,53 +1652,340 @@ def handle_tcp_connection(conn, addr):
 
 """
 
-if __name__ == '__main__':
+def create_tcp_socket(address, port):
+    """Create the TCP socket that makes chatrooms and accepts clients"""
+    # IPPROTO_TCP spelled out: asyncio only sets TCP_NODELAY on the accepted
+    # sockets then, pipelined answers written one by one would wait on Nagle
+    tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    # Set socket options to allow reuse of address
+    tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Workers bind the same port and the kernel spreads clients across them
+    if workers > 1:
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # Bind socket to address and port
+    tcp_socket.bind((address, port))
+    tcp_socket.listen(tcp_backlog)
+    logger.info('Server listening on %s:%d', address, port)
+    return tcp_socket
+
+def create_udp_socket(address, port):
+    """Create the UDP socket for chat messages"""
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # Set socket options to allow reuse of address
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Workers bind the same port and the kernel spreads clients across them
+    if workers > 1:
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # Bind socket to address and port
+    udp_socket.bind((address, port))
+    logger.info('UDP server listening on %s:%d', address, port)
+    return udp_socket
+
+def handle_pooled_udp_message(buffer, nbytes, address):
+    """Handle a datagram received into a pooled buffer and give the buffer back"""
+    try:
+        with memoryview(buffer) as view:
+            route_udp_message(view[:nbytes], address)
+    finally:
+        buffer_pool.release(buffer)
+
+def handle_queued_udp_messages():
+    """Handler thread: validate and fan out the datagrams the receive thread queued"""
+    while True:
+        buffer, nbytes, address, queued = udp_queue.get()
+        queue_latency.record(time.perf_counter_ns() - queued)
+        try:
+            handle_pooled_udp_message(buffer, nbytes, address)
+        except Exception as e:
+            logger.warning('Error handling UDP message from %s: %s', address, e)
+
+def send_queued_packets():
+    """Send thread: send what the handler threads queued"""
+    while True:
+        room_name, packets, tokens = send_queue.get()
+        try:
+            deliver_to_members(room_name, packets, tokens)
+        except Exception as e:
+            logger.warning('Error sending to chatroom %s: %s', room_name, e)
+
+def start_udp_pipeline():
+    """Create the queues and start the handler and send threads"""
+    global buffer_pool, udp_queue, send_queue
+    # A buffer for every queued datagram and every one being received or handled
+    buffer_pool = BufferPool(udp_queue_depth + RECV_BATCH + handler_threads, PACKET_SIZE)
+    udp_queue = BoundedQueue(udp_queue_depth, drop_policy)
+    send_queue = queue.Queue(send_queue_depth)
+    for _ in range(handler_threads):
+        threading.Thread(target=handle_queued_udp_messages, daemon=True).start()
+    threading.Thread(target=send_queued_packets, daemon=True).start()
+
+def serve_udp_threaded():
+    """Receive stage: receive datagrams into pooled buffers and queue them for the handler threads
+    Under overload the queue drops datagrams by its policy, so the work held
+    in memory and the time a datagram waits stay bounded.
+    """
+    start_udp_pipeline()
+    if batch_io.BATCH_AVAILABLE:
+        batch_io.pin_buffers(buffer_pool.buffers)
+        receiver = batch_io.BatchReceiver([buffer_pool.acquire() for _ in range(RECV_BATCH)])
+    while True:
+        try:
+            # Receive messages from clients, as many as are queued in one recvmmsg
+            if batch_io.BATCH_AVAILABLE:
+                received = receiver.receive(udp_socket.fileno())
+            else:
+                buffer = buffer_pool.acquire()
+                try:
+                    received = [udp_socket.recvfrom_into(buffer)]
+                except Exception:
+                    buffer_pool.release(buffer)
+                    raise
+        except Exception as e:
+            logger.error('Server error: %s', e)
+            continue
+        for index, (nbytes, address) in enumerate(received):
+            if batch_io.BATCH_AVAILABLE:
+                buffer = receiver.buffers[index]
+                receiver.replace(index, buffer_pool.acquire())
+            # Early drop, before the datagram takes a place in the queue
+            if not accept_udp_message(address):
+                buffer_pool.release(buffer)
+                continue
+            # The fair policy queues by room name, taken as raw bytes
+            room_key = bytes(buffer[2:2 + buffer[0]]) if drop_policy == 'fair' else None
+            dropped = udp_queue.put((buffer, nbytes, address, time.perf_counter_ns()), room_key)
+            if dropped is not None:
+                buffer_pool.release(dropped[0])
+
+def serve_relay_threaded():
+    """Handle the messages other nodes relay to this node"""
+    while True:
+        try:
+            data, address = relay_socket.recvfrom(PACKET_SIZE)
+        except OSError as e:
+            logger.error('Relay error: %s', e)
+            continue
+        handle_relayed_message(data, address)
+
+class RelayProtocol(asyncio.DatagramProtocol):
+    """Handle relayed messages on the event loop"""
+
+    def datagram_received(self, data, addr):
+        handle_relayed_message(data, addr)
+
+class UDPServerProtocol(asyncio.DatagramProtocol):
+    """Handle every datagram on the event loop instead of in the threaded pipeline"""
+
+    def connection_made(self, transport):
+        global sock
+        # The transport has sendto() and close() like a socket,
+        # so the UDP handlers and cleanup_resources use it unchanged
+        sock = transport
+
+    def datagram_received(self, data, addr):
+        if accept_udp_message(addr):
+            route_udp_message(data, addr)
+
+    def error_received(self, exc):
+        logger.warning('UDP error: %s', exc)
+
+async def serve_udp_asyncio(udp_socket):
+    """Run the UDP handlers on one asyncio event loop"""
+    loop = asyncio.get_running_loop()
+    transports = []
     try:
-        # Create a TCP socket for the server that will make chatroom and accept clients
-        sock_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Define tcp server address and port
-        tcp_server_address = '0.0.0.0'
-        tcp_server_port = 9000  # TCP port for chatroom management
+        transport, _ = await loop.create_datagram_endpoint(UDPServerProtocol, sock=udp_socket)
+        transports.append(transport)
+        if relay_socket is not None:
+            transport, _ = await loop.create_datagram_endpoint(RelayProtocol, sock=relay_socket)
+            transports.append(transport)
+        # Serve until the process is stopped
+        await loop.create_future()
+    finally:
+        # Closed while the loop runs, a transport cannot be closed after
+        for transport in transports:
+            transport.close()
+
+def stop_serving(task):
+    """Signal handler of asyncio mode: cancel the serve task so asyncio.run unwinds"""
+    logger.info("Shutting down server...")
+    task.cancel()
 
-        # Set socket options to allow reuse of address
-        sock_tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+async def serve_asyncio(tcp_socket, udp_socket):
+    """Run the TCP server and the UDP handlers on the same event loop until SIGINT or SIGTERM"""
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop_serving, asyncio.current_task())
+    try:
+        await asyncio.gather(serve_tcp_asyncio(tcp_socket), serve_udp_asyncio(udp_socket))
+    except asyncio.CancelledError:
+        # Stopped by a signal, cleanup_resources runs once the loop has exited
+        pass
 
-        # Bind socket to address and port
-        sock_tcp.bind((tcp_server_address, tcp_server_port))
-        sock_tcp.listen(5)
-        print(f'Server listening on {tcp_server_address}:{tcp_server_port}')
-        # Accept incoming connections subthread
-        tcp_thread = threading.Thread(target=accept_tcp_connections, daemon=True)
-        tcp_thread.start()
+def parse_address(text):
+    """(host, port) of a HOST:PORT argument"""
+    host, _, port = text.rpartition(':')
+    try:
+        return host, int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected HOST:PORT, got {text!r}')
 
-        # Create a UDP socket for chat messages
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+def parse_args():
+    parser = argparse.ArgumentParser(description='Online chat messenger server')
+    parser.add_argument('--mode', choices=SERVER_MODES, default='threaded',
+                        help='UDP engine: handler threads behind a bounded queue or one asyncio event loop')
+    parser.add_argument('--host', default='0.0.0.0', help='address to bind the TCP and UDP sockets')
+    parser.add_argument('--tcp-port', type=int, default=9000, help='TCP port for chatroom management')
+    parser.add_argument('--udp-port', type=int, default=9001, help='UDP port for chat messages')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes sharing the ports with SO_REUSEPORT, rooms are split between them')
+    parser.add_argument('--tcp-backlog', type=int, default=4096,
+                        help='pending TCP connections queued by the kernel (capped by net.core.somaxconn)')
+    parser.add_argument('--max-connections', type=int, default=10000,
+                        help='TCP connections served at once, more are refused')
+    parser.add_argument('--tcp-timeout', type=float, default=10.0,
+                        help='seconds a TCP client may take to send a request before it is disconnected')
+    parser.add_argument('--control-timeout', type=float, default=300.0,
+                        help='seconds a control channel, a connection that pipelines requests, may stay idle')
+    parser.add_argument('--log-level', choices=logs.LOG_LEVELS, default='INFO',
+                        help='DEBUG logs every packet and join')
+    parser.add_argument('--log-sample-rate', type=int, default=10,
+                        help='log records per second let through from each call site, up to WARNING')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics (worker N uses PORT + N), 0 to disable')
+    parser.add_argument('--metrics-interval', type=float, default=60,
+                        help='seconds between metrics snapshots in the log, 0 to disable')
+    parser.add_argument('--history-bytes', type=int, default=65536,
+                        help='bytes of recent messages each room keeps for joiners, 0 to disable')
+    parser.add_argument('--history-messages', type=int, default=256,
+                        help='most recent messages each room keeps for joiners')
+    parser.add_argument('--coalesce-ms', type=float, default=0,
+                        help='milliseconds a room holds messages for v3 members to send them in one datagram, 0 to disable')
+    parser.add_argument('--coalesce-bytes', type=int, default=1400,
+                        help='largest datagram of coalesced messages, keep it under the path MTU')
+    parser.add_argument('--compression', action='store_true',
+                        help='compress messages for v3 clients that ask for it at join')
+    parser.add_argument('--compression-dictionary',
+                        help='shared dictionary to compress with (python compression.py train), implies --compression')
+    parser.add_argument('--queue-depth', type=int, default=1024,
+                        help='threaded mode: datagrams waiting for a handler thread, more are dropped')
+    parser.add_argument('--drop-policy', choices=DROP_POLICIES, default='drop-newest',
+                        help='threaded mode: datagram dropped when the queue is full, fair drops from the busiest room')
+    parser.add_argument('--handler-threads', type=int, default=4,
+                        help='threaded mode: threads validating and fanning out datagrams')
+    parser.add_argument('--send-queue-depth', type=int, default=64,
+                        help='threaded mode: fan-outs waiting for the send thread before handlers wait')
+    parser.add_argument('--member-rate', type=float, default=0,
+                        help='datagrams/sec each member may send, more are dropped, 0 for no limit')
+    parser.add_argument('--member-burst', type=float, default=20,
+                        help='datagrams a member may send at once above --member-rate')
+    parser.add_argument('--room-rate', type=float, default=0,
+                        help='messages/sec each room may forward, more are dropped, 0 for no limit')
+    parser.add_argument('--room-burst', type=float, default=100,
+                        help='messages a room may forward at once above --room-rate')
+    parser.add_argument('--state-server', type=parse_address,
+                        help='HOST:PORT of a state_server.py sharing room state with other nodes, default keeps it in this process')
+    parser.add_argument('--node-id', type=int, default=0,
+                        help='this node\'s id, unique among the nodes of a state server')
+    parser.add_argument('--relay-address', type=parse_address,
+                        help='HOST:PORT other nodes relay messages to this node on, needed with --state-server')
+    parser.add_argument('--state-dir',
+                        help='directory the rooms and members are saved to and restored from at startup '
+                             '(worker N uses DIR/worker-N), default keeps them in memory only')
+    parser.add_argument('--snapshot-interval', type=float, default=60,
+                        help='seconds between snapshots of the saved state, changes in between are logged')
+    parser.add_argument('--inactive-threshold', type=float, default=180,
+                        help='seconds without a message before a client leaves its room')
+    parser.add_argument('--expiry-granularity', type=float, default=1.0,
+                        help='seconds between expiry checks, clients expire at most this late')
+    args = parser.parse_args()
+    if args.state_server and not args.relay_address:
+        parser.error('--state-server needs --relay-address')
+    if args.state_server and args.state_dir:
+        parser.error('--state-dir is for a single node, the state server keeps the state of its nodes')
+    if args.state_server and args.workers > 1:
+        parser.error('--state-server serves one worker per node, run more nodes instead of --workers')
+    return args
 
-        # Define UDP server address and port
-        udp_server_address = '0.0.0.0'
-        udp_server_port = 9001  # UDP port for chat messages
+def serve(args):
+    """Serve clients in this process until it is stopped"""
+    global sock_tcp, sock, udp_socket
+    # Each process logs through its own listener thread
+    logs.configure_logging(args.log_level, args.log_sample_rate)
+    sock_tcp = create_tcp_socket(args.host, args.tcp_port)
+    sock = udp_socket = create_udp_socket(args.host, args.udp_port)
+    if args.state_server:
+        configure_backend(args.state_server, args.node_id, args.relay_address)
+    if args.state_dir:
+        restore_state(os.path.join(args.state_dir, f'worker-{worker_id}') if workers > 1 else args.state_dir)
 
-        # Set socket options to allow reuse of address
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Start thread to clean up inactive clients
+    cleanup_thread = threading.Thread(target=cleanup_clients, daemon=True)
+    cleanup_thread.start()
 
-        # Bind socket to address and port
-        sock.bind((udp_server_address, udp_server_port))
-        print(f'UDP server listening on {udp_server_address}:{udp_server_port}')
+    if args.metrics_port:
+        serve_metrics(metrics, '127.0.0.1', args.metrics_port + worker_id)
+    if args.metrics_interval:
+        start_snapshots(metrics, args.metrics_interval)
 
-        # Start thread to clean up inactive clients
-        cleanup_thread = threading.Thread(target=cleanup_clients, daemon=True)
-        cleanup_thread.start()
+    if args.mode == 'asyncio':
+        asyncio.run(serve_asyncio(sock_tcp, sock))
+    else:
+        # Accept incoming connections on an event loop in a subthread
+        serve_tcp_in_thread(sock_tcp)
+        if relay_socket is not None:
+            threading.Thread(target=serve_relay_threaded, daemon=True).start()
+        serve_udp_threaded()
 
-        while True:
+def serve_workers(args):
+    """Fork args.workers workers that each bind the ports and serve their share of rooms
+    The channels are created before forking so every worker can reach every other.
+    The parent only waits for the workers and stops them when it is stopped.
+    """
+    global workers, worker_id, channels, worker_pids
+    workers = args.workers
+    channels = worker_ipc.WorkerChannels(workers)
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            worker_id = index
+            worker_pids = []
+            channels.attach(index)
             try:
-                # Receive message from client
-                data, address = sock.recvfrom(4096)
-                # Handle client message in a new thread
-                thread = threading.Thread(target=handle_udp_message, args=(data, address))
-                thread.start()
-            except Exception as e:
-                print(f'Server error: {e}')
+                serve(args)
+            finally:
+                cleanup_resources()
+                os._exit(0)
+        worker_pids.append(pid)
+    logs.configure_logging(args.log_level, args.log_sample_rate)
+    logger.info('Started %d workers: %s', workers, worker_pids)
+    for pid in list(worker_pids):
+        _, status = os.waitpid(pid, 0)
+        worker_pids.remove(pid)
+        logger.info('Worker %d exited with status %d', pid, status)
+
+if __name__ == '__main__':
+    args = parse_args()
+    configure_expiry(args.inactive_threshold, args.expiry_granularity)
+    configure_history(args.history_bytes, args.history_messages)
+    configure_coalescing(args.coalesce_ms / 1000, args.coalesce_bytes)
+    configure_compression(args.compression, args.compression_dictionary)
+    configure_rate_limits(args.member_rate, args.member_burst, args.room_rate, args.room_burst)
+    tcp_backlog = args.tcp_backlog
+    max_tcp_connections = args.max_connections
+    tcp_timeout = args.tcp_timeout
+    control_timeout = args.control_timeout
+    udp_queue_depth = max(args.queue_depth, 1)
+    drop_policy = args.drop_policy
+    handler_threads = max(args.handler_threads, 1)
+    send_queue_depth = max(args.send_queue_depth, 1)
+    snapshot_interval = args.snapshot_interval
+    try:
+        if args.workers > 1:
+            serve_workers(args)
+        else:
+            serve(args)
     except KeyboardInterrupt:
-        print("\nServer interrupted by user")
+        logger.info("Server interrupted by user")
     finally:
-        cleanup_resources()
\ No newline at end of file
+        cleanup_resources()
@@ -0,0 +1,194 @@
+"""
+# Registry snapshots
+A state directory holds a snapshot of every room and member of a
+RoomRegistry and the change logs of what changed since, so a restarted
+server picks up its rooms, tokens and addresses and clients keep chatting.
+- registry.snapshot: written every few seconds to registry.snapshot.tmp,
+  then renamed over the old one
+- changes.<generation>: every change in the order it was made, appended
+  from the moment the snapshot of that generation started; the snapshot
+  may already hold some of them, replaying a change is harmless then
+Snapshot layout, little-endian:
+- header: Magic(8) 'CHATSNP1' + Generation(4) + SavedAt(8, time.time()) + RoomCount(4) + MemberCount(4)
+- room table, RoomCount times: RoomNameSize(1) + RoomName + MemberCount(4)
+- member records in room table order, the owner first in its room, 33 bytes each:
+  Token(16, the token's hex digits as bytes) + Version(1) + Node(2) + IP(4) + Port(2) + LastActive(8)
+  a member without an address yet has IP 0.0.0.0 and Port 0,
+  Version has COMPRESSED set for a member that gets compressed messages
+Change record: Op(1) + RoomNameSize(1) + Token(16) + Version(1) + Node(2) + IP(4) + Port(2) + RoomName,
+then NewToken(16) in a refresh record, the token that replaced Token
+Tokens are the server's TOKEN_BYTES random bytes in hex.
+"""
+import os
+import socket
+import struct
+import time
+
+SNAPSHOT_MAGIC = b'CHATSNP1'
+SNAPSHOT_FILE = 'registry.snapshot'
+CHANGES_PREFIX = 'changes.'
+SNAPSHOT_HEADER = struct.Struct('<8sIdII')
+ROOM_COUNT = struct.Struct('<I')
+MEMBER_RECORD = struct.Struct('<16sBH4sHd')
+CHANGE_RECORD = struct.Struct('<BB16sBH4sH')
+
+# Change record operations
+OP_CREATE = 1
+OP_JOIN = 2
+OP_LEAVE = 3
+OP_BIND = 4
+OP_DELETE = 5
+OP_DETACH = 6
+OP_REFRESH = 7
+
+# Version bit of a member that negotiated compression
+COMPRESSED = 0x80
+
+NO_TOKEN = bytes(16)
+NO_IP = bytes(4)
+
+def pack_address(address):
+    """(IP, Port) fields of an address, zero for None"""
+    if address is None:
+        return NO_IP, 0
+    return socket.inet_aton(address[0]), address[1]
+
+def unpack_address(ip, port):
+    if not port:
+        return None
+    return socket.inet_ntoa(ip), port
+
+def pack_version(version, compressed):
+    """Version field of a member"""
+    return version | COMPRESSED if compressed else version
+
+def unpack_version(field):
+    """(version, compressed) of a Version field"""
+    return field & ~COMPRESSED, bool(field & COMPRESSED)
+
+def snapshot_path(directory):
+    return os.path.join(directory, SNAPSHOT_FILE)
+
+def changes_path(directory, generation):
+    return os.path.join(directory, f'{CHANGES_PREFIX}{generation}')
+
+def change_generations(directory):
+    """Generations of the change logs in directory, oldest first"""
+    generations = []
+    for name in os.listdir(directory):
+        if name.startswith(CHANGES_PREFIX) and name[len(CHANGES_PREFIX):].isdigit():
+            generations.append(int(name[len(CHANGES_PREFIX):]))
+    return sorted(generations)
+
+def write_snapshot(directory, generation, rooms):
+    """Write rooms as the snapshot of generation, replacing the last one only once it is complete
+    Args:
+        rooms: list of (room_name, members), the owner's Member first
+    """
+    table = []
+    records = []
+    for room_name, members in rooms:
+        name = room_name.encode()
+        table.append(bytes((len(name),)) + name + ROOM_COUNT.pack(len(members)))
+        for member in members:
+            ip, port = pack_address(member.address)
+            records.append(MEMBER_RECORD.pack(bytes.fromhex(member.token),
+                                              pack_version(member.version, member.compressed), member.node,
+                                              ip, port, member.last_active))
+    path = snapshot_path(directory)
+    with open(path + '.tmp', 'wb') as snapshot:
+        snapshot.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, generation, time.time(), len(table), len(records)))
+        snapshot.write(b''.join(table))
+        snapshot.write(b''.join(records))
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(path + '.tmp', path)
+
+def read_snapshot(directory):
+    """Read the snapshot's room table, leaving the member records packed
+    Returns:
+        (generation, saved_at, {room_name: (first record, member count)}, records),
+        None if there is no snapshot
+    Raises:
+        ValueError: if the file is not a snapshot
+    """
+    try:
+        with open(snapshot_path(directory), 'rb') as snapshot:
+            data = snapshot.read()
+    except FileNotFoundError:
+        return None
+    magic, generation, saved_at, room_count, member_count = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError(f'{snapshot_path(directory)} is not a registry snapshot')
+    offset = SNAPSHOT_HEADER.size
+    rooms = {}
+    first = 0
+    for _ in range(room_count):
+        size = data[offset]
+        room_name = data[offset + 1:offset + 1 + size].decode()
+        count, = ROOM_COUNT.unpack_from(data, offset + 1 + size)
+        rooms[room_name] = (first, count)
+        first += count
+        offset += 1 + size + ROOM_COUNT.size
+    records = memoryview(data)[offset:offset + member_count * MEMBER_RECORD.size]
+    return generation, saved_at, rooms, records
+
+def iter_members(records, first, count):
+    """(token, version, compressed, node, address, last_active) of count member records from first"""
+    start = first * MEMBER_RECORD.size
+    for token, version, node, ip, port, last_active in MEMBER_RECORD.iter_unpack(
+            records[start:start + count * MEMBER_RECORD.size]):
+        version, compressed = unpack_version(version)
+        yield token.hex(), version, compressed, node, unpack_address(ip, port), last_active
+
+class ChangeLog:
+    """Append-only log of registry changes
+    Records are buffered and reach the file when flush() is called, the
+    caller orders them, RoomRegistry writes them under its lock.
+    """
+
+    def __init__(self, directory, generation):
+        self.generation = generation
+        self.file = open(changes_path(directory, generation), 'ab')
+
+    def record(self, op, room_name, token=None, version=0, node=0, address=None, compressed=False, new_token=None):
+        name = room_name.encode()
+        ip, port = pack_address(address)
+        self.file.write(CHANGE_RECORD.pack(op, len(name), bytes.fromhex(token) if token else NO_TOKEN,
+                                           pack_version(version, compressed), node, ip, port) + name)
+        if op == OP_REFRESH:
+            self.file.write(bytes.fromhex(new_token))
+
+    def flush(self, sync=False):
+        """Write the buffered records, sync also waits until they are on disk"""
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush(sync=True)
+        self.file.close()
+
+def read_changes(directory, generation):
+    """(op, room_name, token, version, node, address, compressed, new_token) of every record in a change log
+    A record cut short by a crash ends the log.
+    """
+    with open(changes_path(directory, generation), 'rb') as changes:
+        data = changes.read()
+    offset = 0
+    while offset + CHANGE_RECORD.size <= len(data):
+        op, size, token, version, node, ip, port = CHANGE_RECORD.unpack_from(data, offset)
+        offset += CHANGE_RECORD.size
+        if offset + size > len(data):
+            break
+        room_name = data[offset:offset + size].decode()
+        offset += size
+        new_token = None
+        if op == OP_REFRESH:
+            if offset + 16 > len(data):
+                break
+            new_token = data[offset:offset + 16].hex()
+            offset += 16
+        version, compressed = unpack_version(version)
+        yield (op, room_name, token.hex() if token != NO_TOKEN else None, version, node, unpack_address(ip, port),
+               compressed, new_token)
@@ -0,0 +1,90 @@
+"""
+# State server
+Keeps the room state of every server node in one MemoryBackend and serves
+it over TCP, a local stand-in for a networked store shared by the nodes.
+- every request is a JSON line {"op": operation, "args": [...]}, answered in
+  order with {"result": ...} or {"error": message}; the operations are the
+  MemoryBackend methods in OPERATIONS
+- a connection that sends {"op": "subscribe"} gets every change from then on
+  instead, as {"event": [event, room_name, token, node]}
+
+usage:
+    python state_server.py --port 9100
+    python server.py --state-server 127.0.0.1:9100 --node-id 0 --relay-address 127.0.0.1:9102
+    python server.py --state-server 127.0.0.1:9100 --node-id 1 --relay-address 127.0.0.1:9112 \\
+        --tcp-port 9010 --udp-port 9011
+"""
+import argparse
+import asyncio
+import json
+import logging
+
+import logs
+from room_backend import MemoryBackend
+
+logger = logging.getLogger('chat.state')
+
+OPERATIONS = ('create_room', 'join', 'leave', 'claim', 'refresh', 'member', 'room', 'room_nodes', 'register_node',
+              'nodes')
+
+state = MemoryBackend()
+# Writers of the subscribed connections
+subscribers = set()
+
+def publish(event, room_name, token, node):
+    line = json.dumps({'event': [event, room_name, token, node]}).encode() + b'\n'
+    for writer in subscribers:
+        writer.write(line)
+
+def answer(request):
+    """Carry out one request
+    Returns:
+        the response to send back
+    """
+    op = request.get('op')
+    if op not in OPERATIONS:
+        return {'error': f'Unknown operation {op!r}'}
+    try:
+        return {'result': getattr(state, op)(*request.get('args', []))}
+    except Exception as e:
+        return {'error': str(e)}
+
+async def serve_connection(reader, writer):
+    address = writer.get_extra_info('peername')
+    logger.info('Node connected from %s', address)
+    try:
+        async for line in reader:
+            request = json.loads(line)
+            if request.get('op') == 'subscribe':
+                subscribers.add(writer)
+                continue
+            writer.write(json.dumps(answer(request)).encode() + b'\n')
+            await writer.drain()
+    except (ConnectionError, ValueError) as e:
+        logger.warning('Closing connection from %s: %s', address, e)
+    finally:
+        subscribers.discard(writer)
+        writer.close()
+        logger.info('Node at %s disconnected', address)
+
+async def serve(host, port):
+    # Events are published from the request being answered, on the event loop
+    state.subscribe(publish)
+    server = await asyncio.start_server(serve_connection, host, port)
+    logger.info('State server listening on %s:%d', host, port)
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Room state shared by chat server nodes')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--log-level', choices=logs.LOG_LEVELS, default='INFO')
+    args = parser.parse_args()
+    logs.configure_logging(args.log_level)
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logs.stop_logging()
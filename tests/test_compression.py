@@ -0,0 +1,58 @@
+import errno
+
+import server
+from compression import Codec
+from room_registry import RoomRegistry
+from wire import (FLAG_COMPRESSED, PACKET_SIZE, PROTOCOL_V2, PROTOCOL_V3, build_udp_packet, compress_packet,
+                  parse_v3_header)
+
+OWNER = 'a' * 32
+MEMBER = 'b' * 32
+OWNER_ADDRESS = ('127.0.0.1', 5000)
+MEMBER_ADDRESS = ('127.0.0.1', 5001)
+
+class Socket:
+    """Keeps what the server sends, refuses what a UDP socket would"""
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, packet, address):
+        if len(packet) > 65507:
+            raise OSError(errno.EMSGSIZE, 'Message too long')
+        self.sent.append((bytes(packet), address))
+
+def compressed_room(monkeypatch):
+    """A room of a v3 owner that compresses and a v2 member, and what the server sends"""
+    registry = RoomRegistry()
+    registry.create_room('lobby', OWNER, OWNER_ADDRESS, PROTOCOL_V3, compressed=True)
+    registry.join('lobby', MEMBER, MEMBER_ADDRESS, PROTOCOL_V2)
+    sock = Socket()
+    monkeypatch.setattr(server, 'registry', registry)
+    monkeypatch.setattr(server, 'codec', Codec())
+    monkeypatch.setattr(server, 'sock', sock)
+    return registry, sock
+
+def send(message):
+    packet = compress_packet(build_udp_packet('lobby', OWNER, message, PROTOCOL_V3), server.codec)
+    assert parse_v3_header(packet, 2 + packet[0] + packet[1])[0] & FLAG_COMPRESSED
+    server.handle_udp_message(packet, OWNER_ADDRESS)
+
+def test_compressed_message_is_forwarded_decompressed(monkeypatch):
+    registry, sock = compressed_room(monkeypatch)
+    send('hello ' * 100)
+    forwarded = [packet for packet, address in sock.sent if address == MEMBER_ADDRESS]
+    assert len(forwarded) == 1 and forwarded[0].endswith(('hello ' * 100).encode())
+
+def tokens(registry):
+    return {member.token for member in registry.members('lobby')}
+
+def test_oversized_compressed_message_is_dropped(monkeypatch):
+    registry, sock = compressed_room(monkeypatch)
+    # Compresses to a few hundred bytes, decompressed it fits no v2 frame
+    send('a' * 60000)
+    # Only the sender hears of it, and nobody is dropped for a send that failed
+    assert [address for _, address in sock.sent] == [OWNER_ADDRESS]
+    assert tokens(registry) == {OWNER, MEMBER}
+    send('a' * (PACKET_SIZE + 1))
+    assert tokens(registry) == {OWNER, MEMBER}
@@ -0,0 +1,61 @@
+import random
+
+from expiry import TimingWheel
+
+def test_never_due_before_its_deadline():
+    rng = random.Random(1)
+    wheel = TimingWheel(horizon=10.0, granularity=0.5, now=0.0)
+    deadlines = {}
+    for item in range(500):
+        deadlines[item] = rng.uniform(0.0, 9.5)
+        wheel.schedule(item, deadlines[item])
+    now = 0.0
+    while deadlines:
+        now += rng.uniform(0.01, 0.7)
+        for item in wheel.advance(now):
+            assert deadlines.pop(item) <= now
+        # Due within one granularity of the deadline
+        assert all(deadline > now - 0.5 for deadline in deadlines.values())
+    assert len(wheel) == 0
+
+def test_deadline_on_a_tick_boundary():
+    wheel = TimingWheel(horizon=10.0, granularity=1.0, now=0.0)
+    wheel.schedule('item', 3.0)
+    assert wheel.advance(2.999) == []
+    assert wheel.advance(3.0) == ['item']
+
+def test_reschedule_replaces_the_earlier_deadline():
+    wheel = TimingWheel(horizon=10.0, granularity=1.0, now=0.0)
+    wheel.schedule('item', 2.0)
+    wheel.schedule('item', 5.0)
+    assert wheel.advance(4.0) == []
+    assert wheel.advance(5.0) == ['item']
+    assert len(wheel) == 0
+
+def test_discard():
+    wheel = TimingWheel(horizon=10.0, granularity=1.0, now=0.0)
+    wheel.schedule('item', 2.0)
+    wheel.discard('item')
+    wheel.discard('item')
+    assert wheel.advance(5.0) == [] and len(wheel) == 0
+
+def test_past_deadline_is_due_on_the_next_advance():
+    wheel = TimingWheel(horizon=10.0, granularity=1.0, now=5.0)
+    wheel.schedule('item', 1.0)
+    assert wheel.advance(5.0) == ['item']
+
+def test_beyond_the_horizon_comes_due_early_to_be_rescheduled():
+    wheel = TimingWheel(horizon=4.0, granularity=1.0, now=0.0)
+    wheel.schedule('item', 100.0)
+    # Parked in the last slot, never due before the horizon
+    assert wheel.advance(3.0) == []
+    assert wheel.advance(4.0) == ['item']
+
+def test_long_pause_visits_every_slot_once():
+    wheel = TimingWheel(horizon=4.0, granularity=1.0, now=0.0)
+    for item in range(4):
+        wheel.schedule(item, item + 1.0)
+    assert sorted(wheel.advance(1000.0)) == [0, 1, 2, 3]
+    wheel.schedule('late', 1002.0)
+    assert wheel.advance(1001.0) == []
+    assert wheel.advance(1002.0) == ['late']
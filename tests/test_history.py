@@ -0,0 +1,58 @@
+import random
+
+from history import MessageHistory
+
+def frames_of(history):
+    return history.since(0)
+
+def test_sequence_numbers_and_last():
+    history = MessageHistory(1024, 8)
+    assert [history.append(b'frame %d' % index) for index in range(3)] == [1, 2, 3]
+    assert history.last(2) == [(2, b'frame 1'), (3, b'frame 2')]
+    assert history.last(10) == history.last() == frames_of(history)
+    assert history.last(0) == []
+
+def test_since_at_the_boundaries():
+    history = MessageHistory(1024, 4)
+    for index in range(6):
+        history.append(b'%d' % index)
+    # 1 and 2 were evicted, 3 to 6 are kept
+    assert history.first_seq == 3 and history.next_seq == 7
+    assert [seq for seq, _ in history.since(0)] == [3, 4, 5, 6]
+    assert [seq for seq, _ in history.since(2)] == [3, 4, 5, 6]
+    assert [seq for seq, _ in history.since(3)] == [4, 5, 6]
+    assert history.since(6) == []
+    assert history.since(100) == []
+    assert [seq for seq, _ in history.since(3, count=2)] == [4, 5]
+
+def test_frames_wrap_around_the_ring():
+    history = MessageHistory(100, 100)
+    for index in range(3):
+        history.append(bytes([index]) * 30)
+    # 10 bytes are left at the end, the next frame wraps and overwrites the first
+    assert history.append(b'\x03' * 30) == 4
+    assert history.write == 30
+    assert frames_of(history) == [(2, b'\x01' * 30), (3, b'\x02' * 30), (4, b'\x03' * 30)]
+
+def test_randomized_against_a_list():
+    rng = random.Random(1)
+    history = MessageHistory(256, 10)
+    sent = []
+    for index in range(2000):
+        frame = bytes([index % 256]) * rng.randint(1, 120)
+        sent.append((history.append(frame), frame))
+        kept = frames_of(history)
+        # The newest frames, as many as fit in the ring and max_messages
+        assert kept == sent[len(sent) - len(kept):]
+        assert kept[-1] == sent[-1]
+        assert len(kept) <= 10 and sum(len(frame) for _, frame in kept) <= 256
+        count = rng.randint(0, 12)
+        assert history.last(count) == kept[max(len(kept) - count, 0):]
+
+def test_frame_larger_than_the_ring():
+    history = MessageHistory(16, 8)
+    history.append(b'small')
+    assert history.append(b'x' * 17) == 2
+    assert frames_of(history) == []
+    assert history.append(b'next') == 3
+    assert frames_of(history) == [(3, b'next')]
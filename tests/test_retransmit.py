@@ -0,0 +1,116 @@
+import asyncio
+
+import server
+from chat_client import NACK_RETRIES, ChatClient
+from room_registry import RoomRegistry
+from wire import (FLAG_ACK, FLAG_NACK, FLAG_RETRANSMIT, PROTOCOL_V2, PROTOCOL_V3, build_udp_packet, pack_nack,
+                  parse_v3_header, split_nack)
+
+TOKEN = 'a' * 32
+
+class Transport:
+    """Keeps what a client sends"""
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, packet, address):
+        self.sent.append(bytes(packet))
+
+class Endpoint:
+    def __init__(self):
+        self.transport = Transport()
+
+def test_nack_ranges_round_trip():
+    ranges = [(1, 3), (2**64 - 1, 65535)]
+    assert split_nack(pack_nack(ranges)) == ranges
+    # A range cut short is left out
+    assert split_nack(pack_nack(ranges)[:-1]) == ranges[:1]
+    assert split_nack(b'') == []
+
+def nack_client():
+    client = ChatClient(version=PROTOCOL_V3)
+    client.room_name = 'lobby'
+    client.token = TOKEN
+    client.endpoint = Endpoint()
+    return client
+
+def sent_ranges(client):
+    """(first, count) ranges of every NACK the client sent"""
+    ranges = []
+    for packet in client.endpoint.transport.sent:
+        message_start = 2 + packet[0] + packet[1]
+        flags, _ = parse_v3_header(packet, message_start)
+        assert flags & FLAG_NACK
+        ranges.append(split_nack(packet[message_start + 9:]))
+    return ranges
+
+def test_client_tracks_gaps_and_nacks_ranges():
+    async def run():
+        client = nack_client()
+        for seq in (1, 2, 6, 7, 9):
+            assert client._track(seq)
+        assert sorted(client.missing) == [3, 4, 5, 8]
+        # A duplicate is not delivered again, a late message fills its gap
+        assert not client._track(7)
+        assert client._track(4)
+        client._send_nack()
+        assert sent_ranges(client) == [[(3, 1), (5, 1), (8, 1)]]
+        client.nack_timer.cancel()
+    asyncio.run(run())
+
+def test_client_gives_up_after_its_retries():
+    async def run():
+        client = nack_client()
+        client._track(1)
+        client._track(4)
+        for _ in range(NACK_RETRIES + 1):
+            client._send_nack()
+        assert sent_ranges(client) == [[(2, 2)]] * NACK_RETRIES
+        assert client.missing == {} and client.lost == 2
+        assert client.nack_timer is None
+    asyncio.run(run())
+
+def server_room(monkeypatch, messages, history_messages=256):
+    """The server's registry with a v3 member in a room of messages, and the packets it sends"""
+    registry = RoomRegistry(history_messages=history_messages)
+    member = registry.create_room('lobby', TOKEN, ('127.0.0.1', 5000), PROTOCOL_V3)
+    for index in range(messages):
+        registry.append_history('lobby', build_udp_packet('lobby', TOKEN, f'message {index + 1}', PROTOCOL_V2))
+    sent = []
+    monkeypatch.setattr(server, 'registry', registry)
+    monkeypatch.setattr(server, 'send_packets', lambda packets: sent.extend(packets) or [])
+    return member, sent
+
+def retransmitted(sent):
+    """Seq of every packet sent, each one a retransmission"""
+    seqs = []
+    for packet, _ in sent:
+        flags, seq = parse_v3_header(packet, 2 + packet[0] + packet[1])
+        assert flags == FLAG_RETRANSMIT
+        seqs.append(seq)
+    return seqs
+
+def test_server_retransmits_nacked_ranges(monkeypatch):
+    member, sent = server_room(monkeypatch, 10)
+    server.handle_control_packet(member, FLAG_NACK, 10, pack_nack([(2, 2), (7, 1), (10, 5)]), ('127.0.0.1', 5000))
+    assert retransmitted(sent) == [2, 3, 7, 10]
+    assert sent[0][0].endswith(b'message 2')
+
+def test_server_skips_what_left_the_history(monkeypatch):
+    member, sent = server_room(monkeypatch, 10, history_messages=4)
+    server.handle_control_packet(member, FLAG_NACK, 10, pack_nack([(1, 8)]), ('127.0.0.1', 5000))
+    assert retransmitted(sent) == [7, 8]
+
+def test_server_caps_a_retransmission(monkeypatch):
+    member, sent = server_room(monkeypatch, 200)
+    server.handle_control_packet(member, FLAG_NACK, 200, pack_nack([(1, 100), (150, 50)]), ('127.0.0.1', 5000))
+    assert retransmitted(sent) == list(range(1, server.MAX_RETRANSMIT + 1))
+
+def test_server_answers_a_heartbeat_with_the_tail(monkeypatch):
+    member, sent = server_room(monkeypatch, 10)
+    server.handle_control_packet(member, FLAG_ACK, 7, b'', ('127.0.0.1', 5000))
+    assert retransmitted(sent) == [8, 9, 10]
+    sent.clear()
+    server.handle_control_packet(member, FLAG_ACK, 10, b'', ('127.0.0.1', 5000))
+    assert sent == []
@@ -0,0 +1,44 @@
+import server
+from room_backend import LocalBackend
+from room_registry import RoomRegistry
+
+OWNER = 'a' * 32
+MEMBER = 'b' * 32
+
+def single_node(monkeypatch):
+    """The server's registry, read by the backend of a node without a state server"""
+    registry = RoomRegistry()
+    monkeypatch.setattr(server, 'registry', registry)
+    monkeypatch.setattr(server, 'backend', LocalBackend(registry))
+    return registry
+
+def test_local_backend_reads_the_registry(monkeypatch):
+    registry = single_node(monkeypatch)
+    assert server.create_chatroom('lobby', None, OWNER, 3)
+    assert server.join_chatroom('lobby', None, MEMBER, 2)
+    assert server.backend.room('lobby') == (OWNER, 0, 3)
+    assert server.backend.member(MEMBER) == ('lobby', 0, 2)
+    assert server.backend.room_nodes('lobby') == [0]
+
+    member = server.refresh_member_token('lobby', MEMBER)
+    assert server.backend.member(MEMBER) is None
+    assert server.backend.member(member.token) == ('lobby', 0, 2)
+
+    server.leave_chatroom('lobby', member.token)
+    assert [member.token for member in registry.members('lobby')] == [OWNER]
+    server.leave_chatroom('lobby', OWNER)
+    assert 'lobby' not in registry and server.backend.room('lobby') is None
+
+def test_local_backend_refuses_what_the_registry_does(monkeypatch):
+    registry = single_node(monkeypatch)
+    assert server.create_chatroom('lobby', None, OWNER, 3)
+    assert not server.create_chatroom('lobby', None, MEMBER, 3)
+    assert not server.create_chatroom('other', None, OWNER, 3)
+    assert not server.join_chatroom('missing', None, MEMBER, 3)
+    assert not server.join_chatroom('lobby', None, OWNER, 3)
+    # A room made between the backend's answer and the registry's is not taken over
+    registry.create_room('late', MEMBER, None, 3)
+    monkeypatch.setattr(server.backend, 'create_room', lambda *args: True)
+    assert not server.create_chatroom('late', None, 'c' * 32, 3)
+    assert registry.owner('late') == MEMBER
+    assert 'other' not in registry
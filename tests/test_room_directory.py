@@ -0,0 +1,84 @@
+import random
+
+import pytest
+
+import room_directory
+from room_directory import RoomDirectory
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # Chunks split and empty out after a few names
+    monkeypatch.setattr(room_directory, 'CHUNK_SIZE', 4)
+
+def walk(directory, page_size, prefix=''):
+    """Every name under prefix, a page at a time by cursor"""
+    names = []
+    cursor = None
+    while True:
+        page, more = directory.page(page_size, cursor, prefix)
+        names.extend(page)
+        if not more:
+            return names
+        cursor = page[-1]
+
+def test_add_and_discard():
+    directory = RoomDirectory(['b', 'a'])
+    assert directory.add('c') and not directory.add('a')
+    assert directory.discard('b') and not directory.discard('b')
+    assert len(directory) == 2
+    assert directory.page(10) == (['a', 'c'], False)
+    assert RoomDirectory().page(10) == ([], False)
+    assert not RoomDirectory().discard('a')
+
+def test_pages_across_chunk_splits():
+    names = [f'room-{index:03d}' for index in range(100)]
+    directory = RoomDirectory()
+    for name in random.Random(1).sample(names, len(names)):
+        directory.add(name)
+    assert len(directory.chunks) > 1
+    assert directory.firsts == [chunk[0] for chunk in directory.chunks]
+    for page_size in (1, 3, 8, 100, 1000):
+        assert walk(directory, page_size) == names
+    assert directory.page(3, 'room-049') == (['room-050', 'room-051', 'room-052'], True)
+    assert directory.page(5, 'room-097') == (['room-098', 'room-099'], False)
+    assert directory.page(0) == ([], True)
+
+def test_prefix_search():
+    directory = RoomDirectory(['lab', 'lobby', 'lobby two', 'lock', 'loft', 'm', 'l'])
+    assert walk(directory, 2, 'lo') == ['lobby', 'lobby two', 'lock', 'loft']
+    assert directory.page(10, 'lobby', 'lob') == (['lobby two'], False)
+    # A cursor before the prefix starts at the prefix
+    assert directory.page(10, 'a', 'm') == (['m'], False)
+    assert directory.page(10, prefix='x') == ([], False)
+
+def test_cursor_paging_while_rooms_change():
+    rng = random.Random(2)
+    directory = RoomDirectory(f'room-{index:04d}' for index in range(0, 2000, 2))
+    present = set(directory.page(5000)[0])
+    for _ in range(20):
+        listed = []
+        # Present for the whole walk, these must be listed exactly once
+        stable = set(present)
+        cursor = None
+        while True:
+            page, more = directory.page(7, cursor)
+            assert page == sorted(page)
+            assert cursor is None or all(name > cursor for name in page)
+            listed.extend(page)
+            for _ in range(5):
+                name = f'room-{rng.randrange(2000):04d}'
+                if name in present:
+                    directory.discard(name)
+                    present.discard(name)
+                    stable.discard(name)
+                else:
+                    directory.add(name)
+                    present.add(name)
+            if not more:
+                break
+            cursor = page[-1]
+        assert listed == sorted(set(listed))
+        assert stable <= set(listed)
+        assert directory.firsts == [chunk[0] for chunk in directory.chunks]
+        assert all(directory.chunks) and len(directory) == len(present)
+    assert walk(directory, 50) == sorted(present)
@@ -0,0 +1,80 @@
+from room_registry import RoomRegistry
+
+OWNER = 'a' * 32
+JOINER = 'b' * 32
+OTHER = 'c' * 32
+
+def make_room(registry=None):
+    registry = registry or RoomRegistry()
+    registry.create_room('lobby', OWNER, ('127.0.0.1', 5000), 2)
+    registry.join('lobby', JOINER, ('127.0.0.1', 5001), 3)
+    return registry
+
+def test_create_and_join_index_tokens_and_addresses():
+    registry = make_room()
+    assert 'lobby' in registry
+    assert registry.owner('lobby') == OWNER
+    assert registry.validate('lobby', JOINER).version == 3
+    assert registry.member_for_address(('127.0.0.1', 5001)).token == JOINER
+    assert registry.member_count() == 2
+
+def test_create_refuses_existing_room_and_taken_token():
+    registry = make_room()
+    assert registry.create_room('lobby', OTHER, None, 2) is None
+    assert registry.create_room('hall', JOINER, None, 2) is None
+    assert registry.join('lobby', JOINER, None, 2) is None
+
+def test_validate_checks_the_room_of_the_token():
+    registry = make_room()
+    registry.create_room('hall', OTHER, None, 2)
+    assert registry.validate('hall', JOINER) is None
+    assert registry.validate('missing', JOINER) is None
+
+def test_member_leaving_keeps_the_room():
+    registry = make_room()
+    member, room_deleted = registry.leave('lobby', JOINER)
+    assert member.token == JOINER and not room_deleted
+    assert registry.validate('lobby', JOINER) is None
+    assert registry.member_for_address(('127.0.0.1', 5001)) is None
+    assert registry.leave('lobby', JOINER) == (None, False)
+
+def test_owner_leaving_deletes_the_room_and_unindexes_everyone():
+    registry = make_room()
+    member, room_deleted = registry.leave('lobby', OWNER)
+    assert member.token == OWNER and room_deleted
+    assert 'lobby' not in registry
+    assert registry.member_for_token(JOINER) is None
+    assert registry.addresses == {}
+    assert registry.room_page(10) == ([], False)
+
+def test_addresses_shared_by_several_members():
+    registry = make_room()
+    registry.create_room('hall', OTHER, None, 2)
+    registry.bind_address(registry.member('hall', OTHER), ('127.0.0.1', 5001))
+    # Two members send from the address, neither is its only member
+    assert registry.member_for_address(('127.0.0.1', 5001)) is None
+    registry.leave('hall', OTHER)
+    assert registry.member_for_address(('127.0.0.1', 5001)).token == JOINER
+
+def test_refresh_token_keeps_member_and_ownership():
+    registry = make_room()
+    member = registry.refresh_token('lobby', OWNER, OTHER)
+    assert member.token == OTHER and member.address == ('127.0.0.1', 5000)
+    assert registry.owner('lobby') == OTHER
+    assert registry.validate('lobby', OWNER) is None
+    assert registry.refresh_token('lobby', JOINER, OTHER) is None
+
+def test_delete_room_returns_its_members():
+    registry = make_room()
+    members = registry.delete_room('lobby')
+    assert sorted(member.token for member in members) == [OWNER, JOINER]
+    assert len(registry) == 0 and registry.tokens == {}
+    assert registry.delete_room('lobby') == []
+
+def test_room_page_counts_members():
+    registry = make_room()
+    registry.create_room('hall', OTHER, None, 2)
+    assert registry.room_page(10) == ([('hall', 1), ('lobby', 2)], False)
+    assert registry.room_page(1) == ([('hall', 1)], True)
+    assert registry.room_page(10, 'hall') == ([('lobby', 2)], False)
+    assert registry.room_page(10, prefix='lo') == ([('lobby', 2)], False)
@@ -0,0 +1,98 @@
+import snapshot
+from room_registry import RoomRegistry
+
+def token(index):
+    return f'{index:032x}'
+
+def state(registry):
+    """Every room of the registry with its owner and members, and its indexes"""
+    while registry.restore_some(1024):
+        pass
+    rooms = {}
+    for room_name, members in registry.snapshot_rooms():
+        rooms[room_name] = (members[0].token, {member.token: (member.version, member.node, member.address,
+                                                              member.compressed) for member in members})
+    return rooms, sorted(registry.tokens), sorted(registry.addresses), registry.room_page(1000)
+
+def fill(registry, rooms, start=0):
+    for index in range(start, start + rooms):
+        room_name = f'room-{index}'
+        registry.create_room(room_name, token(index * 10), ('10.0.0.1', 1000 + index), 2)
+        for member in range(1, 4):
+            registry.join(room_name, token(index * 10 + member), None, 3, node=member % 2,
+                          compressed=member == 3)
+
+def restored(directory):
+    """A registry restored from directory the way server.restore_state does it"""
+    registry = RoomRegistry()
+    loaded = snapshot.read_snapshot(directory)
+    generation = 0
+    if loaded is not None:
+        generation, _, rooms, records = loaded
+        registry.restore(rooms, records, 0.0)
+    for number in snapshot.change_generations(directory):
+        if number >= generation:
+            for change in snapshot.read_changes(directory, number):
+                registry.apply_change(*change)
+    return registry
+
+def test_snapshot_round_trip(tmp_path):
+    registry = RoomRegistry()
+    fill(registry, 20)
+    registry.bind_address(registry.member('room-3', token(31)), ('10.0.0.2', 2000))
+    snapshot.write_snapshot(str(tmp_path), 1, registry.snapshot_rooms())
+    copy = restored(str(tmp_path))
+    assert len(copy) == 20 and copy.member_count() == 80
+    assert state(copy) == state(registry)
+    assert copy.member('room-3', token(31)).last_active == registry.member('room-3', token(31)).last_active
+
+def test_rooms_are_built_on_first_use(tmp_path):
+    registry = RoomRegistry()
+    fill(registry, 3)
+    snapshot.write_snapshot(str(tmp_path), 1, registry.snapshot_rooms())
+    copy = restored(str(tmp_path))
+    assert len(copy.restoring) == 3
+    assert copy.validate('room-1', token(12)).version == 3
+    assert 'room-1' not in copy.restoring and len(copy.restoring) == 2
+    # Listed with their member counts before they are built
+    assert copy.room_page(10) == ([('room-0', 4), ('room-1', 4), ('room-2', 4)], False)
+
+def test_change_log_replay_after_a_snapshot(tmp_path):
+    directory = str(tmp_path)
+    registry = RoomRegistry()
+    registry.swap_changes(snapshot.ChangeLog(directory, 1))
+    fill(registry, 10)
+    # Taken while changes go on, the log repeats what the snapshot has
+    snapshot.write_snapshot(directory, 1, registry.snapshot_rooms())
+    registry.swap_changes(snapshot.ChangeLog(directory, 2)).close()
+    fill(registry, 3, start=10)
+    registry.leave('room-0', token(1))
+    registry.leave('room-1', token(10))
+    registry.delete_room('room-2')
+    registry.refresh_token('room-3', token(30), token(999))
+    registry.refresh_token('room-11', token(112), token(998))
+    registry.bind_address(registry.member('room-4', token(41)), ('10.0.0.3', 3000))
+    registry.detach(token(42), 5)
+    registry.changes.close()
+
+    copy = restored(directory)
+    assert state(copy) == state(registry)
+    assert 'room-1' not in copy and 'room-2' not in copy
+    assert copy.owner('room-3') == token(999)
+    assert copy.validate('room-3', token(30)) is None
+
+def test_change_log_cut_short_ends_the_replay(tmp_path):
+    directory = str(tmp_path)
+    registry = RoomRegistry()
+    registry.swap_changes(snapshot.ChangeLog(directory, 1))
+    fill(registry, 2)
+    registry.changes.close()
+    path = snapshot.changes_path(directory, 1)
+    with open(path, 'rb') as changes:
+        data = changes.read()
+    with open(path, 'wb') as changes:
+        changes.write(data[:-3])
+    copy = restored(directory)
+    # Every record but the last join is replayed
+    assert copy.member_count() == registry.member_count() - 1
+    assert copy.member('room-1', token(13)) is None
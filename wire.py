@@ -0,0 +1,325 @@
+"""
+# Wire codec
+Framing of the TCP and UDP packets, shared by server.py, client.py and
+chat_client.py; the packets are described in the TCP and UDP sections of
+server.py.
+- every fixed layout is a struct.Struct compiled once
+- pack_*_into() write a frame into a buffer the caller owns, a pooled
+  buffer or a larger frame being assembled, and return its size; build_*()
+  allocate a bytearray for one frame
+- frames that never change, the status and error answers, are built once
+  and cached as bytes, callers must not modify them
+Room names, tokens and payloads are str or bytes.
+"""
+import functools
+import struct
+
+# Protocol versions
+# 1: every TCP and UDP frame is zero-padded to PACKET_SIZE bytes
+# 2: every frame is sized to its payload
+# 3: v2, and UDP frames carry Flags and the room's sequence number so lost messages are NACKed
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+PROTOCOL_V3 = 3
+SUPPORTED_VERSIONS = (PROTOCOL_V1, PROTOCOL_V2, PROTOCOL_V3)
+PACKET_SIZE = 4096
+# Flags(1byte) + Seq(8byte) between the token and the message of a v3 UDP frame
+V3_HEADER_SIZE = 9
+FLAG_ACK = 0x01
+FLAG_NACK = 0x02
+FLAG_RETRANSMIT = 0x04
+FLAG_BATCH = 0x08
+# The message is compressed, only set for clients that negotiated compression
+FLAG_COMPRESSED = 0x10
+# State of an operation 0, 3 or 7 request: the protocol version ORed with the capabilities the client asks for
+VERSION_MASK = 0x7f
+CAPABILITY_COMPRESSION = 0x80
+
+# TCP framing: every frame starts with a 32 byte header that sizes its body
+TCP_HEADER_SIZE = 32
+MAX_ROOM_NAME_SIZE = 255
+MAX_PAYLOAD_SIZE = 2**29 - 1
+# RoomNameSize(1) + Operation(1) + State(1) + RequestId(4) + OperationPayloadSize(25, big-endian),
+# a size below 2^64 is 17 zero bytes and 8 bytes of Q. RequestId took the top bytes of what was
+# a 29 byte size, always zero since no frame is that large, so a frame without one is unchanged
+TCP_HEADER = struct.Struct('>BBBI17xQ')
+# The same header with the 17 high bytes of the size, for frames from others
+TCP_HEADER_WIDE = struct.Struct('>BBBI17sQ')
+TCP_REQUEST_ID = struct.Struct('>I')
+SIZE_HIGH_ZERO = bytes(17)
+# RequestId 0 is a request answered in order, with operation 1 first
+MAX_REQUEST_ID = 2**32 - 1
+# RoomNameSize(1) + TokenSize(1) of a UDP frame
+UDP_HEADER = struct.Struct('BB')
+# Flags(1) + Seq(8) of a v3 UDP frame
+V3_HEADER = struct.Struct('>BQ')
+# Seq(8) + FrameSize(2) before every frame of an operation 4 payload
+HISTORY_RECORD = struct.Struct('>QH')
+# First(8) + Count(2) of every missing range in a v3 NACK
+NACK_RANGE = struct.Struct('>QH')
+# FrameSize(2) before every frame of a v3 batch
+BATCH_FRAME = struct.Struct('>H')
+# MemberCount(4) after every room name of an operation 12 payload
+MEMBER_COUNT = struct.Struct('>I')
+# Rooms in an operation 12 answer when the request does not say, and at most
+ROOM_PAGE_SIZE = 100
+MAX_ROOM_PAGE = 1000
+# Zero padding of v1 frames
+PADDING = bytes(PACKET_SIZE)
+
+def encode(value):
+    return value.encode() if isinstance(value, str) else value
+
+def tcp_packet_size(room_name_size, operation_payload_size, version=PROTOCOL_V1):
+    size = TCP_HEADER_SIZE + room_name_size + operation_payload_size
+    return max(size, PACKET_SIZE) if version == PROTOCOL_V1 else size
+
+def pack_tcp_packet_into(buffer, offset, operation, state, room_name, operation_payload, version=PROTOCOL_V1,
+                         request_id=0):
+    """Write a TCP frame into buffer at offset, the zero padding of a v1 frame included
+    Args:
+        room_name, operation_payload: bytes, within MAX_ROOM_NAME_SIZE and MAX_PAYLOAD_SIZE
+        request_id: RequestId of a pipelined request and of its answer
+    Returns:
+        the frame's size
+    """
+    body = offset + TCP_HEADER_SIZE
+    end = body + len(room_name) + len(operation_payload)
+    TCP_HEADER.pack_into(buffer, offset, len(room_name), operation, state, request_id, len(operation_payload))
+    buffer[body:body + len(room_name)] = room_name
+    buffer[body + len(room_name):end] = operation_payload
+    if version == PROTOCOL_V1 and end - offset < PACKET_SIZE:
+        buffer[end:offset + PACKET_SIZE] = PADDING[:offset + PACKET_SIZE - end]
+        end = offset + PACKET_SIZE
+    return end - offset
+
+def build_tcp_packet(operation, state, room_name, operation_payload, version=PROTOCOL_V1, request_id=0):
+    """One TCP frame, an error frame if room_name or operation_payload is too large"""
+    room_name = encode(room_name)
+    operation_payload = encode(operation_payload)
+    if len(room_name) > MAX_ROOM_NAME_SIZE:
+        return build_error_packet("Room name exceeds maximum size of 255 bytes", version, request_id)
+    if len(operation_payload) > MAX_PAYLOAD_SIZE:
+        return build_error_packet("Operation payload exceeds maximum size of 2^29 - 1 bytes", version, request_id)
+    packet = bytearray(tcp_packet_size(len(room_name), len(operation_payload), version))
+    pack_tcp_packet_into(packet, 0, operation, state, room_name, operation_payload, version, request_id)
+    return packet
+
+def build_error_packet(error_message, version=PROTOCOL_V1, request_id=0):
+    """Build a packet with operation=1 (error response) and state=1 (failed)"""
+    error_message = encode(error_message)[:MAX_PAYLOAD_SIZE]
+    packet = bytearray(tcp_packet_size(0, len(error_message), version))
+    pack_tcp_packet_into(packet, 0, 1, 1, b'', error_message, version, request_id)
+    return packet
+
+def with_request_id(frame, request_id):
+    """frame answering the request with request_id, a copy if it has to be changed"""
+    if not request_id:
+        return frame
+    frame = bytearray(frame)
+    TCP_REQUEST_ID.pack_into(frame, 3, request_id)
+    return frame
+
+@functools.lru_cache(maxsize=256)
+def error_packet(error_message, version=PROTOCOL_V1):
+    """build_error_packet() for a message that does not change, built once"""
+    return bytes(build_error_packet(error_message, version))
+
+@functools.lru_cache(maxsize=1024)
+def success_packet(room_name, version=PROTOCOL_V1):
+    """The operation 1 'Success' frame that starts the answer to every request for room_name"""
+    return bytes(build_tcp_packet(1, 0, room_name, 'Success', version))
+
+def parse_tcp_header(header):
+    """Split a 32 byte TCP header
+    Returns:
+        (room_name_size, operation, state, operation_payload_size, request_id)
+    """
+    room_name_size, operation, state, request_id, high, low = TCP_HEADER_WIDE.unpack_from(header)
+    if high != SIZE_HIGH_ZERO:
+        # Far larger than any frame anyone accepts, sized in full all the same
+        low |= int.from_bytes(high, 'big') << 64
+    return room_name_size, operation, state, low, request_id
+
+def udp_packet_size(room_name_size, token_size, message_size, version=PROTOCOL_V1):
+    size = 2 + room_name_size + token_size + message_size
+    if version == PROTOCOL_V3:
+        size += V3_HEADER_SIZE
+    return max(size, PACKET_SIZE) if version == PROTOCOL_V1 else size
+
+def pack_udp_packet_into(buffer, offset, room_name, token, message, version=PROTOCOL_V1, flags=0, seq=0):
+    """Write a UDP frame into buffer at offset, the zero padding of a v1 frame included
+    Args:
+        room_name, token, message: bytes
+        flags, seq: Flags and Seq of a v3 frame
+    Returns:
+        the frame's size
+    """
+    UDP_HEADER.pack_into(buffer, offset, len(room_name), len(token))
+    position = offset + 2
+    buffer[position:position + len(room_name)] = room_name
+    position += len(room_name)
+    buffer[position:position + len(token)] = token
+    position += len(token)
+    if version == PROTOCOL_V3:
+        V3_HEADER.pack_into(buffer, position, flags, seq)
+        position += V3_HEADER_SIZE
+    buffer[position:position + len(message)] = message
+    position += len(message)
+    if version == PROTOCOL_V1 and position - offset < PACKET_SIZE:
+        buffer[position:offset + PACKET_SIZE] = PADDING[:offset + PACKET_SIZE - position]
+        position = offset + PACKET_SIZE
+    return position - offset
+
+def build_udp_packet(room_name, token, message, version=PROTOCOL_V1, flags=0, seq=0):
+    room_name = encode(room_name)
+    token = encode(token)
+    message = encode(message)
+    packet = bytearray(udp_packet_size(len(room_name), len(token), len(message), version))
+    pack_udp_packet_into(packet, 0, room_name, token, message, version, flags, seq)
+    return packet
+
+@functools.lru_cache(maxsize=4096)
+def ack_header(room_name):
+    """The v3 ACK frame for room_name without its Seq"""
+    return bytes(build_udp_packet(room_name, b'', b'', PROTOCOL_V3, FLAG_ACK))[:-8]
+
+def build_ack_packet(room_name, seq):
+    """v3 ACK frame telling a client the room's messages up to seq exist"""
+    return ack_header(room_name) + seq.to_bytes(8, 'big')
+
+def parse_udp_packet(data):
+    """Parse the header of a received packet without copying it
+    Only the room name and token are decoded, the message stays in the packet.
+    Args:
+        data: memoryview of the received datagram
+    Returns:
+        (room_name, token, message_start)
+    """
+    room_name_size, token_size = UDP_HEADER.unpack_from(data)
+    message_start = 2 + room_name_size + token_size
+    room_name = str(data[2:2 + room_name_size], 'utf-8')
+    token = str(data[2 + room_name_size:message_start], 'utf-8')
+    return room_name, token, message_start
+
+def split_udp_packet(data, version=PROTOCOL_V1):
+    """(room_name, token, message) of a UDP frame as bytes, the padding of a v1 frame cut off"""
+    room_name_size, token_size = UDP_HEADER.unpack_from(data)
+    message_start = 2 + room_name_size + token_size
+    room_name = data[2:2 + room_name_size]
+    token = data[2 + room_name_size:message_start]
+    if version == PROTOCOL_V3:
+        message_start += V3_HEADER_SIZE
+    # The message runs to the end of the datagram, only v1 packets are zero-padded
+    message = data[message_start:]
+    if len(data) == PACKET_SIZE and version == PROTOCOL_V1:
+        # The padding starts at the first zero byte unless the message holds zeros of its own
+        end = message.find(0)
+        if end != -1 and message[end:] == PADDING[:len(message) - end]:
+            message = message[:end]
+        else:
+            message = message.rstrip(b'\x00')
+    return room_name, token, message
+
+def parse_v3_header(data, message_start):
+    """Flags and Seq of a v3 packet whose token ends at message_start"""
+    if len(data) < message_start + V3_HEADER_SIZE:
+        raise ValueError('v3 packet without Flags and Seq')
+    return V3_HEADER.unpack_from(data, message_start)
+
+def split_batch(data):
+    """The v3 packets packed in a FLAG_BATCH packet"""
+    offset = 2 + data[0] + data[1] + V3_HEADER_SIZE
+    packets = []
+    while offset + 2 <= len(data):
+        size, = BATCH_FRAME.unpack_from(data, offset)
+        packets.append(data[offset + 2:offset + 2 + size])
+        offset += 2 + size
+    return packets
+
+def compress_packet(packet, codec):
+    """The v3 packet with its message compressed, the packet itself if that does not shrink it
+    Args:
+        packet: a bytearray, its Flags are updated in place
+        codec: compression.Codec
+    """
+    message_start = 2 + packet[0] + packet[1] + V3_HEADER_SIZE
+    compressed = codec.compress(packet[message_start:])
+    if compressed is None:
+        return packet
+    packet[message_start - V3_HEADER_SIZE] |= FLAG_COMPRESSED
+    return bytes(packet[:message_start]) + compressed
+
+def decompress_packet(data, codec):
+    """The v3 packet with its compressed message decompressed and FLAG_COMPRESSED cleared
+    Raises:
+        ValueError: if the message cannot be decompressed, or codec is None
+    """
+    if codec is None:
+        raise ValueError('Compressed message but compression was not granted')
+    message_start = 2 + data[0] + data[1] + V3_HEADER_SIZE
+    header = bytearray(data[:message_start])
+    header[message_start - V3_HEADER_SIZE] &= ~FLAG_COMPRESSED
+    return bytes(header) + codec.decompress(data[message_start:])
+
+def split_udp_messages(data, version=PROTOCOL_V1, codec=None):
+    """Every (room_name, token, message) of a datagram, a v3 batch holds several and an ACK none
+    Args:
+        codec: compression.Codec of a client granted compression
+    Raises:
+        ValueError: if a compressed message cannot be decompressed
+    """
+    if version != PROTOCOL_V3:
+        return [split_udp_packet(data, version)]
+    flags, _ = parse_v3_header(data, 2 + data[0] + data[1])
+    if flags & FLAG_COMPRESSED:
+        data = decompress_packet(data, codec)
+    if flags & FLAG_BATCH:
+        return [message for packet in split_batch(data) for message in split_udp_messages(packet, version)]
+    if flags & FLAG_ACK:
+        return []
+    return [split_udp_packet(data, version)]
+
+def pack_nack(ranges):
+    """Message of a v3 NACK asking for the (first, count) ranges"""
+    return b''.join([NACK_RANGE.pack(first, count) for first, count in ranges])
+
+def split_nack(payload):
+    """(first, count) ranges of a v3 NACK's message, a range cut short is left out"""
+    return list(NACK_RANGE.iter_unpack(payload[:len(payload) - len(payload) % NACK_RANGE.size]))
+
+def pack_room_list(rooms):
+    """Operation 12 payload of (room_name, member_count) pairs"""
+    records = []
+    for room_name, member_count in rooms:
+        room_name = encode(room_name)
+        records.append(bytes((len(room_name),)) + room_name + MEMBER_COUNT.pack(member_count))
+    return b''.join(records)
+
+def split_room_list(operation_payload):
+    """(room_name, member_count) pairs of an operation 12 payload, in order, a record cut short ends it"""
+    rooms = []
+    offset = 0
+    while offset < len(operation_payload):
+        end = offset + 1 + operation_payload[offset]
+        if end + MEMBER_COUNT.size > len(operation_payload):
+            break
+        member_count, = MEMBER_COUNT.unpack_from(operation_payload, end)
+        rooms.append((bytes(operation_payload[offset + 1:end]).decode(errors='replace'), member_count))
+        offset = end + MEMBER_COUNT.size
+    return rooms
+
+def pack_history(records):
+    """Operation 4 payload of (seq, frame) records"""
+    return b''.join([HISTORY_RECORD.pack(seq, len(frame)) + frame for seq, frame in records])
+
+def split_history(operation_payload):
+    """(seq, frame) records of an operation 4 payload, oldest first"""
+    records = []
+    offset = 0
+    while offset + HISTORY_RECORD.size <= len(operation_payload):
+        seq, size = HISTORY_RECORD.unpack_from(operation_payload, offset)
+        offset += HISTORY_RECORD.size
+        records.append((seq, operation_payload[offset:offset + size]))
+        offset += size
+    return records
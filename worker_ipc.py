@@ -0,0 +1,108 @@
+"""
+# Worker IPC
+Channels between the forked server workers, one Unix datagram socketpair
+per worker: every worker keeps the sending end of every pair and reads its
+own inbox from the receiving end. A datagram on a Unix socket is never split
+or merged, so each message is one datagram.
+
+Messages:
+- UDP forward | b'U' + IP(4byte) + Port(2byte) + the received datagram, byte-for-byte
+- TCP request | b'T' + pickled (request_id, reply_worker, request)
+- TCP reply   | b'R' + pickled (request_id, reply)
+
+Rooms are owned by the worker room_worker() picks, so every packet and join
+for a room ends up in the one worker that holds the room.
+"""
+import pickle
+import socket
+import struct
+import zlib
+
+UDP_FORWARD = b'U'
+TCP_REQUEST = b'T'
+TCP_REPLY = b'R'
+
+# Socket buffer of each inbox, messages queue here while the worker is busy
+INBOX_BUFFER = 1 << 22
+# Largest message read from an inbox, a forwarded datagram plus its header
+MAX_MESSAGE = 65536
+
+_ADDRESS = struct.Struct('!4sH')
+
+def room_worker(room_name, workers):
+    """Index of the worker that owns the room
+    crc32 is stable across processes, unlike hash() with hash randomization.
+    Args:
+        room_name: room name, str or bytes-like
+        workers: number of workers
+    """
+    if isinstance(room_name, str):
+        room_name = room_name.encode()
+    return zlib.crc32(room_name) % workers
+
+class WorkerChannels:
+    """Inboxes of every worker, created before forking"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.outboxes = []
+        self.inboxes = []
+        for _ in range(workers):
+            inbox, outbox = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            inbox.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, INBOX_BUFFER)
+            outbox.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, INBOX_BUFFER)
+            # A full inbox drops the message instead of stalling the sender
+            outbox.setblocking(False)
+            inbox.setblocking(False)
+            self.inboxes.append(inbox)
+            self.outboxes.append(outbox)
+        self.inbox = None
+
+    def attach(self, worker):
+        """Keep only what worker needs after the fork: its inbox and every outbox"""
+        for index, inbox in enumerate(self.inboxes):
+            if index != worker:
+                inbox.close()
+        self.inbox = self.inboxes[worker]
+        self.inboxes = []
+
+    def send(self, worker, message):
+        """Send one message to worker's inbox
+        Returns:
+            False if the inbox is full and the message was dropped
+        """
+        try:
+            self.outboxes[worker].send(message)
+            return True
+        except BlockingIOError:
+            return False
+
+    def forward_udp(self, worker, data, address):
+        """Forward a datagram received from address to worker"""
+        ip, port = address
+        return self.send(worker, UDP_FORWARD + _ADDRESS.pack(socket.inet_aton(ip), port) + data)
+
+    def request(self, worker, request_id, reply_worker, request):
+        return self.send(worker, TCP_REQUEST + pickle.dumps((request_id, reply_worker, request)))
+
+    def reply(self, worker, request_id, reply):
+        return self.send(worker, TCP_REPLY + pickle.dumps((request_id, reply)))
+
+    def receive(self):
+        """Read one message from the inbox
+        Returns:
+            (kind, payload), kind is UDP_FORWARD, TCP_REQUEST or TCP_REPLY:
+            UDP_FORWARD: (datagram, (ip, port))
+            TCP_REQUEST: (request_id, reply_worker, request)
+            TCP_REPLY: (request_id, reply)
+            None if the inbox is empty
+        """
+        try:
+            message = self.inbox.recv(MAX_MESSAGE)
+        except BlockingIOError:
+            return None
+        kind = message[:1]
+        if kind == UDP_FORWARD:
+            packed_ip, port = _ADDRESS.unpack_from(message, 1)
+            return kind, (memoryview(message)[1 + _ADDRESS.size:], (socket.inet_ntoa(packed_ip), port))
+        return kind, pickle.loads(message[1:])